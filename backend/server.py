@@ -9,6 +9,14 @@ import subprocess
 import webbrowser
 import mimetypes
 import signal
+import functools
+import gzip
+import math
+import sqlite3
+import itertools
+import random
+import uuid
+import select
 
 def kill_existing_instance():
     """尝试杀死已经在运行的后端实例 (占用 17471 端口的进程)"""
@@ -44,15 +52,34 @@ try:
     HAS_PYPINYIN = True
 except ImportError:
     HAS_PYPINYIN = False
-from threading import Timer, Lock
-from flask import Flask, request, jsonify, send_file, send_from_directory
+try:
+    import psutil
+    HAS_PSUTIL = True
+except ImportError:
+    HAS_PSUTIL = False
+try:
+    import brotli
+    HAS_BROTLI = True
+except ImportError:
+    HAS_BROTLI = False
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+from threading import Timer, Lock, Thread, Event, Condition, local
+from collections import OrderedDict, deque
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from flask import Flask, request, jsonify, send_file, g, has_request_context, abort
+from werkzeug.security import safe_join
 from flask_cors import CORS
 
 app = Flask(__name__)
 CORS(app)
 
 GAME_HOST = "127.0.0.1"
-GAME_PORT = 12345
+GAME_PORT = int(os.environ.get("TWWE_GAME_PORT", 12345))
 _GAME_ROOT = None
 
 import time
@@ -81,17 +108,312 @@ else:
 # 配置 Flask 静态资源目录 (用于打包 EXE 后能找到网页)
 app.static_folder = FRONTEND_DIST
 
-# 进程管理：防止多个 luajit 同时运行撑爆内存
-active_processes = {}
-process_lock = Lock()
+# 评估进程资源限制 (均可通过环境变量覆盖，<= 0 表示不限制)
+# 内存 / CPU 限制通过 rlimit 作用于 luajit 子进程 (仅 POSIX)，输出大小在读取 stdout 时流式统计
+EVAL_TIMEOUT_SEC = float(os.environ.get("TWWE_EVAL_TIMEOUT", 60))
+EVAL_MEMORY_LIMIT_MB = int(os.environ.get("TWWE_EVAL_MEMORY_MB", 2048))
+EVAL_CPU_LIMIT_SEC = int(os.environ.get("TWWE_EVAL_CPU_SEC", 60))
+EVAL_OUTPUT_LIMIT_MB = float(os.environ.get("TWWE_EVAL_OUTPUT_MB", 200))
+# 未折叠结果超过该大小时浏览器基本无法渲染
+EVAL_UNFOLDED_LIMIT_MB = float(os.environ.get("TWWE_EVAL_UNFOLDED_MB", 15))
+# tree_format: "dag" 的未折叠结果会在浏览器里还原成完整的树逐个渲染，按展开后的节点数限制
+# (默认值约等于 EVAL_UNFOLDED_LIMIT_MB 的未折叠输出，每个节点约 64 字节)
+EVAL_UNFOLDED_MAX_NODES = int(os.environ.get("TWWE_EVAL_UNFOLDED_NODES", EVAL_UNFOLDED_LIMIT_MB * 1024 * 1024 / 64))
+# 触发限制时是否自动开启折叠重新评估 (请求中的 auto_fold 字段可覆盖)。
+# 默认关闭：明确要求 fold_nodes: false 的请求不应被悄悄改成折叠结果
+EVAL_AUTO_FOLD = os.environ.get("TWWE_EVAL_AUTO_FOLD", "0") == "1"
 
-# 预加载数据
+# 预加载数据 (模组状态见 法术库快照)
 _SPELL_CACHE = {}
-_MOD_SPELL_CACHE = {}
-_MOD_APPENDS_CACHE = {}
-_ACTIVE_MODS_CACHE = []
 _TRANSLATIONS = {}
 
+# ==== 运行指标 (Prometheus 文本格式，由 /metrics 导出) ====
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(11)) # 1KB ~ 1GB
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in items) + "}"
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class MetricsRegistry:
+    """极简的指标注册表：counter / gauge / histogram，标签以 kwargs 传入"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = {}  # name -> {"type", "help", "buckets", "values"}
+        self._collectors = []
+
+    def _declare(self, kind, name, help_text, buckets=None):
+        self._metrics[name] = {"type": kind, "help": help_text, "buckets": buckets, "values": {}}
+
+    def counter(self, name, help_text):
+        self._declare("counter", name, help_text)
+
+    def gauge(self, name, help_text):
+        self._declare("gauge", name, help_text)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._declare("histogram", name, help_text, tuple(buckets))
+
+    def collector(self, func):
+        """注册抓取时才计算的指标 (例如进程数)，func 在 render 前被调用"""
+        self._collectors.append(func)
+        return func
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._metrics[name]["values"]
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._metrics[name]["values"][key] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            metric = self._metrics[name]
+            entry = metric["values"].get(key)
+            if entry is None:
+                entry = metric["values"][key] = {"buckets": [0] * len(metric["buckets"]), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(metric["buckets"]):
+                if value <= bound:
+                    entry["buckets"][i] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def label_sets(self, name):
+        with self._lock:
+            return [dict(labels) for labels in self._metrics[name]["values"]]
+
+    def get(self, name, **labels):
+        with self._lock:
+            return self._metrics[name]["values"].get(tuple(sorted(labels.items())), 0)
+
+    def render(self):
+        for func in self._collectors:
+            try:
+                func()
+            except Exception as e:
+                print(f"[Metrics] Collector error: {e}")
+
+        lines = []
+        with self._lock:
+            for name, metric in self._metrics.items():
+                lines.append(f"# HELP {name} {metric['help']}")
+                lines.append(f"# TYPE {name} {metric['type']}")
+                for labels, value in sorted(metric["values"].items()):
+                    if metric["type"] != "histogram":
+                        lines.append(f"{name}{_format_labels(labels)} {_format_number(value)}")
+                        continue
+                    for bound, count in zip(metric["buckets"], value["buckets"]):
+                        lines.append(f"{name}_bucket{_format_labels(labels, ('le', _format_number(float(bound))))} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {value['count']}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_number(value['sum'])}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.histogram("twwe_http_request_duration_seconds", "HTTP request latency by route")
+metrics.histogram("twwe_eval_spawn_seconds", "Time to spawn the luajit evaluator process")
+metrics.histogram("twwe_eval_simulate_seconds", "Time from evaluator spawn until process exit")
+metrics.histogram("twwe_eval_read_seconds", "Time spent collecting evaluator output after exit")
+metrics.histogram("twwe_eval_transfer_seconds", "Time to send evaluation results to the client")
+metrics.histogram("twwe_eval_output_bytes", "Evaluator stdout size in bytes", BYTES_BUCKETS)
+metrics.counter("twwe_eval_runs_total", "Evaluator runs by final status")
+metrics.counter("twwe_fast_eval_total", "In-process fast evaluator results (hit / fallback)")
+metrics.histogram("twwe_tree_dag_ratio", "Unique / expanded node ratio of DAG-folded trees", (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 1))
+metrics.histogram("twwe_static_compress_seconds", "Time to compress a static file by encoding")
+metrics.counter("twwe_eval_cancelled_total", "Evaluations cancelled by reason (cancelled / disconnected)")
+metrics.histogram("twwe_shared_state_write_bytes", "Size of values written to the shared state database", BYTES_BUCKETS)
+metrics.counter("twwe_game_events_total", "Game state events published to /api/events subscribers by type")
+metrics.counter("twwe_sweep_points_total", "Parameter sweep points by engine / error")
+metrics.counter("twwe_monte_carlo_runs_total", "Shuffle Monte Carlo runs by result")
+metrics.histogram("twwe_bridge_rtt_seconds", "Game bridge round-trip time by command")
+metrics.counter("twwe_bridge_failures_total", "Failed game bridge round-trips by command")
+metrics.histogram("twwe_bridge_response_bytes", "Game bridge response size by command", BYTES_BUCKETS)
+metrics.counter("twwe_cache_requests_total", "Cache lookups by cache and result (hit / miss)")
+metrics.gauge("twwe_cache_hit_ratio", "Cache hit ratio since startup")
+metrics.gauge("twwe_eval_processes", "Evaluator child processes tracked by the supervisor")
+metrics.counter("twwe_eval_processes_spawned_total", "Evaluator child processes spawned since startup")
+metrics.counter("twwe_eval_processes_killed_total", "Evaluator child processes killed by reason")
+metrics.gauge("twwe_backend_rss_bytes", "Resident memory of the backend process")
+metrics.gauge("twwe_result_store_entries", "Evaluation results held server-side")
+metrics.gauge("twwe_result_store_bytes", "Estimated size of evaluation results held server-side")
+
+def record_cache(cache, hit):
+    metrics.inc("twwe_cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+# ==== 单请求阶段追踪 (按需开启) ====
+# 请求头 X-TWWE-Trace: 1 或查询参数 ?trace=1 开启，结果通过 Server-Timing 响应头返回。
+# 额外指定 X-TWWE-Profile / ?profile=cprofile|tracemalloc (逗号分隔) 时把该请求的剖析结果写入 PROFILE_DIR。
+if getattr(sys, 'frozen', False):
+    _DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(sys.executable), "twwe_cache")
+else:
+    _DEFAULT_CACHE_DIR = os.path.join(BASE_DIR, ".twwe_cache")
+CACHE_DIR = os.environ.get("TWWE_CACHE_DIR", _DEFAULT_CACHE_DIR)
+PROFILE_DIR = os.path.join(CACHE_DIR, "profiles")
+
+_TRACEMALLOC_LOCK = Lock()
+
+class RequestTrace:
+    def __init__(self, profile_modes):
+        self.spans = {}  # name -> [总耗时, 次数]，同名阶段 (例如逐页调用 lua helper) 累加
+        self.start = time.perf_counter()
+        self.profile_modes = profile_modes
+        self.profiler = None
+        self.tracemalloc_snapshot = None
+
+    def add(self, name, duration):
+        span = self.spans.setdefault(name, [0.0, 0])
+        span[0] += duration
+        span[1] += 1
+
+    def server_timing(self):
+        parts = []
+        for name, (duration, count) in self.spans.items():
+            entry = f"{name};dur={duration * 1000:.2f}"
+            if count > 1:
+                entry += f';desc="x{count}"'
+            parts.append(entry)
+        parts.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.2f}")
+        return ", ".join(parts)
+
+def current_trace():
+    if not has_request_context():
+        return None
+    return g.get("twwe_trace")
+
+def trace_add(name, duration):
+    trace = current_trace()
+    if trace is not None:
+        trace.add(name, duration)
+
+class trace_span:
+    """with trace_span("phase"): ... 未开启追踪时几乎零开销"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        trace_add(self.name, time.perf_counter() - self.start)
+        return False
+
+def traced(name):
+    """把整个函数记为一个追踪阶段"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _trace_flag(header, param):
+    value = request.headers.get(header) or request.args.get(param)
+    return value.strip().lower() if value else ""
+
+@app.before_request
+def _start_request_trace():
+    trace_flag = _trace_flag("X-TWWE-Trace", "trace")
+    profile_flag = _trace_flag("X-TWWE-Profile", "profile")
+    if not (trace_flag in ("1", "true", "yes") or profile_flag):
+        return
+
+    modes = {m.strip() for m in profile_flag.split(",") if m.strip()} & {"cprofile", "tracemalloc"}
+    trace = RequestTrace(modes)
+    if "tracemalloc" in modes:
+        import tracemalloc
+        # tracemalloc 是进程级的，同一时间只允许一个请求使用
+        if _TRACEMALLOC_LOCK.acquire(blocking=False):
+            tracemalloc.start()
+            trace.tracemalloc_snapshot = tracemalloc.take_snapshot()
+        else:
+            modes.discard("tracemalloc")
+    if "cprofile" in modes:
+        import cProfile
+        try:
+            trace.profiler = cProfile.Profile()
+            trace.profiler.enable()
+        except ValueError:
+            # Python 3.12+ 同一时间只允许一个 profiler
+            trace.profiler = None
+            modes.discard("cprofile")
+    g.twwe_trace = trace
+
+@app.after_request
+def _finish_request_trace(response):
+    trace = g.pop("twwe_trace", None)
+    if trace is None:
+        return response
+
+    dumps = []
+    if trace.profile_modes:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        route = request.url_rule.rule if request.url_rule else request.path
+        base_name = time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}-" + re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_")
+    if trace.profiler is not None:
+        trace.profiler.disable()
+        path = os.path.join(PROFILE_DIR, base_name + ".prof")
+        trace.profiler.dump_stats(path)
+        dumps.append(path)
+    if trace.tracemalloc_snapshot is not None:
+        import tracemalloc
+        try:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        finally:
+            _TRACEMALLOC_LOCK.release()
+        path = os.path.join(PROFILE_DIR, base_name + ".tracemalloc.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"peak traced memory: {peak / (1024 * 1024):.2f} MB\n\n")
+            for stat in snapshot.compare_to(trace.tracemalloc_snapshot, "lineno")[:50]:
+                f.write(f"{stat}\n")
+        dumps.append(path)
+    if dumps:
+        print(f"[Trace] Profile written: {', '.join(dumps)}")
+        response.headers["X-TWWE-Profile-Dump"] = ";".join(dumps)
+
+    response.headers["Server-Timing"] = trace.server_timing()
+    response.headers["Timing-Allow-Origin"] = "*"
+    return response
+
+@app.teardown_request
+def _abort_request_trace(exc=None):
+    """视图抛出异常时 after_request 可能不会执行：停止仍在运行的 profiler / tracemalloc，否则之后的剖析请求都会被挡住"""
+    trace = g.pop("twwe_trace", None)
+    if trace is None:
+        return
+    if trace.profiler is not None:
+        trace.profiler.disable()
+    if trace.tracemalloc_snapshot is not None:
+        import tracemalloc
+        try:
+            tracemalloc.stop()
+        finally:
+            _TRACEMALLOC_LOCK.release()
+    print(f"[Trace] Request failed before its profile was written: {exc}")
+
+@traced("pinyin")
 def get_pinyin_data(text):
     if not HAS_PYPINYIN or not text:
         return "", ""
@@ -104,18 +426,258 @@ def get_pinyin_data(text):
     except:
         return "", ""
 
-def load_translations():
-    global _TRANSLATIONS
-    if _TRANSLATIONS: return _TRANSLATIONS
-    
-    trans_files = [
+# ==== 法术库快照 ====
+# 本地法术库、游戏同步的模组法术、法术追加脚本与活动模组列表作为一个不可变的快照整体发布：
+# 写入方 (游戏同步、其它 worker 的共享状态) 构建好新快照后一次赋值替换，
+# 读取方在请求开始时取一次 get_snapshot()，之后整个请求 (包括参数扫描的所有点) 看到的都是同一个版本，无需加锁或复制。
+# 快照版本号会出现在评估响应 (X-TWWE-Snapshot) 与依赖法术库的缓存键里。
+
+class SpellSnapshot:
+    __slots__ = ("version", "static_db", "mod_spells", "appends", "active_mods", "spells", "_spells", "_spells_json")
+
+    def __init__(self, version, static_db, mod_spells, appends, active_mods):
+        self.version = version
+        self.static_db = static_db   # 尚未加载本地法术库时为 None
+        self.mod_spells = MappingProxyType(dict(mod_spells))
+        self.appends = MappingProxyType(dict(appends))
+        self.active_mods = tuple(active_mods)
+        # 合并只在发布时做一次 (游戏同步的法术优先)
+        merged = dict(static_db or {})
+        merged.update(mod_spells)
+        self._spells = merged
+        self.spells = MappingProxyType(merged)
+        self._spells_json = None
+
+    def spells_json(self):
+        """合并后法术库的 JSON 与其摘要 (每个快照只序列化一次)"""
+        if self._spells_json is None:
+            import hashlib
+            body = json.dumps(self._spells, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            self._spells_json = (body, hashlib.sha1(body).hexdigest()[:20])
+        return self._spells_json
+
+_SNAPSHOT = SpellSnapshot(0, None, {}, {}, [])
+_SNAPSHOT_LOCK = Lock()
+_SNAPSHOT_UNSET = object()
+_SNAPSHOT_LISTENERS = []
+
+def publish_snapshot(static_db=_SNAPSHOT_UNSET, mod_spells=_SNAPSHOT_UNSET, appends=_SNAPSHOT_UNSET, active_mods=_SNAPSHOT_UNSET):
+    """以当前快照为基础替换给定的部分，发布并返回新快照"""
+    global _SNAPSHOT
+    with _SNAPSHOT_LOCK:
+        cur = _SNAPSHOT
+        snapshot = SpellSnapshot(
+            cur.version + 1,
+            cur.static_db if static_db is _SNAPSHOT_UNSET else static_db,
+            cur.mod_spells if mod_spells is _SNAPSHOT_UNSET else mod_spells,
+            cur.appends if appends is _SNAPSHOT_UNSET else appends,
+            cur.active_mods if active_mods is _SNAPSHOT_UNSET else active_mods,
+        )
+        _SNAPSHOT = snapshot
+    for callback in _SNAPSHOT_LISTENERS:
+        try:
+            callback(snapshot)
+        except Exception as e:
+            print(f"[Snapshot] Listener failed: {e}")
+    return snapshot
+
+def on_snapshot(callback):
+    """注册快照发布后的回调 (在发布方的线程里调用)"""
+    _SNAPSHOT_LISTENERS.append(callback)
+
+def get_snapshot():
+    """当前快照；本地法术库第一次被用到时加载并发布一个包含它的新快照"""
+    snapshot = _SNAPSHOT
+    if snapshot.static_db is None:
+        static_db = load_spell_database()
+        if static_db:
+            with _SNAPSHOT_LOCK:
+                loaded = _SNAPSHOT.static_db is not None
+            snapshot = _SNAPSHOT if loaded else publish_snapshot(static_db=static_db)
+    return snapshot
+
+# ==== 多进程共享缓存 ====
+# 在 gunicorn 等多 worker 部署下，法术库与游戏同步的模组状态保存在一个 SQLite 文件里，所有 worker 读到同一份数据：
+#   - 游戏同步只会打到某一个 worker，它把新的模组状态写入共享库，其它 worker 在下一个请求开始时发现版本变化并载入
+#   - 本地法术库按源文件摘要保存，只有第一个 worker 需要解析 gun_actions.lua
+# 翻译表本身已经是按摘要命名的磁盘缓存 (见 load_translations)，各 worker 直接共用。
+# 单进程运行时行为不变；共享库不可用 (例如缓存目录只读) 时退回纯内存。
+SHARED_STATE_PATH = os.environ.get("TWWE_SHARED_STATE_DB", os.path.join(CACHE_DIR, "shared_state.db"))
+
+class SharedState:
+    """
+    版本化的键值缓存。每次写入分配一个新的全局版本号；
+    读取方用 PRAGMA data_version 判断其它进程是否写过，没有变化时一次 refresh 只是一条 PRAGMA，
+    有变化时只重新读取版本号变了的键，并交给 on_change 注册的回调。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._conn = None
+        self._data_version = None
+        self._versions = {}   # key -> 本进程已载入的版本
+        self._listeners = {}  # key -> callback(value)
+        self.disabled = False
+
+    def _connection(self):
+        if self._conn is None and not self.disabled:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS shared_state ("
+                             "key TEXT PRIMARY KEY, version INTEGER NOT NULL, data BLOB NOT NULL) WITHOUT ROWID")
+                self._conn = conn
+            except (sqlite3.Error, OSError) as e:
+                print(f"[SharedState] Disabled, falling back to per-process caches: {e}")
+                self.disabled = True
+        return self._conn
+
+    def _fail(self, e):
+        print(f"[SharedState] Disabled after error: {e}")
+        self.disabled = True
+        self._conn = None
+
+    def on_change(self, key, callback):
+        self._listeners[key] = callback
+
+    def put(self, key, value):
+        """写入并返回新的版本号 (共享库不可用时返回 None)"""
+        data = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        with self._lock:
+            conn = self._connection()
+            if conn is None:
+                return None
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    version = conn.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM shared_state").fetchone()[0]
+                    conn.execute("INSERT OR REPLACE INTO shared_state (key, version, data) VALUES (?, ?, ?)",
+                                 (key, version, data))
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+            except sqlite3.Error as e:
+                self._fail(e)
+                return None
+            self._versions[key] = version
+        metrics.observe("twwe_shared_state_write_bytes", len(data), key=key)
+        return version
+
+    def get(self, key):
+        with self._lock:
+            conn = self._connection()
+            if conn is None:
+                return None
+            try:
+                row = conn.execute("SELECT data FROM shared_state WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error as e:
+                self._fail(e)
+                return None
+        return json.loads(row[0]) if row else None
+
+    def delete(self, key):
+        with self._lock:
+            conn = self._connection()
+            if conn is None:
+                return
+            try:
+                conn.execute("DELETE FROM shared_state WHERE key = ?", (key,))
+            except sqlite3.Error as e:
+                self._fail(e)
+            self._versions.pop(key, None)
+
+    def refresh(self):
+        """载入其它进程写入的新版本，返回更新的键的个数"""
+        if self.disabled or not self._listeners:
+            return 0
+        with self._lock:
+            conn = self._connection()
+            if conn is None:
+                return 0
+            try:
+                data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+                if data_version == self._data_version:
+                    return 0
+                self._data_version = data_version
+                changed = []
+                for key, version in conn.execute("SELECT key, version FROM shared_state").fetchall():
+                    if key in self._listeners and self._versions.get(key) != version:
+                        row = conn.execute("SELECT data, version FROM shared_state WHERE key = ?", (key,)).fetchone()
+                        if row:
+                            changed.append((key, row[1], json.loads(row[0])))
+            except sqlite3.Error as e:
+                self._fail(e)
+                return 0
+            for key, version, value in changed:
+                self._listeners[key](value)
+                self._versions[key] = version
+        for key, version, _ in changed:
+            print(f"[SharedState] Loaded {key} v{version} written by another worker")
+        return len(changed)
+
+shared_state = SharedState(SHARED_STATE_PATH)
+
+def _apply_shared_mod_state(state):
+    publish_snapshot(mod_spells=state.get("spells") or {}, appends=state.get("appends") or {},
+                     active_mods=state.get("active_mods") or [])
+
+shared_state.on_change("mod_state", _apply_shared_mod_state)
+# 新启动的 worker 先载入其它 worker 已经同步好的状态
+shared_state.refresh()
+
+def reset_shared_state():
+    """
+    丢弃上一次运行留下的模组状态 (与单进程重启后的行为一致)。
+    直接运行 server.py 时在启动时调用；gunicorn 部署可以在 on_starting 钩子里调用，不要在 worker 里调用。
+    """
+    shared_state.delete("mod_state")
+    _apply_shared_mod_state({})
+
+@app.before_request
+def _refresh_shared_state():
+    shared_state.refresh()
+
+# ==== 翻译表 ====
+# common.csv 等文件预处理成按语言分列的二进制文件 (偏移表 + UTF-8 数据)，缓存在 CACHE_DIR/translations/<源文件哈希>/。
+# 冷启动只需读取键列表，各语言列在第一次访问时才 mmap，取值时解码并 intern，切换界面语言几乎零开销。
+TRANSLATION_FORMAT_VERSION = 1
+_TRANSLATION_MAGIC = b"TWTR"
+
+def _translation_sources():
+    return [
         os.path.join(EXTRACTED_DATA_ROOT, "data/translations/common.csv"),
         os.path.join(EXTRACTED_DATA_ROOT, "data/translations/common_dev.csv"),
         os.path.join(BASE_DIR, "spell_mapping.md") # 支持新的 md 格式
     ]
-    
-    translations = {}
-    for file_path in trans_files:
+
+def _translation_digest(sources):
+    import hashlib
+    h = hashlib.sha1(f"v{TRANSLATION_FORMAT_VERSION}:{sys.byteorder}".encode())
+    for file_path in sources:
+        h.update(file_path.encode("utf-8", "replace") + b"\0")
+        if os.path.exists(file_path):
+            with open(file_path, "rb") as f:
+                h.update(hashlib.sha1(f.read()).digest())
+        else:
+            h.update(b"-")
+    return h.hexdigest()[:20]
+
+def _parse_translation_sources(sources):
+    """解析源文件，返回 (keys, {语言: {key: 值}})。"zh" 是首选中文列，"aliases" 来自 spell_mapping.md"""
+    import csv
+    columns = {"en": {}, "zh": {}}
+    order = {}
+
+    def put(lang, key, val):
+        if key not in order:
+            order[key] = len(order)
+        columns.setdefault(lang, {})[key] = val
+
+    for file_path in sources:
         if not os.path.exists(file_path):
             continue
         try:
@@ -128,50 +690,183 @@ def load_translations():
                         parts = [p.strip() for p in line.split("|")]
                         if len(parts) >= 4:
                             key = parts[0].lstrip('$')
-                            translations[key] = {
-                                "en": key, # md 暂时没存英文名，用 ID 占位
-                                "zh": parts[2] or parts[1], # 优先选汉化 mod 名，没有则选官方中文
-                                "aliases": parts[3] # 存入别名
-                            }
+                            put("en", key, key) # md 暂时没存英文名，用 ID 占位
+                            put("zh", key, parts[2] or parts[1]) # 优先选汉化 mod 名，没有则选官方中文
+                            put("aliases", key, parts[3]) # 存入别名
                     continue
 
-                import csv
                 # Noita CSVs often have junk or extra commas, we use a simple reader
                 reader = csv.reader(f)
                 header = next(reader, None)
                 if not header: continue
-                
+
                 # Standard Noita indices
-                en_idx = 1
                 zh_idx = 9 # Default zh-cn index
-                
-                # Dynamic index detection
+                lang_cols = []
                 for i, h in enumerate(header):
-                    h_lower = h.lower()
-                    if h_lower == 'en': en_idx = i
-                    elif h_lower == 'zh-cn': zh_idx = i
+                    h_lower = h.strip().lower()
+                    if i == 0 or not h_lower or h_lower.startswith("notes") or h_lower == "max length":
+                        continue
+                    lang_cols.append((h_lower, i))
+                    if h_lower == 'zh-cn': zh_idx = i
                     elif 'zh-cn汉化mod' in h_lower: zh_idx = i # Prefer modded zh-cn if available
                     elif h_lower == '简体中文' and zh_idx == 9: zh_idx = i
-                
+                if not any(lang == "en" for lang, _ in lang_cols):
+                    lang_cols.append(("en", 1))
+                lang_cols.append(("zh", zh_idx))
+
                 for row in reader:
                     if not row or len(row) < 2: continue
                     key = row[0].lstrip('$')
                     if not key: continue
-                    
-                    en_val = row[en_idx] if len(row) > en_idx else ""
-                    zh_val = row[zh_idx] if len(row) > zh_idx else ""
-                    
-                    # Store translations
-                    if key not in translations:
-                        translations[key] = {"en": "", "zh": ""}
-                    
-                    if en_val: translations[key]["en"] = en_val.replace('\\n', '\n').strip('"')
-                    if zh_val: translations[key]["zh"] = zh_val.replace('\\n', '\n').strip('"')
+                    if key not in order:
+                        order[key] = len(order)
+                    for lang, idx in lang_cols:
+                        val = row[idx] if len(row) > idx else ""
+                        if val:
+                            columns.setdefault(lang, {})[key] = val.replace('\\n', '\n').strip('"')
         except Exception as e:
             print(f"Error loading translations from {file_path}: {e}")
-            
-    _TRANSLATIONS = translations
-    return translations
+
+    return list(order), columns
+
+def _write_translation_cache(cache_dir, keys, columns):
+    from array import array
+    tmp_dir = f"{cache_dir}.tmp{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    for lang, values in columns.items():
+        offsets = array("I", [0])
+        blob = bytearray()
+        for key in keys:
+            blob += values.get(key, "").encode("utf-8")
+            offsets.append(len(blob))
+        with open(os.path.join(tmp_dir, f"{_safe_lang_name(lang)}.bin"), "wb") as f:
+            f.write(_TRANSLATION_MAGIC)
+            f.write(len(keys).to_bytes(4, "little"))
+            offsets.tofile(f)
+            f.write(blob)
+    with open(os.path.join(tmp_dir, "index.json"), "w", encoding="utf-8") as f:
+        json.dump({"version": TRANSLATION_FORMAT_VERSION, "languages": list(columns), "keys": keys}, f, ensure_ascii=False)
+    try:
+        os.replace(tmp_dir, cache_dir)
+    except OSError:
+        # 其它进程已经生成了同一份缓存
+        import shutil
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def _safe_lang_name(lang):
+    return re.sub(r"[^0-9A-Za-z_-]", lambda m: f"%{ord(m.group()):x}", lang)
+
+class TranslationStore:
+    """
+    只读翻译表。keys 常驻内存 (interned)，每种语言一个 mmap 文件，首次访问时才打开。
+    store.get(key, "en")；"zh" 为首选中文 (汉化 mod 列优先)，其余语言名与 CSV 表头一致 (小写)。
+    """
+
+    def __init__(self, cache_dir, keys, languages):
+        self.cache_dir = cache_dir
+        self.keys = keys
+        self.index = {sys.intern(k): i for i, k in enumerate(keys)}
+        self.languages = languages
+        self._columns = {}
+        self._lock = Lock()
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _column(self, lang):
+        col = self._columns.get(lang)
+        if col is not None:
+            return col
+        with self._lock:
+            col = self._columns.get(lang)
+            if col is None:
+                import mmap
+                path = os.path.join(self.cache_dir, f"{_safe_lang_name(lang)}.bin")
+                with open(path, "rb") as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                count = int.from_bytes(mm[4:8], "little")
+                data_start = 8 + 4 * (count + 1)
+                offsets = memoryview(mm)[8:data_start].cast("I")
+                col = {"mm": mm, "offsets": offsets, "start": data_start, "decoded": [None] * count}
+                self._columns[lang] = col
+        return col
+
+    def get(self, key, lang, default=""):
+        idx = self.index.get(key)
+        if idx is None or lang not in self.languages:
+            return default
+        col = self._column(lang)
+        val = col["decoded"][idx]
+        if val is None:
+            begin, end = col["offsets"][idx], col["offsets"][idx + 1]
+            start = col["start"]
+            val = sys.intern(col["mm"][start + begin:start + end].decode("utf-8"))
+            col["decoded"][idx] = val
+        return val or default
+
+    def column(self, lang):
+        """整列导出为 {key: 值} (跳过空值)"""
+        return {key: val for key in self.keys if (val := self.get(key, lang))}
+
+class _MemoryTranslationStore:
+    """缓存目录不可写时使用，接口与 TranslationStore 相同"""
+
+    def __init__(self, keys, columns):
+        self.keys = keys
+        self.index = {sys.intern(k): i for i, k in enumerate(keys)}
+        self.languages = list(columns)
+        self._data = columns
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, key, lang, default=""):
+        return self._data.get(lang, {}).get(key) or default
+
+    def column(self, lang):
+        return dict(self._data.get(lang, {}))
+
+def load_translations():
+    global _TRANSLATIONS
+    record_cache("translations", bool(_TRANSLATIONS))
+    if _TRANSLATIONS: return _TRANSLATIONS
+
+    sources = _translation_sources()
+    cache_root = os.path.join(CACHE_DIR, "translations")
+    cache_dir = os.path.join(cache_root, _translation_digest(sources))
+    index_path = os.path.join(cache_dir, "index.json")
+
+    if not os.path.exists(index_path):
+        with trace_span("parse_translations"):
+            keys, columns = _parse_translation_sources(sources)
+        try:
+            os.makedirs(cache_root, exist_ok=True)
+            # 源文件变了，旧的缓存就没用了
+            for old in os.listdir(cache_root):
+                if old != os.path.basename(cache_dir):
+                    import shutil
+                    shutil.rmtree(os.path.join(cache_root, old), ignore_errors=True)
+            _write_translation_cache(cache_dir, keys, columns)
+            print(f"[Translations] Cached {len(keys)} keys x {len(columns)} languages")
+        except OSError as e:
+            print(f"[Translations] Could not write cache: {e}")
+            # 缓存目录不可写时退回纯内存
+            store = _MemoryTranslationStore(keys, columns)
+            _TRANSLATIONS = store
+            return store
+
+    with open(index_path, "r", encoding="utf-8") as f:
+        index = json.load(f)
+    store = TranslationStore(cache_dir, index["keys"], index["languages"])
+    _TRANSLATIONS = store
+    return store
 
 def load_spell_mapping():
     mapping_path = os.path.join(BASE_DIR, "spell_mapping.md")
@@ -197,17 +892,37 @@ def load_spell_mapping():
         print(f"Error loading spell mapping: {e}")
     return mapping
 
+def _spell_db_digest(actions_file):
+    """本地法术库的来源摘要: gun_actions.lua、翻译表与别名表，以及是否生成拼音"""
+    import hashlib
+    h = hashlib.sha1(f"{_translation_digest(_translation_sources())}:{HAS_PYPINYIN}".encode())
+    with open(actions_file, "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()[:20]
+
+@traced("load_spell_db")
 def load_spell_database():
     global _SPELL_CACHE
+    record_cache("spell_database", bool(_SPELL_CACHE))
     if _SPELL_CACHE: return _SPELL_CACHE
     
-    trans = load_translations()
-    mapping = load_spell_mapping()
     actions_file = os.path.join(EXTRACTED_DATA_ROOT, "data/scripts/gun/gun_actions.lua")
     if not os.path.exists(actions_file):
         print(f"Warning: gun_actions.lua not found at {actions_file}")
         return {}
 
+    # 其它 worker (或上一次运行) 已经用同样的源文件解析过：直接使用共享库里的结果
+    digest = _spell_db_digest(actions_file)
+    shared = shared_state.get("spell_database")
+    record_cache("shared_spell_database", bool(shared and shared.get("digest") == digest))
+    if shared and shared.get("digest") == digest:
+        _SPELL_CACHE = shared["db"]
+        print(f"Loaded {len(_SPELL_CACHE)} spells from the shared cache")
+        return _SPELL_CACHE
+
+    trans = load_translations()
+    mapping = load_spell_mapping()
+
     try:
         with open(actions_file, "r", encoding="utf-8", errors="ignore") as f:
             content = f.read()
@@ -238,6 +953,10 @@ def load_spell_database():
             sprite_match = re.search(r'sprite\s*=\s*"([^"]+)"', block)
             type_match = re.search(r'type\s*=\s*([A-Z0-9_]+)', block)
             uses_match = re.search(r'max_uses\s*=\s*(-?\d+)', block)
+            mana_match = re.search(r'^\s*mana\s*=\s*(-?\d+)', block, re.MULTILINE)
+            # action 里对 c.fire_rate_wait / current_reload_time 的增量 (与 wand_sync 同步的口径一致)
+            delay_match = re.search(r'c\.fire_rate_wait\s*=\s*c\.fire_rate_wait\s*([-+])\s*(\d+(?:\.\d+)?)', block)
+            reload_match = re.search(r'current_reload_time\s*=\s*current_reload_time\s*([-+])\s*(\d+(?:\.\d+)?)', block)
             
             if id_match and sprite_match:
                 spell_id = id_match.group(1)
@@ -250,8 +969,8 @@ def load_spell_database():
                 if raw_name.startswith("$"):
                     trans_key = raw_name.lstrip("$")
                     if trans_key in trans:
-                        en_name = trans[trans_key]["en"] or raw_name
-                        zh_name = trans[trans_key]["zh"] or raw_name
+                        en_name = trans.get(trans_key, "en", raw_name)
+                        zh_name = trans.get(trans_key, "zh", raw_name)
                 
                 py_full, py_init = get_pinyin_data(zh_name)
                 
@@ -281,9 +1000,14 @@ def load_spell_database():
                     "alias_pinyin": alias_py,
                     "alias_initials": alias_init,
                     "type": TYPE_MAP.get(type_str, 0),
-                    "max_uses": int(uses_match.group(1)) if uses_match else None
+                    "max_uses": int(uses_match.group(1)) if uses_match else None,
+                    "mana": int(mana_match.group(1)) if mana_match else 0,
+                    "fire_rate_wait": float(delay_match.group(1) + delay_match.group(2)) if delay_match else 0,
+                    "reload_time": float(reload_match.group(1) + reload_match.group(2)) if reload_match else 0,
+                    "name_key": raw_name.lstrip("$") if raw_name.startswith("$") else None
                 }
         _SPELL_CACHE = db
+        shared_state.put("spell_database", {"digest": digest, "db": db})
         print(f"Loaded {len(db)} clean spells with translations")
         return db
     except Exception as e:
@@ -292,6 +1016,7 @@ def load_spell_database():
 
 def get_game_root():
     global _GAME_ROOT
+    record_cache("game_root", bool(_GAME_ROOT))
     if _GAME_ROOT: return _GAME_ROOT
     
     try:
@@ -311,10 +1036,33 @@ def get_game_root():
                 break
     return _GAME_ROOT
 
-def talk_to_game(cmd):
+def bridge_command_label(cmd):
+    """指标用的命令名：JSON 负载统一记为 WAND_PUSH，避免标签基数爆炸"""
+    if isinstance(cmd, bytes):
+        cmd = cmd[:64].decode("utf-8", "ignore")
+    cmd = cmd.strip()
+    if cmd.startswith("{") or cmd.startswith("["):
+        return "WAND_PUSH"
+    name = cmd.split(":", 1)[0].split(" ", 1)[0]
+    return name if re.fullmatch(r"[A-Z_]{1,40}", name) else "OTHER"
+
+def talk_to_game(cmd, timeout=2):
+    label = bridge_command_label(cmd)
+    start = time.perf_counter()
+    resp = _talk_to_game(cmd, timeout)
+    elapsed = time.perf_counter() - start
+    metrics.observe("twwe_bridge_rtt_seconds", elapsed, command=label)
+    trace_add(f"bridge_{label}", elapsed)
+    if resp is None:
+        metrics.inc("twwe_bridge_failures_total", command=label)
+    else:
+        metrics.observe("twwe_bridge_response_bytes", len(resp), command=label)
+    return resp
+
+def _talk_to_game(cmd, timeout=2):
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.settimeout(2) # 降低超时时间，避免未连接时阻塞前端
+            sock.settimeout(timeout) # 默认 2s，避免未连接时阻塞前端
             sock.connect((GAME_HOST, GAME_PORT))
             sock.sendall(cmd if isinstance(cmd, bytes) else (cmd + "\n").encode("utf-8"))
             
@@ -334,6 +1082,10 @@ def talk_to_game(cmd):
 
 @app.route("/api/status")
 def status():
+    # 后台监视线程在运行时直接用它的连接状态，不再为每次轮询单独 PING 一次游戏
+    cached = game_watcher.cached_status()
+    if cached is not None:
+        return jsonify(cached)
     # Check if we can actually talk to the game right now
     test_res = talk_to_game("PING")
     is_live = test_res is not None
@@ -342,11 +1094,217 @@ def status():
         "game_root": get_game_root()
     })
 
+# ==== 游戏状态推送 (SSE) ====
+# 前端不再每秒轮询 /api/status 与 /api/pull：整个后端只有一个监视线程与游戏保持一条长连接 ("WATCH\n")，
+# 模组每 2 秒发一次心跳，快捷栏魔杖变化时推送 {"type":"wands"}，连接建立时推送 {"type":"mods"}。
+# 监视线程把这些整理成 status / wands / mods / snapshot 事件 (内容没变的不重复发)，由 /api/events 以 SSE 推给所有页面。
+# 旧版 wand_sync 不认识 WATCH (回复 OK)，这时退回由监视线程统一轮询，页面数量再多也只有一份轮询。
+# 没有订阅者一段时间后线程断开连接并退出，下一个订阅者到来时重新启动。
+WATCH_RETRY_SEC = 3
+WATCH_HEARTBEAT_TIMEOUT = 6
+WATCH_LEGACY_POLL_SEC = float(os.environ.get("TWWE_WATCH_POLL", "2"))
+WATCH_IDLE_STOP_SEC = 10
+SSE_KEEPALIVE_SEC = 15
+
+class GameWatcher:
+    def __init__(self, backlog=256):
+        self.lock = Lock()
+        self.cond = Condition(self.lock)
+        self.events = deque(maxlen=backlog)   # (seq, type, payload)
+        self.state = {}                       # 每种事件的最新内容，新订阅者先收到这一份
+        self.seq = 0
+        self.subscribers = 0
+        self.mode = None                      # "watch" / "poll"，未连接时为 None
+        self.thread = None
+        self._idle_since = None
+
+    def publish(self, kind, payload):
+        """发布一条事件；与该类型上一次内容相同时忽略"""
+        with self.cond:
+            if self.state.get(kind) == payload:
+                return False
+            self.state[kind] = payload
+            self.seq += 1
+            self.events.append((self.seq, kind, payload))
+            self.cond.notify_all()
+        metrics.inc("twwe_game_events_total", type=kind)
+        return True
+
+    def forget(self, kind):
+        with self.lock:
+            self.state.pop(kind, None)
+
+    def subscribe(self):
+        with self.lock:
+            self.subscribers += 1
+            if self.thread is None:
+                self.thread = Thread(target=self._run, daemon=True, name="game-watcher")
+                self.thread.start()
+
+    def unsubscribe(self):
+        with self.lock:
+            self.subscribers = max(0, self.subscribers - 1)
+
+    def current(self):
+        with self.lock:
+            return self.seq, dict(self.state)
+
+    def cached_status(self):
+        with self.lock:
+            if self.thread is None:
+                return None
+            return self.state.get("status")
+
+    def wait(self, after, timeout):
+        """等待 seq > after 的事件，返回 (新的 seq, 事件列表)；订阅者落后太多 (事件已被挤出队列) 时改发完整状态"""
+        with self.cond:
+            if self.seq <= after:
+                self.cond.wait(timeout)
+            if self.seq <= after:
+                return after, []
+            if self.events[0][0] > after + 1:
+                return self.seq, [(self.seq, kind, payload) for kind, payload in self.state.items()]
+            return self.seq, [e for e in self.events if e[0] > after]
+
+    def _should_stop(self):
+        """没有订阅者持续 WATCH_IDLE_STOP_SEC 后停止；返回 True 时线程已登记为退出"""
+        with self.lock:
+            if self.subscribers > 0:
+                self._idle_since = None
+                return False
+            now = time.monotonic()
+            if self._idle_since is None:
+                self._idle_since = now
+            if now - self._idle_since < WATCH_IDLE_STOP_SEC:
+                return False
+            self.thread = None
+            self.mode = None
+            self._idle_since = None
+            # 连接相关的状态在下次启动时重新获取
+            self.state.pop("status", None)
+            self.state.pop("wands", None)
+            return True
+
+    def _run(self):
+        print("[Watch] Game watcher started")
+        while True:
+            try:
+                # 正常返回说明已经没有订阅者
+                self._watch()
+                break
+            except Exception as e:
+                if self.mode is not None:
+                    print(f"[Watch] Lost game connection: {e}")
+            self.mode = None
+            self.forget("wands")
+            self.publish("status", {"connected": False, "game_root": _GAME_ROOT})
+            time.sleep(WATCH_RETRY_SEC)
+            if self._should_stop():
+                break
+        print("[Watch] No subscribers, game watcher stopped")
+
+    def _connected(self, mode):
+        if self.mode != mode:
+            print(f"[Watch] Connected to game ({mode})")
+        self.mode = mode
+        self.publish("status", {"connected": True, "game_root": get_game_root()})
+
+    def _watch(self):
+        with socket.create_connection((GAME_HOST, GAME_PORT), timeout=2) as sock:
+            sock.sendall(b"WATCH\n")
+            sock.settimeout(WATCH_HEARTBEAT_TIMEOUT)
+            reader = sock.makefile("rb")
+            first = reader.readline()
+            if not first:
+                raise ConnectionError("closed by game")
+            if first.strip() != b"WATCHING":
+                # 旧版模组把 WATCH 当作普通数据并回复 OK
+                sock.close()
+                return self._poll()
+            self._connected("watch")
+            while not self._should_stop():
+                # 心跳间隔 2 秒，超过 WATCH_HEARTBEAT_TIMEOUT 没有任何数据即视为断开 (socket.timeout)
+                line = reader.readline()
+                if not line:
+                    raise ConnectionError("closed by game")
+                self._handle_line(line)
+
+    def _handle_line(self, line):
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return
+        kind = event.get("type") if isinstance(event, dict) else None
+        if kind == "wands":
+            # 空表在 Lua 端会序列化成 {}
+            self.publish("wands", {"wands": event.get("wands") or {}})
+        elif kind == "mods":
+            mods = event.get("active_mods")
+            self.publish("mods", {"active_mods": mods if isinstance(mods, list) else []})
+
+    def _poll(self):
+        res = talk_to_game("GET_ACTIVE_MODS")
+        if res is None:
+            raise ConnectionError("no response to GET_ACTIVE_MODS")
+        self._connected("poll")
+        try:
+            mods = json.loads(res)
+            self.publish("mods", {"active_mods": mods if isinstance(mods, list) else []})
+        except ValueError:
+            pass
+        while not self._should_stop():
+            res = talk_to_game("GET_ALL_WANDS")
+            if res is None:
+                raise ConnectionError("no response to GET_ALL_WANDS")
+            try:
+                self.publish("wands", {"wands": json.loads(res) or {}})
+            except ValueError:
+                pass
+            time.sleep(WATCH_LEGACY_POLL_SEC)
+
+game_watcher = GameWatcher()
+
+def _publish_snapshot_event(snapshot):
+    game_watcher.publish("snapshot", {"version": snapshot.version, "mod_spells": len(snapshot.mod_spells),
+                                      "active_mods": list(snapshot.active_mods)})
+
+on_snapshot(_publish_snapshot_event)
+
+def _sse(seq, kind, payload):
+    return f"id: {seq}\nevent: {kind}\ndata: {json.dumps(payload, ensure_ascii=False, separators=(',', ':'))}\n\n"
+
+@app.route("/api/events")
+def game_events():
+    def generate():
+        game_watcher.subscribe()
+        try:
+            seq, state = game_watcher.current()
+            yield f"retry: {int(WATCH_RETRY_SEC * 1000)}\n\n"
+            # 先发完整的当前状态，页面不需要再单独请求 /api/status 与 /api/pull
+            for kind, payload in state.items():
+                yield _sse(seq, kind, payload)
+            while True:
+                # 其它 worker 同步的模组状态也要以 snapshot 事件推出去
+                shared_state.refresh()
+                seq, events = game_watcher.wait(seq, SSE_KEEPALIVE_SEC)
+                if not events:
+                    yield ": keepalive\n\n"
+                for event_seq, kind, payload in events:
+                    yield _sse(event_seq, kind, payload)
+        finally:
+            game_watcher.unsubscribe()
+
+    response = app.response_class(generate(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
 def get_noita_save_path():
     if sys.platform == "win32":
         return os.path.join(os.environ["USERPROFILE"], "AppData/LocalLow/Nolla_Games_Noita/save00").replace("\\", "/")
     return None
 
+@traced("read_mod_config")
 def read_noita_mod_settings():
     save_path = get_noita_save_path()
     if not save_path: return {}
@@ -370,6 +1328,7 @@ def read_noita_mod_settings():
         print(f"Error reading mod_config.xml: {e}")
         return {}
 
+@traced("lua_helper")
 def run_lua_helper(mode, data_string):
     import tempfile
     with tempfile.NamedTemporaryFile(mode='w', delete=False, encoding='utf-8', suffix='.txt') as tmp:
@@ -378,14 +1337,19 @@ def run_lua_helper(mode, data_string):
     
     try:
         helper_path = os.path.join(os.path.dirname(__file__), "import_helper.lua")
-        result = subprocess.run([LUAJIT_PATH, helper_path, mode, tmp_path], capture_output=True, text=True, encoding="utf-8")
+        proc = eval_supervisor.spawn(
+            [LUAJIT_PATH, helper_path, mode, tmp_path],
+            timeout=EVAL_TIMEOUT_SEC if EVAL_TIMEOUT_SEC > 0 else None,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding="utf-8"
+        )
+        stdout, stderr = proc.communicate()
         if os.path.exists(tmp_path): os.unlink(tmp_path)
         
-        if result.returncode != 0:
-            print(f"Lua error: {result.stderr}")
+        if proc.returncode != 0:
+            print(f"Lua error: {stderr}")
             return None
         
-        return json.loads(result.stdout)
+        return json.loads(stdout)
     except Exception as e:
         if os.path.exists(tmp_path): os.unlink(tmp_path)
         print(f"Error running lua helper: {e}")
@@ -489,7 +1453,7 @@ def import_wand_editor():
                 }
                 wands.append(new_wand)
         
-        return jsonify({"success": True, "wands": wands, "folders": folders})
+        return import_response(wands, folders)
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -592,24 +1556,389 @@ def import_spell_lab():
             }
             wands.append(new_wand)
             
-        return jsonify({"success": True, "wands": wands, "folders": folders})
+        return import_response(wands, folders)
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
 
 
+# ==== 魔杖库 (SQLite) ====
+# 大型魔杖库放在后端，按文件夹 / 标签 / 名称拼音 / 包含的法术建立索引，前端按页查询。
+if getattr(sys, 'frozen', False):
+    _DEFAULT_LIBRARY_DB = os.path.join(os.path.dirname(sys.executable), "twwe_library.db")
+else:
+    _DEFAULT_LIBRARY_DB = os.path.join(BASE_DIR, "twwe_library.db")
+LIBRARY_DB_PATH = os.environ.get("TWWE_LIBRARY_DB", _DEFAULT_LIBRARY_DB)
+LIBRARY_MAX_PAGE_SIZE = 500
+
+_LIBRARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    parent_id TEXT,
+    ord INTEGER NOT NULL DEFAULT 0,
+    is_open INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_folders_parent ON folders(parent_id, ord);
+
+CREATE TABLE IF NOT EXISTS wands (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL DEFAULT '' COLLATE NOCASE,
+    pinyin TEXT NOT NULL DEFAULT '' COLLATE NOCASE,
+    pinyin_initials TEXT NOT NULL DEFAULT '' COLLATE NOCASE,
+    folder_id TEXT,
+    ord INTEGER NOT NULL DEFAULT 0,
+    created_at INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_wands_folder ON wands(folder_id, ord);
+CREATE INDEX IF NOT EXISTS idx_wands_name ON wands(name);
+CREATE INDEX IF NOT EXISTS idx_wands_pinyin ON wands(pinyin);
+CREATE INDEX IF NOT EXISTS idx_wands_initials ON wands(pinyin_initials);
+CREATE INDEX IF NOT EXISTS idx_wands_created ON wands(created_at);
+
+CREATE TABLE IF NOT EXISTS wand_tags (
+    wand_id TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (wand_id, tag)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_wand_tags_tag ON wand_tags(tag, wand_id);
+
+CREATE TABLE IF NOT EXISTS wand_spells (
+    wand_id TEXT NOT NULL,
+    spell_id TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (wand_id, spell_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_wand_spells_spell ON wand_spells(spell_id, wand_id);
+"""
+
+class WandLibrary:
+    """每个线程一个 sqlite3 连接 (WAL 模式，读写可以并发)"""
+
+    SORTS = {
+        "order": "w.folder_id, w.ord, w.created_at",
+        "name": "w.name, w.created_at",
+        "created": "w.created_at DESC",
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self._local = local()
+        self._init_lock = Lock()
+        self._initialized = False
+        self._fts = False
+
+    def _init_name_index(self, conn):
+        """
+        名称子串搜索用的 FTS5 trigram 索引 (wands_name_fts，rowid 与 wands 相同)。
+        SQLite 太旧 (< 3.34) 不支持 trigram 时不建索引，搜索退回逐行 LIKE。
+        """
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'wands_name_fts'").fetchone()
+        if not exists:
+            try:
+                with conn:
+                    conn.execute("CREATE VIRTUAL TABLE wands_name_fts USING fts5(name, tokenize='trigram')")
+                    conn.execute("INSERT INTO wands_name_fts (rowid, name) SELECT rowid, name FROM wands")
+            except sqlite3.OperationalError as e:
+                print(f"[Library] Name search index unavailable, falling back to LIKE: {e}")
+                return False
+        return True
+
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=OFF")
+            with self._init_lock:
+                if not self._initialized:
+                    conn.executescript(_LIBRARY_SCHEMA)
+                    self._fts = self._init_name_index(conn)
+                    self._initialized = True
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _spell_counts(wand):
+        counts = {}
+        for spell_id in list((wand.get("spells") or {}).values()) + list(wand.get("always_cast") or []):
+            if isinstance(spell_id, str) and spell_id:
+                counts[spell_id] = counts.get(spell_id, 0) + 1
+        return counts
+
+    @staticmethod
+    def _int_field(item, key):
+        value = item.get(key) or 0
+        if isinstance(value, bool):
+            raise ValueError(f"{key} must be an integer")
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{key} must be an integer, got {value!r}")
+
+    @classmethod
+    def check(cls, wands=(), folders=()):
+        """写入前校验客户端数据，不合法时抛出 ValueError (写入是一个事务，不能写到一半才失败)"""
+        for kind, items in (("wand", wands), ("folder", folders)):
+            for item in items:
+                if not isinstance(item, dict) or not isinstance(item.get("id"), str) or not item["id"]:
+                    raise ValueError(f"Each {kind} needs a non-empty string id")
+                for key in ("name", "folderId", "parentId", "pinyin", "pinyin_initials"):
+                    if item.get(key) is not None and not isinstance(item[key], str):
+                        raise ValueError(f"{kind} {item['id']}: {key} must be a string")
+                for key in ("order", "createdAt"):
+                    cls._int_field(item, key)
+        for wand in wands:
+            if not isinstance(wand.get("spells") or {}, dict):
+                raise ValueError(f"wand {wand['id']}: spells must be an object")
+            for key in ("always_cast", "tags"):
+                if not isinstance(wand.get(key) or [], list):
+                    raise ValueError(f"wand {wand['id']}: {key} must be a list")
+
+    def upsert(self, wands=(), folders=()):
+        self.check(wands, folders)
+        conn = self.conn()
+        with conn:
+            for folder in folders:
+                conn.execute(
+                    "INSERT OR REPLACE INTO folders (id, name, parent_id, ord, is_open) VALUES (?, ?, ?, ?, ?)",
+                    (folder["id"], folder.get("name") or "", folder.get("parentId"), self._int_field(folder, "order"),
+                     1 if folder.get("isOpen") else 0))
+            for wand in wands:
+                wand_id = wand["id"]
+                name = wand.get("name") or ""
+                py_full, py_init = wand.get("pinyin"), wand.get("pinyin_initials")
+                if py_full is None or py_init is None:
+                    py_full, py_init = get_pinyin_data(name)
+                if self._fts:
+                    # REPLACE 会换一个新的 rowid，名称索引跟着删旧插新
+                    conn.execute("DELETE FROM wands_name_fts WHERE rowid IN (SELECT rowid FROM wands WHERE id = ?)", (wand_id,))
+                cur = conn.execute(
+                    "INSERT OR REPLACE INTO wands (id, name, pinyin, pinyin_initials, folder_id, ord, created_at, data) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (wand_id, name, py_full or "", py_init or "", wand.get("folderId"), self._int_field(wand, "order"),
+                     self._int_field(wand, "createdAt"), json.dumps(wand, ensure_ascii=False)))
+                if self._fts:
+                    conn.execute("INSERT INTO wands_name_fts (rowid, name) VALUES (?, ?)", (cur.lastrowid, name))
+                conn.execute("DELETE FROM wand_tags WHERE wand_id = ?", (wand_id,))
+                conn.executemany("INSERT OR IGNORE INTO wand_tags (wand_id, tag) VALUES (?, ?)",
+                                 [(wand_id, tag) for tag in wand.get("tags") or [] if isinstance(tag, str)])
+                conn.execute("DELETE FROM wand_spells WHERE wand_id = ?", (wand_id,))
+                conn.executemany("INSERT INTO wand_spells (wand_id, spell_id, count) VALUES (?, ?, ?)",
+                                 [(wand_id, sid, n) for sid, n in self._spell_counts(wand).items()])
+        return len(wands), len(folders)
+
+    def delete_wand(self, wand_id):
+        conn = self.conn()
+        with conn:
+            if self._fts:
+                conn.execute("DELETE FROM wands_name_fts WHERE rowid IN (SELECT rowid FROM wands WHERE id = ?)", (wand_id,))
+            cur = conn.execute("DELETE FROM wands WHERE id = ?", (wand_id,))
+            conn.execute("DELETE FROM wand_tags WHERE wand_id = ?", (wand_id,))
+            conn.execute("DELETE FROM wand_spells WHERE wand_id = ?", (wand_id,))
+        return cur.rowcount > 0
+
+    def get_wand(self, wand_id):
+        row = self.conn().execute("SELECT data FROM wands WHERE id = ?", (wand_id,)).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    def folders(self):
+        rows = self.conn().execute(
+            "SELECT f.id, f.name, f.parent_id, f.ord, f.is_open, "
+            "(SELECT COUNT(*) FROM wands w WHERE w.folder_id = f.id) AS wand_count "
+            "FROM folders f ORDER BY f.parent_id, f.ord").fetchall()
+        return [{"id": r["id"], "name": r["name"], "parentId": r["parent_id"], "order": r["ord"],
+                 "isOpen": bool(r["is_open"]), "wandCount": r["wand_count"]} for r in rows]
+
+    def query(self, folder=None, recursive=False, spells=(), tags=(), text=None, sort="order", page=1, page_size=50):
+        """
+        spells / tags 为“全部包含”语义；text 匹配名称子串 (与前端仓库搜索一致) 或拼音 / 首字母前缀。
+        名称子串走 trigram 索引 (至少 3 个字符)，拼音 / 首字母是 NOCASE 索引上的前缀范围查找，
+        三者合并为 MULTI-INDEX OR；更短的查询或没有 trigram 索引时名称退回逐行 LIKE。
+        返回 (total, [wand dict])
+        """
+        conn = self.conn()
+        where = []
+        params = []
+        ctes = []
+        if folder is not None:
+            if recursive:
+                ctes.append("sub(id) AS (SELECT ? UNION ALL SELECT f.id FROM folders f JOIN sub ON f.parent_id = sub.id)")
+                params.append(folder)
+                where.append("w.folder_id IN (SELECT id FROM sub)")
+            elif folder == "":
+                where.append("w.folder_id IS NULL")
+            else:
+                where.append("w.folder_id = ?")
+                params.append(folder)
+        spells = [sp for sp in dict.fromkeys(spells) if sp]
+        if spells:
+            where.append(
+                f"w.id IN (SELECT wand_id FROM wand_spells WHERE spell_id IN ({','.join('?' * len(spells))}) "
+                f"GROUP BY wand_id HAVING COUNT(*) = ?)")
+            params.extend(spells)
+            params.append(len(spells))
+        tags = [t for t in dict.fromkeys(tags) if t]
+        if tags:
+            where.append(
+                f"w.id IN (SELECT wand_id FROM wand_tags WHERE tag IN ({','.join('?' * len(tags))}) "
+                f"GROUP BY wand_id HAVING COUNT(*) = ?)")
+            params.extend(tags)
+            params.append(len(tags))
+        if text:
+            escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            if self._fts and len(text) >= 3 and escaped == text:
+                # trigram 索引不支持 ESCAPE，带通配符的查询走下面的逐行 LIKE
+                name_sql = "w.rowid IN (SELECT rowid FROM wands_name_fts WHERE name LIKE ?)"
+            else:
+                name_sql = "w.name LIKE ? ESCAPE '\\'"
+            where.append(f"({name_sql} OR w.pinyin LIKE ? ESCAPE '\\' OR w.pinyin_initials LIKE ? ESCAPE '\\')")
+            params.extend([f"%{escaped}%", f"{escaped}%", f"{escaped}%"])
+
+        with_sql = ("WITH RECURSIVE " + ", ".join(ctes) + " ") if ctes else ""
+        where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+        total = conn.execute(f"{with_sql}SELECT COUNT(*) FROM wands w {where_sql}", params).fetchone()[0]
+        order_sql = self.SORTS.get(sort, self.SORTS["order"])
+        rows = conn.execute(
+            f"{with_sql}SELECT w.data FROM wands w {where_sql} ORDER BY {order_sql} LIMIT ? OFFSET ?",
+            params + [page_size, (page - 1) * page_size]).fetchall()
+        return total, [json.loads(r["data"]) for r in rows]
+
+_wand_library = None
+_wand_library_lock = Lock()
+
+def get_wand_library():
+    global _wand_library
+    if _wand_library is None:
+        with _wand_library_lock:
+            if _wand_library is None:
+                _wand_library = WandLibrary(LIBRARY_DB_PATH)
+    return _wand_library
+
+def import_response(wands, folders):
+    """导入接口的统一返回；?store=1 时写入魔杖库，只返回摘要而不是整份魔杖数据"""
+    if request.args.get("store") in ("1", "true"):
+        with trace_span("library_store"):
+            stored, _ = get_wand_library().upsert(wands, folders)
+        return jsonify({"success": True, "stored": stored, "folders": folders})
+    return jsonify({"success": True, "wands": wands, "folders": folders})
+
+def _int_arg(name, default, minimum=1, maximum=None):
+    try:
+        val = int(request.args.get(name, default))
+    except (TypeError, ValueError):
+        val = default
+    val = max(minimum, val)
+    return min(val, maximum) if maximum else val
+
+@app.route("/api/library/wands", methods=["GET"])
+def query_library_wands():
+    """
+    GET /api/library/wands?folder=<id>&recursive=1&spell=LIGHT_BULLET&spell=DAMAGE&tag=x&q=火花&sort=name&page=1&page_size=50
+    folder 为空字符串表示未归档的魔杖
+    """
+    page = _int_arg("page", 1)
+    page_size = _int_arg("page_size", 50, maximum=LIBRARY_MAX_PAGE_SIZE)
+    spells = request.args.getlist("spell") + [s for s in request.args.get("spells", "").split(",") if s]
+    tags = request.args.getlist("tag")
+    total, wands = get_wand_library().query(
+        folder=request.args.get("folder"),
+        recursive=request.args.get("recursive") in ("1", "true"),
+        spells=spells,
+        tags=tags,
+        text=request.args.get("q", "").strip() or None,
+        sort=request.args.get("sort", "order"),
+        page=page,
+        page_size=page_size,
+    )
+    return jsonify({
+        "success": True, "total": total, "page": page, "page_size": page_size,
+        "pages": (total + page_size - 1) // page_size, "wands": wands
+    })
+
+@app.route("/api/library/wands", methods=["POST"])
+def upsert_library_wands():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"success": False, "error": "Expected a JSON object"}), 400
+    wands = body.get("wands") or []
+    folders = body.get("folders") or []
+    if not isinstance(wands, list) or not isinstance(folders, list):
+        return jsonify({"success": False, "error": "wands and folders must be lists"}), 400
+    if not wands and not folders:
+        return jsonify({"success": False, "error": "No wands or folders given"}), 400
+    try:
+        stored, stored_folders = get_wand_library().upsert(wands, folders)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    return jsonify({"success": True, "stored": stored, "folders": stored_folders})
+
+@app.route("/api/library/wands/<wand_id>", methods=["GET"])
+def get_library_wand(wand_id):
+    wand = get_wand_library().get_wand(wand_id)
+    if wand is None:
+        return jsonify({"success": False, "error": "Wand not found"}), 404
+    return jsonify({"success": True, "wand": wand})
+
+@app.route("/api/library/wands/<wand_id>", methods=["DELETE"])
+def delete_library_wand(wand_id):
+    if not get_wand_library().delete_wand(wand_id):
+        return jsonify({"success": False, "error": "Wand not found"}), 404
+    return jsonify({"success": True})
+
+@app.route("/api/library/folders")
+def list_library_folders():
+    return jsonify({"success": True, "folders": get_wand_library().folders()})
+
 @app.route("/api/fetch-spells")
 def fetch_spells():
-    db = load_spell_database().copy()
-    if _MOD_SPELL_CACHE:
-        db.update(_MOD_SPELL_CACHE)
-    if db:
+    snapshot = get_snapshot()
+    db = snapshot.spells
+    if not db:
+        return jsonify({"success": False, "error": "Local data not found"}), 404
+
+    # ?lang=ru 等：额外附带该语言的法术名 (lang_name)，只是查表，不会重新解析 CSV
+    lang = request.args.get("lang", "").strip().lower()
+    if lang:
+        trans = load_translations()
+        if lang not in trans.languages:
+            return jsonify({"success": False, "error": f"Unknown language: {lang}", "languages": trans.languages}), 400
+        db = {
+            spell_id: dict(entry, lang_name=trans.get(entry.get("name_key") or "", lang, entry.get("en_name") or entry.get("name")))
+            for spell_id, entry in db.items()
+        }
         return jsonify({"success": True, "spells": db})
-    return jsonify({"success": False, "error": "Local data not found"}), 404
+
+    # 同一个快照的响应体只序列化一次；ETag 取内容摘要 (各 worker 的快照版本号互不相同)
+    body, etag = snapshot.spells_json()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(b'{"success":true,"spells":' + body + b'}', mimetype="application/json")
+    response.headers["ETag"] = f'"{etag}"'
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-TWWE-Snapshot"] = str(snapshot.version)
+    return response
+
+@app.route("/api/translations")
+def list_translation_languages():
+    trans = load_translations()
+    return jsonify({"success": True, "languages": trans.languages, "count": len(trans)})
+
+@app.route("/api/translations/<lang>")
+def get_translation_column(lang):
+    trans = load_translations()
+    lang = lang.lower()
+    if lang not in trans.languages:
+        return jsonify({"success": False, "error": f"Unknown language: {lang}", "languages": trans.languages}), 404
+    return jsonify({"success": True, "language": lang, "translations": trans.column(lang)})
 
 @app.route("/api/sync-game-spells")
 def sync_game_spells():
-    global _MOD_SPELL_CACHE, _MOD_APPENDS_CACHE, _ACTIVE_MODS_CACHE
     res = talk_to_game("GET_ALL_SPELLS")
     if not res:
         return jsonify({"success": False, "error": "Could not connect to game"}), 503
@@ -618,18 +1947,20 @@ def sync_game_spells():
         if not res:
             return jsonify({"success": False, "error": "Game returned empty response"}), 500
         
-        data = json.loads(res)
+        with trace_span("parse"):
+            data = json.loads(res)
         # 兼容处理：Noita 有时直接返回法术列表，有时返回包含 spells/appends 的字典
         if isinstance(data, list):
             spells = data
-            _MOD_APPENDS_CACHE = {}
-            _ACTIVE_MODS_CACHE = []
+            appends = {}
+            active_mods = []
         else:
             spells = data.get("spells", [])
-            _MOD_APPENDS_CACHE = data.get("appends", {})
-            _ACTIVE_MODS_CACHE = data.get("active_mods", [])
+            appends = data.get("appends", {})
+            active_mods = data.get("active_mods", [])
         
         static_db = load_spell_database() 
+        t_build = time.perf_counter()
         mod_db = {}
         for s in spells:
             if not isinstance(s, dict): continue
@@ -666,34 +1997,401 @@ def sync_game_spells():
                 "reload_time": s.get("reload_time", 0),
                 "is_mod": True
             }
-        _MOD_SPELL_CACHE = mod_db
-        return jsonify({"success": True, "count": len(mod_db)})
+        # 模组法术、追加脚本与模组列表一起发布，其它线程不会看到只更新了一半的状态
+        snapshot = publish_snapshot(static_db=static_db or None, mod_spells=mod_db, appends=appends, active_mods=active_mods)
+        trace_add("build_spell_db", time.perf_counter() - t_build)
+        # 其它 worker 在下一个请求时载入同一份模组状态
+        with trace_span("shared_state"):
+            shared_state.put("mod_state", {"spells": mod_db, "appends": appends, "active_mods": active_mods})
+        return jsonify({"success": True, "count": len(mod_db), "snapshot": snapshot.version})
     except Exception as e:
         import traceback
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
 
-@app.route("/api/pull")
-def pull_game_wands():
-    res = talk_to_game("GET_ALL_WANDS")
-    if not res:
-        return jsonify({"success": False, "error": "Could not connect to game"}), 503
+# ==== 法杖静态汇总 (不运行 LuaJIT) ====
+# 按列存放每个法术的 mana / fire_rate_wait / reload_time / type，前端每次编辑时即时估算
+# 法力消耗、施法延迟、充能时间。忽略触发、抽取等运行时行为，完整结果仍以 wand_eval_tree 为准。
+SPELL_TYPE_MODIFIER = 2
+SPELL_TYPE_DRAW_MANY = 3
+SPELL_TYPE_PASSIVE = 7
+WAND_SUMMARY_MAX_BATCH = 20000
+WAND_SUMMARY_VECTOR_MIN = 32 # 少于这个数量的法杖不走 NumPy
+
+class SpellAttributeTable:
+    """法术属性列表；最后一行是全 0 的哨兵，未知法术 / 空槽位都指向它"""
+
+    COLUMNS = ("mana", "fire_rate_wait", "reload_time")
+
+    def __init__(self, db):
+        self.ids = list(db)
+        self.index = {spell_id: i for i, spell_id in enumerate(self.ids)}
+        self.sentinel = len(self.ids)
+        cols = {name: [] for name in self.COLUMNS}
+        terminal = []
+        for spell_id in self.ids:
+            entry = db[spell_id] if isinstance(db[spell_id], dict) else {}
+            for name in self.COLUMNS:
+                try:
+                    cols[name].append(float(entry.get(name) or 0))
+                except (TypeError, ValueError):
+                    cols[name].append(0.0)
+            # 修正、多重施法、被动法术不会单独结束一次施法
+            terminal.append(0.0 if entry.get("type", 0) in (SPELL_TYPE_MODIFIER, SPELL_TYPE_DRAW_MANY, SPELL_TYPE_PASSIVE) else 1.0)
+        cols["terminal"] = terminal
+        for name in cols:
+            cols[name].append(0.0)
+        # 少量法杖直接用 Python 列表求和更快，批量时用 NumPy 数组
+        self.columns = cols
+        self.arrays = {name: np.asarray(values, dtype=np.float64) for name, values in cols.items()} if HAS_NUMPY else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, spell_ids):
+        """返回 (下标列表, 未知法术列表)"""
+        index, sentinel = self.index, self.sentinel
+        rows = [index.get(spell_id, sentinel) for spell_id in spell_ids]
+        unknown = [spell_id for spell_id, row in zip(spell_ids, rows) if row == sentinel]
+        return rows, unknown
+
+_SPELL_TABLE = None  # (快照版本, SpellAttributeTable)
+_SPELL_TABLE_LOCK = Lock()
+
+def get_spell_table():
+    """合并本地法术库与游戏同步的法术库 (后者优先) 的属性表，快照版本变化时重建"""
+    global _SPELL_TABLE
+    snapshot = get_snapshot()
+    cached = _SPELL_TABLE
+    record_cache("spell_table", cached is not None and cached[0] == snapshot.version)
+    if cached is not None and cached[0] == snapshot.version:
+        return cached[1]
+    with _SPELL_TABLE_LOCK:
+        if _SPELL_TABLE is None or _SPELL_TABLE[0] != snapshot.version:
+            _SPELL_TABLE = (snapshot.version, SpellAttributeTable(snapshot.spells))
+        return _SPELL_TABLE[1]
+
+def _wand_spell_lists(wand):
+    spells = wand.get("spells") or {}
+    if isinstance(spells, dict):
+        slots = sorted((int(k), v) for k, v in spells.items() if str(k).isdigit())
+        deck = [v for _, v in slots if isinstance(v, str) and v]
+    else:
+        deck = [v for v in spells if isinstance(v, str) and v]
+    always = [v for v in wand.get("always_cast") or [] if isinstance(v, str) and v]
+    return deck, always
+
+def _wand_stat(wand, key, default=0.0):
     try:
-        return jsonify({"success": True, "wands": json.loads(res)})
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
+        return float(wand.get(key, default) or default)
+    except (TypeError, ValueError):
+        return default
 
-@app.route("/api/sync", methods=["POST"])
-def sync_wand():
-    data = request.get_json()
-    talk_to_game(json.dumps(data))
-    return jsonify({"success": True})
+def summarize_wands(wands, table):
+    """
+    批量估算法杖属性。每个法杖:
+      casts_per_cycle  = ceil(能结束施法的法术数 / actions_per_round)，至少 1
+      cast_delay       = 法杖延迟 + 始终施放延迟 + 卡组延迟 / casts
+      recharge_time    = 法杖充能 + 卡组充能增量 + 始终施放充能增量 * casts
+      cycle_frames     = (casts - 1) * cast_delay + max(cast_delay, recharge_time)
+      cycle_mana       = 卡组法力 + 始终施放法力 * casts
+    """
+    n = len(wands)
+    deck_rows, always_rows, unknown = [], [], []
+    for wand in wands:
+        deck, always = _wand_spell_lists(wand)
+        d_rows, d_unknown = table.lookup(deck)
+        a_rows, a_unknown = table.lookup(always)
+        deck_rows.append(d_rows)
+        always_rows.append(a_rows)
+        unknown.append(d_unknown + a_unknown)
+    stats = {
+        "fire_rate_wait": [_wand_stat(w, "fire_rate_wait") for w in wands],
+        "reload_time": [_wand_stat(w, "reload_time") for w in wands],
+        "actions_per_round": [max(1.0, _wand_stat(w, "actions_per_round", 1.0)) for w in wands],
+        "mana_charge_speed": [_wand_stat(w, "mana_charge_speed") for w in wands],
+    }
+    spell_count = [len(rows) for rows in deck_rows]
 
-@app.route("/api/icon/<path:icon_path>")
-def get_icon(icon_path):
-    icon_path = icon_path.lstrip("/")
-    
-    # 1. 优先从 vanilla 解压目录查找
+    if table.arrays is not None and n >= WAND_SUMMARY_VECTOR_MIN:
+        def gather(rows_list):
+            width = max([len(rows) for rows in rows_list] + [1])
+            matrix = np.full((n, width), table.sentinel, dtype=np.int32)
+            for i, rows in enumerate(rows_list):
+                matrix[i, :len(rows)] = rows
+            return {name: col[matrix].sum(axis=1) for name, col in table.arrays.items()}
+        deck = gather(deck_rows)
+        always = gather(always_rows)
+        st = {k: np.asarray(v, dtype=np.float64) for k, v in stats.items()}
+        casts = np.maximum(1.0, np.ceil(deck["terminal"] / st["actions_per_round"]))
+        cast_delay = st["fire_rate_wait"] + always["fire_rate_wait"] + deck["fire_rate_wait"] / casts
+        recharge = st["reload_time"] + deck["reload_time"] + always["reload_time"] * casts
+        cycle_frames = np.maximum(0.0, (casts - 1) * cast_delay) + np.maximum(0.0, np.maximum(cast_delay, recharge))
+        cycle_mana = deck["mana"] + always["mana"] * casts
+        mana_per_second = cycle_mana * 60.0 / np.maximum(1.0, cycle_frames)
+        columns = {
+            "casts_per_cycle": casts, "deck_mana": deck["mana"], "always_cast_mana": always["mana"],
+            "cycle_mana": cycle_mana, "mana_per_cast": cycle_mana / casts,
+            "cast_delay": cast_delay, "recharge_time": recharge, "cycle_frames": cycle_frames,
+            "mana_per_second": mana_per_second,
+            "mana_net_per_second": st["mana_charge_speed"] - mana_per_second,
+        }
+        columns = {k: np.round(v, 3).tolist() for k, v in columns.items()}
+    else:
+        cols = table.columns
+        columns = {k: [] for k in ("casts_per_cycle", "deck_mana", "always_cast_mana", "cycle_mana", "mana_per_cast",
+                                   "cast_delay", "recharge_time", "cycle_frames", "mana_per_second", "mana_net_per_second")}
+        for i in range(n):
+            deck = {name: sum((col[r] for r in deck_rows[i]), 0.0) for name, col in cols.items()}
+            always = {name: sum((col[r] for r in always_rows[i]), 0.0) for name, col in cols.items()}
+            casts = max(1.0, float(math.ceil(deck["terminal"] / stats["actions_per_round"][i])))
+            cast_delay = stats["fire_rate_wait"][i] + always["fire_rate_wait"] + deck["fire_rate_wait"] / casts
+            recharge = stats["reload_time"][i] + deck["reload_time"] + always["reload_time"] * casts
+            cycle_frames = max(0.0, (casts - 1) * cast_delay) + max(0.0, cast_delay, recharge)
+            cycle_mana = deck["mana"] + always["mana"] * casts
+            mana_per_second = cycle_mana * 60.0 / max(1.0, cycle_frames)
+            for k, v in (("casts_per_cycle", casts), ("deck_mana", deck["mana"]), ("always_cast_mana", always["mana"]),
+                         ("cycle_mana", cycle_mana), ("mana_per_cast", cycle_mana / casts),
+                         ("cast_delay", cast_delay), ("recharge_time", recharge), ("cycle_frames", cycle_frames),
+                         ("mana_per_second", mana_per_second),
+                         ("mana_net_per_second", stats["mana_charge_speed"][i] - mana_per_second)):
+                columns[k].append(round(v, 3))
+
+    summaries = []
+    for i in range(n):
+        summary = {k: v[i] for k, v in columns.items()}
+        summary["casts_per_cycle"] = int(summary["casts_per_cycle"])
+        summary["spell_count"] = spell_count[i]
+        summary["mana_sustainable"] = summary["mana_net_per_second"] >= 0
+        summary["unknown_spells"] = unknown[i]
+        summaries.append(summary)
+    return summaries
+
+@app.route("/api/wand-summary", methods=["POST"])
+def wand_summary():
+    """
+    单个: {"wand": {...}} 或直接传法杖对象；批量: {"wands": [{...}, ...]}
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"success": False, "error": "Expected a JSON object"}), 400
+    table = get_spell_table()
+    if not len(table):
+        return jsonify({"success": False, "error": "Spell database not loaded"}), 503
+
+    if "wands" in body:
+        wands = body["wands"]
+        if not isinstance(wands, list) or not all(isinstance(w, dict) for w in wands):
+            return jsonify({"success": False, "error": "wands must be a list of objects"}), 400
+        if len(wands) > WAND_SUMMARY_MAX_BATCH:
+            return jsonify({"success": False, "error": f"At most {WAND_SUMMARY_MAX_BATCH} wands per batch"}), 413
+        with trace_span("summarize"):
+            summaries = summarize_wands(wands, table)
+        return jsonify({"success": True, "count": len(summaries), "summaries": summaries})
+
+    wand = body.get("wand", body)
+    if not isinstance(wand, dict):
+        return jsonify({"success": False, "error": "wand must be an object"}), 400
+    with trace_span("summarize"):
+        summary = summarize_wands([wand], table)[0]
+    return jsonify({"success": True, "summary": summary})
+
+# ==== 增量拉取魔杖 ====
+# /api/pull?diff=1&known=1:<哈希>,2:<哈希> 只返回相对客户端已知状态新增/变化 (changed) 与移除 (removed) 的魔杖，
+# 连同每个槽位当前的哈希 (hashes)，客户端下次把它作为 known 发回来。
+# 新版 wand_sync 提供 GET_WAND_HASHES (各槽位魔杖的内容哈希) 与 GET_WANDS:<槽位,...>，只有哈希变了的魔杖才从游戏传过来；
+# 后端按槽位保存最近拉到的 (哈希, 魔杖)，别的页面已经拉过的内容不必再向游戏要一次。
+# 旧版模组对这两条命令回复 OK，这时退回 GET_ALL_WANDS 并在后端计算哈希，返回给客户端的仍然是增量。
+_PULLED_WANDS = {}          # 槽位 -> (哈希, 魔杖)
+_PULLED_WANDS_LOCK = Lock()
+_BRIDGE_WAND_HASHES = None  # 游戏端是否支持 GET_WAND_HASHES；未知时为 None
+
+def _parse_known_hashes(arg):
+    known = {}
+    for item in (arg or "").split(","):
+        slot, sep, digest = item.partition(":")
+        if sep and slot.strip() and digest.strip():
+            known[slot.strip()] = digest.strip()
+    return known
+
+def _wand_hash(wand):
+    import hashlib
+    body = json.dumps(wand, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha1(body).hexdigest()[:16]
+
+def _pull_hashes_from_bridge():
+    """返回 槽位 -> 哈希，游戏端不支持时返回 False，连接失败时返回 None"""
+    global _BRIDGE_WAND_HASHES
+    res = talk_to_game("GET_WAND_HASHES")
+    if res is None:
+        _BRIDGE_WAND_HASHES = None
+        return None
+    try:
+        hashes = json.loads(res)
+    except ValueError:
+        hashes = None
+    if not isinstance(hashes, dict):
+        print("[Pull] Game bridge has no GET_WAND_HASHES, falling back to full pulls")
+        _BRIDGE_WAND_HASHES = False
+        return False
+    _BRIDGE_WAND_HASHES = True
+    return {str(slot): str(digest) for slot, digest in hashes.items()}
+
+def pull_wand_diff(known):
+    """拉取游戏当前魔杖并与客户端已知的哈希比较，返回 (changed, removed, hashes)；连接失败时返回 None"""
+    global _BRIDGE_WAND_HASHES
+    hashes = _pull_hashes_from_bridge() if _BRIDGE_WAND_HASHES is not False else False
+    if hashes is None:
+        return None
+    if hashes is False:
+        res = talk_to_game("GET_ALL_WANDS")
+        if res is None:
+            # 游戏重启后可能换了新版模组，重新探测
+            _BRIDGE_WAND_HASHES = None
+            return None
+        wands = json.loads(res) or {}
+        hashes = {}
+        pulled = {}  # 本次要返回的 槽位 -> (哈希, 魔杖)
+        with _PULLED_WANDS_LOCK:
+            for slot, wand in wands.items():
+                hashes[slot] = _wand_hash(wand)
+                pulled[slot] = _PULLED_WANDS[slot] = (hashes[slot], wand)
+    else:
+        # 缓存里已有的魔杖在同一个锁区间内取出快照；之后其它请求可能改写或清理 _PULLED_WANDS，不再回头读它
+        pulled = {}
+        need = []
+        with _PULLED_WANDS_LOCK:
+            for slot, digest in hashes.items():
+                if known.get(slot) == digest:
+                    continue
+                cached = _PULLED_WANDS.get(slot)
+                if cached is not None and cached[0] == digest:
+                    pulled[slot] = cached
+                else:
+                    need.append(slot)
+        for slot in hashes:
+            if known.get(slot) != hashes[slot]:
+                record_cache("pulled_wands", slot not in need)
+        if need:
+            res = talk_to_game("GET_WANDS:" + ",".join(sorted(need)))
+            if res is None:
+                return None
+            fetched = json.loads(res) or {}
+            wands = fetched.get("wands") or {}
+            fetched_hashes = fetched.get("hashes") or {}
+            for slot in need:
+                # 两次请求之间魔杖可能又变了或被拿走，以实际拿到的为准
+                if slot in wands and slot in fetched_hashes:
+                    hashes[slot] = str(fetched_hashes[slot])
+                    pulled[slot] = (hashes[slot], wands[slot])
+                else:
+                    hashes.pop(slot, None)
+            with _PULLED_WANDS_LOCK:
+                for slot in need:
+                    if slot in pulled:
+                        _PULLED_WANDS[slot] = pulled[slot]
+    with _PULLED_WANDS_LOCK:
+        for slot in list(_PULLED_WANDS):
+            if slot not in hashes:
+                del _PULLED_WANDS[slot]
+    changed = {slot: wand for slot, (digest, wand) in pulled.items() if known.get(slot) != digest}
+    removed = sorted(slot for slot in known if slot not in hashes)
+    return changed, removed, hashes
+
+@app.route("/api/pull")
+def pull_game_wands():
+    if request.args.get("diff"):
+        try:
+            result = pull_wand_diff(_parse_known_hashes(request.args.get("known")))
+        except Exception as e:
+            return jsonify({"success": False, "error": str(e)}), 500
+        if result is None:
+            return jsonify({"success": False, "error": "Could not connect to game"}), 503
+        changed, removed, hashes = result
+        return jsonify({"success": True, "diff": True, "changed": changed, "removed": removed, "hashes": hashes})
+
+    res = talk_to_game("GET_ALL_WANDS")
+    if not res:
+        return jsonify({"success": False, "error": "Could not connect to game"}), 503
+    try:
+        return jsonify({"success": True, "wands": json.loads(res)})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route("/api/sync", methods=["POST"])
+def sync_wand():
+    data = request.get_json()
+    acks = push_wands_to_game([data])
+    if acks is None:
+        return jsonify({"success": False, "error": "Could not connect to game"}), 503
+    return jsonify({"success": bool(acks[0].get("ok")), "ack": acks[0]})
+
+# ==== 批量推送魔杖 ====
+# 多个魔杖放在一条分帧消息里发给游戏："SYNC_BATCH <n>\n" 后跟 n 行魔杖 JSON。
+# 游戏在同一帧里逐个应用，再回复一个确认数组 ([{"ok":true}, {"ok":false,"error":...}, ...])，整批只需一次往返。
+# 旧版 wand_sync 把首行当作普通数据并回复 OK，这时退回每个魔杖一条连接，确认只表示游戏收到了，不代表已经应用。
+SYNC_BATCH_MAX = int(os.environ.get("TWWE_SYNC_BATCH_MAX", "64"))
+# wand_sync 最多等主线程 5 秒再回复确认 (超时回复空数组)，后端要等得比它久，否则整批都会被当成连接失败。
+# 游戏暂停时主线程不运行：这批魔杖报告为未确认，但恢复后仍会被应用；wand_sync 按请求编号匹配回复，迟到的确认会被丢弃
+SYNC_BATCH_TIMEOUT_SEC = 8
+_BRIDGE_SYNC_BATCH = None  # 游戏端是否支持 SYNC_BATCH；未知时为 None
+
+def push_wands_to_game(wands):
+    """把若干魔杖 (带 slot 的 dict) 推给游戏，返回与之一一对应的确认；无法连接游戏时返回 None"""
+    global _BRIDGE_SYNC_BATCH
+    lines = [json.dumps(w, ensure_ascii=False, separators=(",", ":")) for w in wands]
+    if _BRIDGE_SYNC_BATCH is not False:
+        frame = f"SYNC_BATCH {len(lines)}\n" + "".join(line + "\n" for line in lines)
+        res = talk_to_game(frame.encode("utf-8"), timeout=SYNC_BATCH_TIMEOUT_SEC)
+        if res is None:
+            _BRIDGE_SYNC_BATCH = None
+            return None
+        if res != "OK":
+            _BRIDGE_SYNC_BATCH = True
+            try:
+                acks = json.loads(res)
+            except ValueError:
+                acks = None
+            if acks == {}:
+                acks = []   # Lua 的空表序列化为 {}
+            if not isinstance(acks, list):
+                return [{"ok": False, "error": "Invalid response from game"}] * len(lines)
+            acks = [a if isinstance(a, dict) else {"ok": False, "error": "Invalid acknowledgement"} for a in acks]
+            # 游戏没等到完整的帧，或主线程没有及时回复 (例如游戏暂停)，剩下的魔杖没有确认
+            acks += [{"ok": False, "error": "Not acknowledged (game may be paused)"}] * (len(lines) - len(acks))
+            return acks[:len(lines)]
+        print("[Sync] Game bridge has no SYNC_BATCH, pushing wands one by one")
+        _BRIDGE_SYNC_BATCH = False
+
+    acks = []
+    for line in lines:
+        res = talk_to_game(line)
+        if res is None and not acks:
+            _BRIDGE_SYNC_BATCH = None
+            return None
+        acks.append({"ok": True} if res == "OK" else {"ok": False, "error": "Could not connect to game"})
+    return acks
+
+@app.route("/api/sync/batch", methods=["POST"])
+def sync_wand_batch():
+    body = request.get_json(silent=True) or {}
+    wands = body.get("wands")
+    if not isinstance(wands, list) or not wands or not all(isinstance(w, dict) for w in wands):
+        return jsonify({"success": False, "error": "wands must be a non-empty list of objects"}), 400
+    if len(wands) > SYNC_BATCH_MAX:
+        return jsonify({"success": False, "error": f"At most {SYNC_BATCH_MAX} wands per batch"}), 400
+    acks = push_wands_to_game(wands)
+    if acks is None:
+        return jsonify({"success": False, "error": "Could not connect to game"}), 503
+    acks = [dict(ack, slot=w.get("slot")) for w, ack in zip(wands, acks)]
+    applied = sum(1 for ack in acks if ack.get("ok"))
+    return jsonify({"success": applied == len(acks), "applied": applied, "acks": acks})
+
+@app.route("/api/icon/<path:icon_path>")
+def get_icon(icon_path):
+    icon_path = icon_path.lstrip("/")
+    
+    # 1. 优先从 vanilla 解压目录查找
     local_path = os.path.join(EXTRACTED_DATA_ROOT, icon_path).replace("\\", "/")
     if os.path.exists(local_path):
         return send_file(local_path, max_age=31536000)
@@ -708,7 +2406,7 @@ def get_icon(icon_path):
             
         # 3. 模拟 Noita VFS：在所有活动 Mod 的文件夹下查找该路径
         # 例如 data/ui_gfx/... 实际上可能在 mods/deep_end/data/ui_gfx/...
-        for mod_id in _ACTIVE_MODS_CACHE:
+        for mod_id in get_snapshot().active_mods:
             mod_path = os.path.join(root, "mods", mod_id, icon_path).replace("\\", "/")
             if os.path.exists(mod_path):
                 return send_file(mod_path, max_age=31536000)
@@ -716,51 +2414,56 @@ def get_icon(icon_path):
     print(f"Icon not found in vanilla or any active mods: {icon_path}")
     return "Not Found", 404
 
-def parse_wiki_wand(text):
-    data = {}
-    # Improved regex parser for {{Wand2 ...}}
-    # Supports both piped parameters and multiline templates
-    def get_val(key, default=None):
-        # 匹配 |key = value (直到 next | or } or newline)
-        m = re.search(rf'\|\s*{key}\s*=\s*([^|\n}}]+)', text, re.IGNORECASE)
-        if m:
-            val = m.group(1).strip()
+# ==== Wiki 魔杖模板解析 ====
+# 所有正则预编译；每个模板只扫描一遍，把 |key = value 全部收集成字典再转换
+_WIKI_FIELD_RE = re.compile(r'\|\s*(\w+)\s*=\s*([^|\n}]+)')
+_WIKI_COMMENT_RE = re.compile(r'<!--.*?-->')
+_WIKI_LINK_RE = re.compile(r'\[\[([^|\]]+\|)?([^\]]+)\]\]')
+_WIKI_BRACES_RE = re.compile(r'\{\{|\}\}')
+_WIKI_WAND_OPEN_RE = re.compile(r'\{\{\s*Wand2\s*(?=[|}\n])', re.IGNORECASE)
+WIKI_BATCH_MAX_BYTES = 16 * 1024 * 1024
+
+def _wiki_fields(text):
+    """一次扫描取出所有 |key = value (key 小写，同名取第一次出现，与逐个 re.search 的结果一致)"""
+    fields = {}
+    for m in _WIKI_FIELD_RE.finditer(text):
+        key = m.group(1).lower()
+        if key not in fields:
             # 移除可能存在的 Wiki 注释
-            val = re.sub(r'<!--.*?-->', '', val).strip()
-            return val
-        return default
+            fields[key] = _WIKI_COMMENT_RE.sub('', m.group(2).strip()).strip()
+    return fields
 
+def _wand_from_wiki_fields(fields):
+    data = {}
+    get_val = fields.get
     try:
-        mana_max = get_val("manaMax")
+        mana_max = get_val("manamax")
         if mana_max: data["mana_max"] = float(mana_max)
-        
-        mana_charge = get_val("manaCharge")
+
+        mana_charge = get_val("manacharge")
         if mana_charge: data["mana_charge_speed"] = float(mana_charge)
-        
-        recharge = get_val("rechargeTime")
+
+        recharge = get_val("rechargetime")
         if recharge: data["reload_time"] = int(float(recharge) * 60)
-        
-        cast_delay = get_val("castDelay")
-        if cast_delay: data["cast_delay"] = int(float(cast_delay) * 60) # Some use cast_delay
-        if not cast_delay:
-             cast_delay = get_val("castDelay")
-        
+
         # 兼容不同命名
-        fire_rate = get_val("castDelay") or get_val("fireRate")
+        cast_delay = get_val("castdelay")
+        if cast_delay: data["cast_delay"] = int(float(cast_delay) * 60) # Some use cast_delay
+        fire_rate = cast_delay or get_val("firerate")
         if fire_rate: data["fire_rate_wait"] = int(float(fire_rate) * 60)
-        
+
         capacity = get_val("capacity")
         if capacity: data["deck_capacity"] = int(capacity)
 
-        spells_cast = get_val("spellsCast") or get_val("spellsPerCast")
+        spells_cast = get_val("spellscast") or get_val("spellspercast")
         if spells_cast: data["actions_per_round"] = int(spells_cast)
-        
+
         spread = get_val("spread")
         if spread: data["spread_degrees"] = float(spread)
-        
+
         speed = get_val("speed")
         if speed: data["speed_multiplier"] = float(speed)
-        
+
         shuffle = get_val("shuffle")
         if shuffle:
             data["shuffle_deck_when_empty"] = (shuffle.lower() == "yes" or shuffle == "1" or shuffle.lower() == "true")
@@ -768,59 +2471,556 @@ def parse_wiki_wand(text):
         spells = get_val("spells")
         if spells:
             # 移除 [[...]] 链接
-            spells = re.sub(r'\[\[([^|\]]+\|)?([^\]]+)\]\]', r'\2', spells)
+            spells = _WIKI_LINK_RE.sub(r'\2', spells)
             spells_list = [s.strip() for s in spells.split(',')]
             data["spells"] = {}
             for i, s in enumerate(spells_list):
                 if s: data["spells"][str(i+1)] = s
     except Exception as e:
         print(f"Error parsing wiki wand: {e}")
-            
+
     return data
 
+def parse_wiki_wand(text):
+    # Supports both piped parameters and multiline templates
+    return _wand_from_wiki_fields(_wiki_fields(text))
+
+def iter_wiki_wand_templates(text):
+    """
+    按 {{ / }} 配对扫描整页 wiki 源码，依次产出每个 {{Wand2 ...}} 模板的 (起始偏移, 模板文本)。
+    模板内部嵌套的其他模板 ({{Spell|...}} 等) 会原样保留在模板文本中。
+    """
+    stack = []
+    for m in _WIKI_BRACES_RE.finditer(text):
+        if m.group() == "{{":
+            stack.append(m.start())
+        elif stack:
+            start = stack.pop()
+            if _WIKI_WAND_OPEN_RE.match(text, start):
+                yield start, text[start:m.end()]
+
 @app.route("/api/parse-wiki", methods=["POST"])
 def parse_wiki():
     text = request.data.decode("utf-8")
     return jsonify({"success": True, "wand": parse_wiki_wand(text)})
 
+@app.route("/api/parse-wiki/batch", methods=["POST"])
+def parse_wiki_batch():
+    """
+    从整页 wiki 源码中提取所有 {{Wand2}} 模板。
+    请求体可以是原始文本，也可以是 JSON: {"text": "..."} 或 {"pages": ["...", "..."]}
+    """
+    if request.content_length and request.content_length > WIKI_BATCH_MAX_BYTES:
+        return jsonify({"success": False, "error": "Request too large"}), 413
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        pages = body.get("pages")
+        if not isinstance(pages, list):
+            pages = [body.get("text", "")]
+    else:
+        pages = [request.get_data(as_text=True)]
+
+    wands = []
+    for page_index, page in enumerate(pages):
+        if not isinstance(page, str):
+            continue
+        for offset, template in iter_wiki_wand_templates(page):
+            fields = _wiki_fields(template)
+            entry = {"page": page_index, "offset": offset, "wand": _wand_from_wiki_fields(fields)}
+            if fields.get("name"):
+                entry["name"] = fields["name"]
+            wands.append(entry)
+    return jsonify({"success": True, "count": len(wands), "wands": wands})
+
 @app.route("/api/sync-wiki", methods=["POST"])
 def sync_wiki():
     body = request.get_json()
     wand = parse_wiki_wand(body.get("wiki", ""))
     slot = body.get("slot", 1)
     wand["slot"] = slot
-    talk_to_game(json.dumps(wand))
-    return jsonify({"success": True, "parsed_wand": wand})
+    acks = push_wands_to_game([wand])
+    if acks is None:
+        return jsonify({"success": False, "error": "Could not connect to game", "parsed_wand": wand}), 503
+    return jsonify({"success": bool(acks[0].get("ok")), "parsed_wand": wand, "ack": acks[0]})
 
 # 已经由前面的逻辑定义，不要在这里重新定义
 # WAND_EVAL_DIR = os.path.join(os.getcwd(), "wand_eval_tree")
 
-@app.route("/api/evaluate", methods=["POST"])
-def evaluate_wand():
-    data = request.get_json()
-    
-    # 获取标识符，用于管理该插槽的进程
-    tab_id = data.get("tab_id", "default")
-    slot_id = data.get("slot_id", "1")
-    proc_key = f"{tab_id}-{slot_id}"
+def format_lua_arg(val):
+    """处理 wand_eval_tree 的负数参数解析 bug"""
+    try:
+        f_val = float(val)
+        if f_val < 0:
+            return f".{f_val}" # 转换为 .-12 格式
+        return str(val)
+    except:
+        return str(val)
 
-    # 提取参数，转换为评估工具需要的格式
-    spells_data = data.get("spells", [])
-    spell_uses = data.get("spell_uses", {}) # { "1": 5, "3": 0 }
-    
-    if not spells_data:
-        return jsonify({"success": False, "error": "No spells to evaluate"})
+def get_active_mods(snapshot=None):
+    """优先向游戏实时查询活动模组，失败时使用快照里上次同步的模组列表"""
+    active_mods = []
+    live_active_mods_res = talk_to_game("GET_ACTIVE_MODS")
+    if live_active_mods_res:
+        try:
+            active_mods = json.loads(live_active_mods_res)
+        except: pass
+    if not active_mods:
+        active_mods = list((snapshot or get_snapshot()).active_mods)
+    return active_mods
+
+SHUFFLE_MOCK_LUA = """-- 由 TWWE 生成：以 TWWE_SHUFFLE_SEED 为起始帧，按乱序魔杖配置 gun
+local _twwe_frame = tonumber(os.getenv("TWWE_SHUFFLE_SEED")) or 0
+local _ConfigGun_ReadToLua = ConfigGun_ReadToLua
+function ConfigGun_ReadToLua(actions_per_round, shuffle_deck_when_empty, ...)
+    return _ConfigGun_ReadToLua(actions_per_round, true, ...)
+end
+-- order_deck 用 GameGetFrameNum() 作种子，每次洗牌推进一帧，否则每次装填都会得到同样的顺序
+local _order_deck = order_deck
+function order_deck()
+    _twwe_frame = _twwe_frame + 1
+    return _order_deck()
+end
+function GameGetFrameNum() return _twwe_frame end
+"""
+
+def _write_if_changed(path, content):
+    """内容没变就不写磁盘，返回是否写入"""
+    try:
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            if f.read() == content:
+                return False
+    except OSError:
+        pass
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+    return True
+
+def shuffle_seed_of(data):
+    """乱序魔杖且请求指定了 shuffle_seed 时返回整数种子；否则返回 None (按非乱序评估，保持旧行为)"""
+    seed = data.get("shuffle_seed")
+    if not data.get("shuffle_deck_when_empty") or seed is None or isinstance(seed, bool):
+        return None
+    try:
+        return int(seed)
+    except (TypeError, ValueError):
+        return None
+
+def eval_env(data):
+    """评估子进程的环境变量，没有额外设置时返回 None (继承当前环境)"""
+    seed = shuffle_seed_of(data)
+    if seed is None:
+        return None
+    return dict(os.environ, TWWE_SHUFFLE_SEED=str(seed))
+
+# ==== 模组虚拟文件系统清单 ====
+# wand_eval_tree 每次 ModTextFileGetContent 都会依次在游戏目录 / 模拟器目录下的每个模组文件夹里 io.open 试探，
+# 模组越多，每次评估里的文件系统探测越多。这里在活动模组列表变化时把
+# 原版数据 + 活动模组 (按加载顺序，先找到的优先，与模拟器的查找顺序一致) 解析成一份 "VFS 路径 -> 实际文件" 清单，
+# 由 twwe_mock 在模拟器里用一次表查找完成解析，查不到的路径仍交给原来的逻辑。
+# 模组仍然以 -md 传给模拟器：追加脚本里 dofile 的 mods/<id>/...、清单之外的扩展名都要靠原来的查找。
+VFS_MANIFEST_ENABLED = os.environ.get("TWWE_VFS_MANIFEST", "1") != "0"
+VFS_MANIFEST_EXTS = (".lua", ".xml", ".csv", ".txt") # 模拟器只会以文本方式读取这些文件
+VFS_IGNORED_MOD_IDS = ("twwe_mock", "wand_sync", "appends", "spells", "active_mods")
 
-    # 构建命令
-    def format_lua_arg(val):
-        """处理 wand_eval_tree 的负数参数解析 bug"""
+VFS_MOCK_LUA = """-- 由 TWWE 生成：按 twwe_vfs.txt 清单解析 VFS 路径，每个路径只需一次表查找
+local files = {}
+local manifest = io.open("mods/twwe_mock/twwe_vfs.txt", "r")
+if manifest then
+    for line in manifest:lines() do
+        local tab = line:find("\\t", 1, true)
+        if tab then files[line:sub(1, tab - 1)] = line:sub(tab + 1) end
+    end
+    manifest:close()
+end
+local cache = {}
+-- 被 ModTextFileSetContent 改写过 (以及引擎预先放进 VFS 的) 文件交给原来的实现
+local overridden = { ["data/translations/common.csv"] = true }
+local _get, _set = ModTextFileGetContent, ModTextFileSetContent
+function ModTextFileSetContent(filename, content)
+    overridden[filename] = true
+    cache[filename] = nil
+    return _set(filename, content)
+end
+function ModTextFileGetContent(filename)
+    if not overridden[filename] then
+        local content = cache[filename]
+        if content then return content end
+        local path = files[filename]
+        if path then
+            local f = io.open(path, "r")
+            if f then
+                content = f:read("*a")
+                f:close()
+                cache[filename] = content
+                return content
+            end
+        end
+    end
+    return _get(filename)
+end
+"""
+
+_VFS_MANIFEST_KEY = None
+_VFS_MANIFEST = {}
+_VFS_MANIFEST_LOCK = Lock()
+
+def _vfs_files(root):
+    """root 下的所有文本文件: (相对路径 (正斜杠), 绝对路径 (正斜杠))"""
+    root = root.replace("\\", "/").rstrip("/")
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        rel_dir = dirpath.replace("\\", "/")[len(root) + 1:]
+        for name in sorted(filenames):
+            if name.lower().endswith(VFS_MANIFEST_EXTS):
+                rel = f"{rel_dir}/{name}" if rel_dir else name
+                yield rel, f"{root}/{rel}"
+
+def build_vfs_manifest(mods, game_root, data_root):
+    """按模拟器的查找顺序解析出 VFS 路径 -> 文件，先出现的优先"""
+    manifest = {}
+    local_mods = os.path.join(WAND_EVAL_DIR, "mods")
+    mod_roots = []
+    for mod in mods:
+        # 模组自己的文件以 mods/<id>/... 访问，游戏目录优先于模拟器目录
+        roots = [os.path.join(game_root, "mods", mod)] if game_root else []
+        roots.append(os.path.join(local_mods, mod))
+        for root in roots:
+            for rel, path in _vfs_files(root):
+                manifest.setdefault(f"mods/{mod}/{rel}", path)
+        mod_roots.extend(roots)
+    # 其它路径 (例如 data/scripts/gun/gun_actions.lua) 依次在每个模组目录下查找，最后才是原版数据
+    for root in mod_roots + [data_root]:
+        for rel, path in _vfs_files(root):
+            manifest.setdefault(rel, path)
+    return manifest
+
+def ensure_vfs_manifest(active_mods):
+    """
+    确保 twwe_vfs.txt 与当前的活动模组列表一致，返回是否可用。
+    模组列表、游戏目录或模组文件夹 (顶层) 修改时间变化时才重新扫描。
+    """
+    global _VFS_MANIFEST_KEY, _VFS_MANIFEST
+    if not VFS_MANIFEST_ENABLED:
+        return False
+    mods = [m for m in active_mods if isinstance(m, str) and m not in VFS_IGNORED_MOD_IDS]
+    game_root = get_game_root()
+    data_root = EXTRACTED_DATA_ROOT
+    if not os.path.isdir(data_root):
+        return False
+
+    def mtime(path):
         try:
-            f_val = float(val)
-            if f_val < 0:
-                return f".{f_val}" # 转换为 .-12 格式
-            return str(val)
-        except:
-            return str(val)
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+    dirs = [data_root]
+    for mod in mods:
+        if game_root:
+            dirs.append(os.path.join(game_root, "mods", mod))
+        dirs.append(os.path.join(WAND_EVAL_DIR, "mods", mod))
+    key = (tuple(mods), game_root, data_root, tuple(mtime(d) for d in dirs))
+
+    with _VFS_MANIFEST_LOCK:
+        hit = key == _VFS_MANIFEST_KEY
+        record_cache("vfs_manifest", hit)
+        if hit:
+            return True
+        t0 = time.perf_counter()
+        manifest = build_vfs_manifest(mods, game_root, data_root)
+        mock_mod_dir = os.path.join(WAND_EVAL_DIR, "mods", "twwe_mock")
+        os.makedirs(mock_mod_dir, exist_ok=True)
+        _write_if_changed(os.path.join(mock_mod_dir, "twwe_vfs.txt"),
+                          "".join(f"{vfs_path}\t{path}\n" for vfs_path, path in manifest.items()))
+        _write_if_changed(os.path.join(mock_mod_dir, "twwe_vfs.lua"), VFS_MOCK_LUA)
+        _VFS_MANIFEST_KEY = key
+        _VFS_MANIFEST = manifest
+        print(f"[VFS] Manifest rebuilt for {len(mods)} mods: {len(manifest)} files in {time.perf_counter() - t0:.2f}s")
+        return True
+
+# ==== LuaJIT 字节码缓存 ====
+# 每次评估 luajit 都要从源码重新解析 wand_eval_tree、gun.lua / gun_actions.lua 与每个模组追加脚本。
+# 这里把它们预编译成字节码，放在 CACHE_DIR/bytecode/<LuaJIT 版本>/ 下，以 (块名 + 源码) 的哈希命名，源码或追加脚本一变就换一个文件：
+#   - wand_eval_tree 的 main.lua 与 src/*.lua 编译进一个镜像目录，评估时由引导脚本把它放到 package.path 最前面再运行 main；
+#   - 游戏脚本与追加脚本记录在 twwe_bytecode.txt 里，twwe_bytecode.lua 接管模拟器 dofile 用的 loadstring，
+#     长度与内容哈希都与编译时一致、且没有被 ModTextFileSetContent 改写过的文件直接载入字节码
+#     (twwe_bytecode.txt 与 gen_N.lua 由并发的评估共用，只看块名和长度可能载入另一份源码的字节码)。
+# 编译用同一个 luajit 的 string.dump (保留调试信息与原来的块名，报错信息不变)，一次启动编译所有缺失的文件。
+# 编译器无法运行 (例如不是 LuaJIT) 时关闭缓存，评估照常从源码加载。
+BYTECODE_CACHE_ENABLED = os.environ.get("TWWE_BYTECODE_CACHE", "1") != "0"
+BYTECODE_DIR = os.path.join(CACHE_DIR, "bytecode")
+BYTECODE_KEEP_DAYS = 14
+# 模拟器每次评估都会 dofile 的游戏脚本
+BYTECODE_VFS_PATHS = (
+    "data/scripts/gun/gun.lua",
+    "data/scripts/gun/gun_actions.lua",
+    "data/scripts/gun/gun_extra_modifiers.lua",
+    "data/scripts/gun/gunaction_generated.lua",
+    "data/scripts/gun/gun_generated.lua",
+    "data/scripts/gun/gunshoteffects_generated.lua",
+    "data/scripts/gun/procedural/gun_action_utils.lua",
+    "data/scripts/lib/utilities.lua",
+)
+
+BYTECODE_COMPILER_LUA = """-- 由 TWWE 生成：不带参数时输出 LuaJIT 版本；否则按任务文件 (块名\\t源文件\\t输出文件) 编译字节码
+if not arg[1] then
+    local ok, ffi = pcall(require, "ffi")
+    io.write(jit and jit.version or _VERSION, " ", jit and jit.arch or "", ok and ffi.abi("gc64") and " gc64" or "", "\\n")
+    return
+end
+for line in io.lines(arg[1]) do
+    local name, src, out = line:match("^(.-)\\t(.-)\\t(.+)$")
+    if name then
+        -- "@?模块名" 表示 require 加载的模块，块名取 package.searchpath 找到的路径
+        if name:sub(1, 2) == "@?" then
+            name = "@" .. (package.searchpath(name:sub(3), package.path) or name:sub(3))
+        end
+        -- 与模拟器一样以文本方式读取
+        local f = io.open(src, "r")
+        local content = f and f:read("*a")
+        if f then f:close() end
+        local fn, err = nil, "unreadable"
+        if content then fn, err = loadstring(content, name) end
+        if fn then
+            local o = io.open(out, "wb")
+            o:write(string.dump(fn))
+            o:close()
+            io.write("OK\\t", out, "\\n")
+        else
+            io.write("ERR\\t", out, "\\t", (tostring(err):gsub("\\n", " ")), "\\n")
+        end
+    end
+end
+"""
+
+BYTECODE_MOCK_LUA = """-- 由 TWWE 生成：源码与 twwe_bytecode.txt 记录的一致时直接载入预编译的字节码，省去解析
+local compiled = {}
+local manifest = io.open("mods/twwe_mock/twwe_bytecode.txt", "r")
+if manifest then
+    for line in manifest:lines() do
+        local name, size, hash, path = line:match("^(.-)\\t(%d+)\\t(%x+)\\t(.+)$")
+        if name then compiled[name] = { size = tonumber(size), hash = hash, path = path } end
+    end
+    manifest:close()
+end
+-- 与后端 _lua_content_hash 相同 (两个 32 位字符串哈希拼接)
+local byte = string.byte
+local function content_hash(s)
+    local h1, h2 = 5381, 0
+    for i = 1, #s do
+        local c = byte(s, i)
+        h1 = (h1 * 33 + c) % 4294967296
+        h2 = (h2 * 65599 + c) % 4294967296
+    end
+    return string.format("%08x%08x", h1, h2)
+end
+local overridden = {}
+local _set = ModTextFileSetContent
+function ModTextFileSetContent(filename, content)
+    overridden[filename] = true
+    return _set(filename, content)
+end
+local _loadstring = loadstring
+function loadstring(content, chunkname)
+    local entry = chunkname and compiled[chunkname]
+    if entry and not overridden[chunkname] and #content == entry.size and content_hash(content) == entry.hash then
+        local fn = loadfile(entry.path)
+        if fn then return fn end
+    end
+    return _loadstring(content, chunkname)
+end
+"""
+
+_BYTECODE_STATE = None     # (源码状态键, 引导脚本路径, 是否有游戏脚本字节码)
+_BYTECODE_LOCK = Lock()
+_LUAJIT_ID = None          # (luajit 可执行文件状态, 版本标识)；无法编译时版本标识为 None
+
+def _file_state(path):
+    try:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+def _lua_text(data):
+    """luajit 以文本方式读取时得到的内容 (Windows 会把 \\r\\n 读成 \\n)"""
+    return data.replace(b"\r\n", b"\n") if os.name == "nt" else data
+
+_LUA_CONTENT_HASHES = {}   # 源码 sha1 -> _lua_content_hash，纯 Python 计算较慢，同样的内容只算一次
+
+def _lua_content_hash(data):
+    """与 twwe_bytecode.lua 的 content_hash 相同"""
+    h1, h2 = 5381, 0
+    for c in data:
+        h1 = (h1 * 33 + c) % 4294967296
+        h2 = (h2 * 65599 + c) % 4294967296
+    return f"{h1:08x}{h2:08x}"
+
+def _luajit_id(compiler_path):
+    """当前 luajit 的版本 + 架构 + GC64 标识 (字节码只能在同样的构建上加载)；无法运行时返回 None"""
+    global _LUAJIT_ID
+    import shutil
+    exe = shutil.which(LUAJIT_PATH) or LUAJIT_PATH
+    state = (exe, _file_state(exe))
+    if _LUAJIT_ID and _LUAJIT_ID[0] == state:
+        return _LUAJIT_ID[1]
+    ident = None
+    try:
+        proc = subprocess.run([LUAJIT_PATH, compiler_path], capture_output=True, text=True, timeout=10, cwd=WAND_EVAL_DIR)
+        out = proc.stdout.strip()
+        if proc.returncode == 0 and out.startswith("LuaJIT"):
+            ident = out
+        else:
+            print(f"[Bytecode] {LUAJIT_PATH} is not LuaJIT, bytecode cache disabled: {(out or proc.stderr.strip())[:200]}")
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"[Bytecode] Could not run {LUAJIT_PATH}, bytecode cache disabled: {e}")
+    _LUAJIT_ID = (state, ident)
+    return ident
+
+def _bytecode_sources(append_paths, use_manifest):
+    """需要预编译的文件: [(块名, 源文件, 镜像中的相对路径 / None)]"""
+    sources = [("@main.lua", os.path.join(WAND_EVAL_DIR, "main.lua"), "main.lua")]
+    src_dir = os.path.join(WAND_EVAL_DIR, "src")
+    try:
+        names = sorted(os.listdir(src_dir))
+    except OSError:
+        names = []
+    for name in names:
+        if name.endswith(".lua"):
+            sources.append((f"@?src.{name[:-4]}", os.path.join(src_dir, name), f"src/{name}"))
+    manifest = _VFS_MANIFEST if use_manifest else {}
+    for vfs_path in BYTECODE_VFS_PATHS:
+        if vfs_path in manifest:
+            sources.append((vfs_path, manifest[vfs_path], None))
+    for vfs_path in append_paths:
+        sources.append((vfs_path, os.path.join(WAND_EVAL_DIR, vfs_path), None))
+    return sources
+
+def ensure_bytecode_cache(append_paths, use_manifest):
+    """
+    确保字节码与当前源码一致 (按文件修改时间与大小判断，变化时按内容哈希查找或重新编译)。
+    返回 (引导脚本路径或 None, 是否需要加载 twwe_bytecode.lua)。
+    """
+    global _BYTECODE_STATE
+    if not BYTECODE_CACHE_ENABLED:
+        return None, False
+    sources = _bytecode_sources(append_paths, use_manifest)
+    key = (LUAJIT_PATH, tuple((chunk, path, _file_state(path)) for chunk, path, _ in sources))
+    with _BYTECODE_LOCK:
+        state = _BYTECODE_STATE
+        record_cache("bytecode_state", state is not None and state[0] == key)
+        if state is not None and state[0] == key:
+            return state[1], state[2]
+        t0 = time.perf_counter()
+        try:
+            boot, has_vfs = _build_bytecode_cache(sources)
+        except OSError as e:
+            print(f"[Bytecode] Cache unavailable: {e}")
+            boot, has_vfs = None, False
+        _BYTECODE_STATE = (key, boot, has_vfs)
+        trace_add("bytecode", time.perf_counter() - t0)
+        return boot, has_vfs
+
+def _build_bytecode_cache(sources):
+    import hashlib, shutil
+    os.makedirs(BYTECODE_DIR, exist_ok=True)
+    compiler_path = os.path.join(BYTECODE_DIR, "twwe_compile.lua")
+    _write_if_changed(compiler_path, BYTECODE_COMPILER_LUA)
+    ident = _luajit_id(compiler_path)
+    if ident is None:
+        return None, False
+    base = os.path.join(BYTECODE_DIR, hashlib.sha1(ident.encode("utf-8")).hexdigest()[:12])
+    os.makedirs(base, exist_ok=True)
+
+    # 按块名 + 源码内容寻址；已经编译过的直接复用
+    entries = []   # (块名, 镜像相对路径, 字节码文件, Lua 看到的长度, Lua 看到的内容哈希)
+    jobs = []
+    for chunk, path, mirror_rel in sources:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            continue
+        digest = hashlib.sha1(chunk.encode("utf-8") + b"\0" + data).hexdigest()[:24]
+        bc_path = os.path.join(base, digest + ".bc").replace("\\", "/")
+        hit = os.path.exists(bc_path)
+        record_cache("bytecode", hit)
+        if not hit:
+            jobs.append((chunk, path.replace("\\", "/"), f"{bc_path}.{os.getpid()}.tmp"))
+        text = _lua_text(data)
+        if mirror_rel:
+            entries.append((chunk, mirror_rel, bc_path, len(text), None))
+        else:
+            if digest not in _LUA_CONTENT_HASHES:
+                _LUA_CONTENT_HASHES[digest] = _lua_content_hash(text)
+            entries.append((chunk, mirror_rel, bc_path, len(text), _LUA_CONTENT_HASHES[digest]))
+
+    if jobs:
+        t0 = time.perf_counter()
+        job_file = os.path.join(base, f"jobs.{os.getpid()}.txt")
+        with open(job_file, "w", encoding="utf-8") as f:
+            f.write("".join(f"{chunk}\t{src}\t{out}\n" for chunk, src, out in jobs))
+        try:
+            proc = subprocess.run([LUAJIT_PATH, compiler_path, job_file], capture_output=True, text=True,
+                                  encoding="utf-8", errors="replace", timeout=120, cwd=WAND_EVAL_DIR)
+        finally:
+            os.unlink(job_file)
+        compiled = 0
+        for line in proc.stdout.splitlines():
+            status, _, rest = line.partition("\t")
+            out, _, error = rest.partition("\t")
+            if status == "OK" and out.endswith(".tmp"):
+                os.replace(out, out[:-len(f".{os.getpid()}.tmp")])
+                compiled += 1
+            elif status == "ERR":
+                print(f"[Bytecode] Could not compile {out}: {error}")
+        if proc.returncode != 0:
+            print(f"[Bytecode] Compiler exited with {proc.returncode}: {proc.stderr.strip()[:300]}")
+        print(f"[Bytecode] Compiled {compiled}/{len(jobs)} files in {time.perf_counter() - t0:.2f}s ({ident})")
+    entries = [e for e in entries if os.path.exists(e[2])]
+
+    # wand_eval_tree 镜像目录：目录名由各文件的字节码决定，内容不变时复用
+    tree = [(rel, bc) for _, rel, bc, _, _ in entries if rel]
+    boot = None
+    if any(rel == "main.lua" for rel, _ in tree):
+        mirror_id = hashlib.sha1("".join(f"{rel}={bc}\n" for rel, bc in tree).encode("utf-8")).hexdigest()[:12]
+        mirror = os.path.join(base, f"tree-{mirror_id}").replace("\\", "/")
+        boot = f"{mirror}/twwe_boot.lua"
+        if not os.path.exists(boot):
+            os.makedirs(f"{mirror}/src", exist_ok=True)
+            for rel, bc in tree:
+                shutil.copyfile(bc, f"{mirror}/{rel}")
+            quoted = json.dumps(mirror, ensure_ascii=False)[1:-1]
+            _write_if_changed(boot, "-- 由 TWWE 生成：从预编译的字节码镜像运行 wand_eval_tree，镜像里没有的模块仍按原来的路径加载源码\n"
+                                    f'package.path = "{quoted}/?.lua;" .. package.path\n'
+                                    f'return assert(loadfile("{quoted}/main.lua"))(...)\n')
+
+    # 游戏脚本与追加脚本：由 twwe_bytecode.lua 在 loadstring 时按块名查表
+    vfs_lines = [f"{chunk}\t{size}\t{content_hash}\t{bc}\n" for chunk, rel, bc, size, content_hash in entries if not rel]
+    mock_mod_dir = os.path.join(WAND_EVAL_DIR, "mods", "twwe_mock")
+    os.makedirs(mock_mod_dir, exist_ok=True)
+    _write_if_changed(os.path.join(mock_mod_dir, "twwe_bytecode.txt"), "".join(vfs_lines))
+    _write_if_changed(os.path.join(mock_mod_dir, "twwe_bytecode.lua"), BYTECODE_MOCK_LUA)
+
+    # 清理长时间没有被用到的旧字节码 (其它 worker 可能还在用较新的文件，所以只按时间清理)
+    in_use = {os.path.basename(bc) for _, _, bc, _, _ in entries}
+    cutoff = time.time() - BYTECODE_KEEP_DAYS * 86400
+    for name in os.listdir(base):
+        path = os.path.join(base, name)
+        try:
+            if name in in_use:
+                os.utime(path)
+            elif name.endswith(".bc") and os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+        except OSError:
+            pass
+    return boot, bool(vfs_lines)
+
+def build_eval_command(data, active_mods=None, snapshot=None):
+    """根据评估请求构建 wand_eval_tree 命令行，没有可评估的法术时返回 None"""
+    if snapshot is None:
+        snapshot = get_snapshot()
+    spells_data = data.get("spells", [])
+    spell_uses = data.get("spell_uses", {}) # { "1": 5, "3": 0 }
 
     # 使用绝对路径并统一斜杠方向，避免 Lua 字符串转义问题
     abs_data_path = EXTRACTED_DATA_ROOT.replace("\\", "/") + "/"
@@ -929,47 +3129,63 @@ def evaluate_wand():
         mock_lua.insert(0, "_TWWE_MANY_ENEMIES = true")
     if data.get("simulate_many_projectiles"):
         mock_lua.insert(0, "_TWWE_MANY_PROJECTILES = true")
+    # 乱序: wand_eval_tree 固定按非乱序配置魔杖，由 twwe_shuffle.lua 在 gun.lua 加载后改写。
+    # 种子通过子进程环境变量传入 (见 eval_env)，init.lua 内容不变，不同种子的评估可以并发运行
+    mock_lua.append('if os.getenv("TWWE_SHUFFLE_SEED") then ModLuaFileAppend("data/scripts/gun/gun.lua", "mods/twwe_mock/twwe_shuffle.lua") end')
     
     # 获取活动模组列表
-    active_mods = []
-    live_active_mods_res = talk_to_game("GET_ACTIVE_MODS")
-    if live_active_mods_res:
-        try:
-            active_mods = json.loads(live_active_mods_res)
-        except: pass
-    if not active_mods and _ACTIVE_MODS_CACHE:
-        active_mods = _ACTIVE_MODS_CACHE
+    if active_mods is None:
+        active_mods = get_active_mods(snapshot)
+    use_manifest = ensure_vfs_manifest(active_mods)
+    if use_manifest:
+        # 必须在其它 dofile 之前生效
+        mock_lua.insert(0, 'dofile("mods/twwe_mock/twwe_vfs.lua")')
 
     # 注入游戏内的法术追加逻辑
     # 我们使用 ModLuaFileAppend 注册追加，这样模拟器在 dofile("gun_actions.lua") 时会自动执行它们
-    if _MOD_APPENDS_CACHE:
+    t_mock = time.perf_counter()
+    append_paths = []
+    if snapshot.appends:
         # 补丁 Mod 应该放在模拟器目录下
         mock_mod_dir = os.path.join(WAND_EVAL_DIR, "mods", "twwe_mock")
         os.makedirs(mock_mod_dir, exist_ok=True)
         
-        should_write_init = False
-        for i, (path, content) in enumerate(_MOD_APPENDS_CACHE.items()):
+        for i, (path, content) in enumerate(snapshot.appends.items()):
             file_name = f"gen_{i}.lua"
             file_path = os.path.join(mock_mod_dir, file_name)
             
             # 优化：内容没变就不写磁盘，减少 I/O
+            # 注意：无论是否重写文件，init.lua 里都必须注册追加，否则第二次评估时 Mod 法术会丢失
+            unchanged = False
             try:
                 if os.path.exists(file_path):
                     with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                        if f.read() == content:
-                            continue
+                        unchanged = f.read() == content
             except: pass
 
-            with open(file_path, "w", encoding="utf-8", errors="replace") as f:
-                f.write(content)
+            record_cache("mock_mod_files", unchanged)
+            if not unchanged:
+                with open(file_path, "w", encoding="utf-8", errors="replace") as f:
+                    f.write(content)
             mock_lua.append(f'ModLuaFileAppend("data/scripts/gun/gun_actions.lua", "mods/twwe_mock/{file_name}")')
-            should_write_init = True
+            append_paths.append(f"mods/twwe_mock/{file_name}")
+
+    # 预编译的字节码：wand_eval_tree 改由引导脚本运行，游戏脚本与追加脚本由 twwe_bytecode.lua 载入
+    boot, use_bytecode = ensure_bytecode_cache(append_paths, use_manifest)
+    if boot:
+        cmd[cmd.index("main.lua")] = boot
+    if use_bytecode:
+        # 放在最前面 (VFS 清单之后)，gun.lua 载入前生效
+        mock_lua.insert(1 if use_manifest else 0, 'dofile("mods/twwe_mock/twwe_bytecode.lua")')
 
     if mock_lua:
         # 写入 init.lua
         mock_mod_dir = os.path.join(WAND_EVAL_DIR, "mods", "twwe_mock")
         os.makedirs(mock_mod_dir, exist_ok=True)
         
+        shuffle_path = os.path.join(mock_mod_dir, "twwe_shuffle.lua")
+        record_cache("mock_mod_files", not _write_if_changed(shuffle_path, SHUFFLE_MOCK_LUA))
+
         init_path = os.path.join(mock_mod_dir, "init.lua")
         init_content = "\n".join(mock_lua) + "\n"
         
@@ -982,6 +3198,7 @@ def evaluate_wand():
                         write_init = False
         except: pass
 
+        record_cache("mock_mod_files", not write_init)
         if write_init:
             with open(init_path, "w", encoding="utf-8") as f:
                 f.write(init_content)
@@ -994,15 +3211,11 @@ def evaluate_wand():
             
         # 即使 twwe_mock 已经存在，也要补全其他 mod 以支持 VFS 搜索
         # 优化：只添加真正的字符串 ID，过滤掉可能被污染的键名
+        # 有 VFS 清单时大部分查找由 twwe_vfs.lua 完成，这里的模组列表是清单查不到时的兜底
         for m in active_mods:
             if isinstance(m, str) and m not in cmd and m not in ["wand_sync", "appends", "spells", "active_mods"]:
                 cmd.append(m)
-
-    # 乱序设置
-    if data.get("shuffle_deck_when_empty"):
-        # wand_eval_tree 默认是非乱序，如果需要乱序，通常需要特定参数或者它目前可能不支持完美模拟乱序
-        # 暂时保持默认，因为用户说没人用乱序
-        pass
+    trace_add("mock_files", time.perf_counter() - t_mock)
 
     # 添加法术列表
     cmd.append("-sp")
@@ -1018,55 +3231,1569 @@ def evaluate_wand():
                 cmd.append(str(spell_uses[slot_key]))
 
     if spell_count == 0:
+        return None
+    return cmd
+
+class EvalSupervisor:
+    """
+    统一管理所有 luajit 子进程 (评估器与导入助手)。
+    后台线程负责及时回收 (避免僵尸进程)、强制截止时间与内存上限，并按进程组整体终止。
+    """
+
+    def __init__(self, poll_interval=0.1):
+        self.poll_interval = poll_interval
+        self._lock = Lock()
+        self._entries = {}   # pid -> entry
+        self._by_key = {}    # proc_key -> pid，同一插槽只保留最新的进程
+        self._wakeup = Event()
+        self._thread = None
+        self.spawned_total = 0
+        self.reaped_total = 0
+        self.killed_total = {}
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = Thread(target=self._run, name="EvalSupervisor", daemon=True)
+            self._thread.start()
+
+    def spawn(self, cmd, key=None, timeout=None, **popen_kwargs):
+        """启动子进程并登记。key 相同的旧进程会被整组杀掉 (新的评估请求顶替旧的)"""
+        if key is not None:
+            with self._lock:
+                old_pid = self._by_key.pop(key, None)
+                old_entry = self._entries.get(old_pid) if old_pid else None
+            if old_entry and old_entry["proc"].poll() is None:
+                print(f"[Eval] Terminating stale process for {key}")
+                self.kill(old_entry["proc"], "superseded")
+
+        if sys.platform == "win32":
+            popen_kwargs.setdefault("creationflags", subprocess.CREATE_NEW_PROCESS_GROUP)
+        else:
+            # 独立进程组，终止时连同它可能派生的子进程一起清理
+            popen_kwargs.setdefault("start_new_session", True)
+
+        proc = subprocess.Popen(cmd, **popen_kwargs)
+        proc.twwe_kill_reason = None
+        now = time.time()
+        entry = {
+            "proc": proc,
+            "key": key,
+            "started": now,
+            "deadline": now + timeout if timeout else None,
+            "rss": 0,
+            "peak_rss": 0,
+            "last_sample": 0,
+        }
+        with self._lock:
+            self._entries[proc.pid] = entry
+            if key is not None:
+                self._by_key[key] = proc.pid
+            self.spawned_total += 1
+        self._ensure_thread()
+        self._wakeup.set()
+        return proc
+
+    def kill(self, proc, reason):
+        """按进程组强制终止，reason 会记录在 proc.twwe_kill_reason 上供调用方判断"""
+        # 注意：其它线程正在 wait() 时 poll() 拿不到锁会返回 None，所以用 kill_reason 防止重复终止
+        if proc.poll() is not None or getattr(proc, "twwe_kill_reason", None) is not None:
+            return False
+        proc.twwe_kill_reason = reason
+        with self._lock:
+            self.killed_total[reason] = self.killed_total.get(reason, 0) + 1
+        try:
+            if sys.platform == "win32":
+                subprocess.run(["taskkill", "/F", "/T", "/PID", str(proc.pid)], capture_output=True)
+            else:
+                os.killpg(proc.pid, signal.SIGKILL)
+        except Exception:
+            try:
+                proc.kill()
+            except Exception:
+                pass
+        self._wakeup.set()
+        return True
+
+    def kill_key(self, key, reason="cancelled"):
+        with self._lock:
+            pid = self._by_key.get(key)
+            entry = self._entries.get(pid) if pid else None
+        if entry:
+            return self.kill(entry["proc"], reason)
+        return False
+
+    def _run(self):
+        while True:
+            with self._lock:
+                entries = list(self._entries.items())
+            if not entries:
+                self._wakeup.wait(1.0)
+                self._wakeup.clear()
+                continue
+
+            now = time.time()
+            for pid, entry in entries:
+                proc = entry["proc"]
+                # poll() 会在进程退出后立即 waitpid，避免僵尸进程
+                if proc.poll() is not None:
+                    with self._lock:
+                        self._entries.pop(pid, None)
+                        if entry["key"] is not None and self._by_key.get(entry["key"]) == pid:
+                            del self._by_key[entry["key"]]
+                        self.reaped_total += 1
+                    continue
+
+                if entry["deadline"] and now > entry["deadline"]:
+                    self.kill(proc, "timeout")
+                    continue
+
+                if now - entry["last_sample"] >= 0.5:
+                    entry["last_sample"] = now
+                    rss = get_process_rss(pid)
+                    if rss:
+                        entry["rss"] = rss
+                        entry["peak_rss"] = max(entry["peak_rss"], rss)
+                        # rlimit 只在 POSIX 生效，这里按 RSS 兜底 (Windows 需要 psutil)
+                        if EVAL_MEMORY_LIMIT_MB > 0 and rss > EVAL_MEMORY_LIMIT_MB * 1024 * 1024:
+                            self.kill(proc, "memory")
+
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            entries = list(self._entries.values())
+            summary = {
+                "spawned_total": self.spawned_total,
+                "reaped_total": self.reaped_total,
+                "killed_total": dict(self.killed_total),
+            }
+        processes = []
+        for entry in entries:
+            proc = entry["proc"]
+            processes.append({
+                "pid": proc.pid,
+                "key": entry["key"],
+                "running": proc.poll() is None,
+                "age_sec": round(now - entry["started"], 3),
+                "deadline_in_sec": round(entry["deadline"] - now, 3) if entry["deadline"] else None,
+                "rss_mb": round(entry["rss"] / (1024 * 1024), 2),
+                "peak_rss_mb": round(entry["peak_rss"] / (1024 * 1024), 2),
+                "kill_reason": proc.twwe_kill_reason,
+            })
+        summary["count"] = len(processes)
+        summary["running"] = sum(1 for p in processes if p["running"])
+        summary["processes"] = processes
+        return summary
+
+def get_process_rss(pid):
+    """读取进程常驻内存 (字节)，优先 psutil，Linux 下退回 /proc"""
+    if HAS_PSUTIL:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except Exception:
+            return 0
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        return 0
+
+eval_supervisor = EvalSupervisor()
+
+# ==== 评估取消 ====
+# 每个进行中的评估 (单次评估、流式评估、参数扫描、蒙特卡洛) 都以所属插槽 "tab_id-slot_id" 登记一个取消回调，
+# 参数扫描与蒙特卡洛另外以 job_id 登记。取消时回调负责设置协作式的取消标志 (进程内快速评估在每轮施法之间检查，
+# 线程池里尚未开始的任务直接跳过) 并整组杀掉正在运行的 luajit，占用的请求线程与线程池 worker 随即释放。
+# 取消来源: POST /api/evaluate/cancel，或 DisconnectWatcher 发现客户端已断开连接。
+
+class EvalCancelled(Exception):
+    """评估被取消 (客户端请求取消或已断开)"""
+
+class CancelRegistry:
+    def __init__(self):
+        self._lock = Lock()
+        self._handlers = {}  # owner -> {token: callback(reason)}
+
+    def register(self, owners, callback):
+        token = object()
+        with self._lock:
+            for owner in owners:
+                self._handlers.setdefault(owner, {})[token] = callback
+        return token
+
+    def unregister(self, owners, token):
+        with self._lock:
+            for owner in owners:
+                handlers = self._handlers.get(owner)
+                if handlers is not None:
+                    handlers.pop(token, None)
+                    if not handlers:
+                        del self._handlers[owner]
+
+    def cancel(self, owner=None, prefix=None, reason="cancelled"):
+        """取消 owner 名下 (或 owner 以 prefix 开头) 的全部评估，返回被取消的评估个数"""
+        with self._lock:
+            owners = [o for o in self._handlers if o == owner or (prefix and o.startswith(prefix))]
+            callbacks = {}
+            for o in owners:
+                callbacks.update(self._handlers.pop(o))
+        for callback in callbacks.values():
+            try:
+                callback(reason)
+            except Exception as e:
+                print(f"[Cancel] Error while cancelling: {e}")
+        if callbacks:
+            metrics.inc("twwe_eval_cancelled_total", amount=len(callbacks), reason=reason)
+        return len(callbacks)
+
+    def owners(self):
+        with self._lock:
+            return sorted(self._handlers)
+
+cancellations = CancelRegistry()
+
+def _request_socket(environ):
+    # 开发服务器 (werkzeug) 与 gunicorn 都会把客户端连接放进 environ
+    return environ.get("werkzeug.socket") or environ.get("gunicorn.socket")
+
+class DisconnectWatcher:
+    """
+    后台线程轮询正在等待评估结果的客户端连接。请求体已经读完，浏览器在收到响应之前不会再发送数据，
+    所以连接可读且 MSG_PEEK 读到 EOF (或连接被重置) 就说明客户端已经断开。
+    """
+
+    def __init__(self, poll_interval=0.25):
+        self.poll_interval = poll_interval
+        self._lock = Lock()
+        self._watched = {}  # token -> (socket, callback)
+        self._wakeup = Event()
+        self._thread = None
+
+    def watch(self, environ, callback):
+        sock = _request_socket(environ)
+        if sock is None:
+            return None
+        token = object()
+        with self._lock:
+            self._watched[token] = (sock, callback)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, name="DisconnectWatcher", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return token
+
+    def unwatch(self, token):
+        if token is not None:
+            with self._lock:
+                self._watched.pop(token, None)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                watched = list(self._watched.items())
+            if not watched:
+                self._wakeup.wait(1.0)
+                self._wakeup.clear()
+                continue
+            socks = {}
+            for token, (sock, callback) in watched:
+                try:
+                    if sock.fileno() >= 0:
+                        socks[sock] = (token, callback)
+                        continue
+                except OSError:
+                    pass
+                self.unwatch(token)
+            try:
+                readable = select.select(list(socks), [], [], 0)[0] if socks else []
+            except (OSError, ValueError):
+                readable = []
+            for sock in readable:
+                token, callback = socks[sock]
+                try:
+                    closed = sock.recv(1, socket.MSG_PEEK) == b""
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    closed = True
+                # 读到数据说明客户端在复用连接 (流水线请求)，无法判断，不再继续观察
+                self.unwatch(token)
+                if closed:
+                    callback("disconnected")
+            time.sleep(self.poll_interval)
+
+disconnect_watcher = DisconnectWatcher()
+
+class cancellable:
+    """
+    在 with 块内登记一个可取消的评估:
+        with cancellable([proc_key], on_cancel) as cancel:
+            ...  # cancel.is_set() 为协作式取消标志
+    on_cancel(reason) 在标志设置之后调用，用来停止线程池任务等。watch_disconnect 为 True 时客户端断开也会触发取消。
+    run_evaluator 启动的进程登记在取消标志上 (cancel.twwe_procs)，取消时只终止这些进程，
+    不会误杀同插槽里更新的请求启动的进程。
+    """
+
+    def __init__(self, owners, on_cancel=None, watch_disconnect=True, environ=None):
+        self.owners = [o for o in owners if o]
+        self.on_cancel = on_cancel
+        self.event = Event()
+        self.event.twwe_procs = []
+        self.reason = None
+        self._environ = environ if environ is not None else (request.environ if has_request_context() else None)
+        self._watch = watch_disconnect
+        self._token = None
+        self._watch_token = None
+
+    def _fire(self, reason):
+        if self.event.is_set():
+            return
+        self.reason = reason
+        self.event.set()
+        if self.on_cancel:
+            self.on_cancel(reason)
+        self.kill_started()
+
+    def kill_started(self, reason="cancelled"):
+        """终止本次评估启动的进程"""
+        for proc in list(self.event.twwe_procs):
+            eval_supervisor.kill(proc, reason)
+
+    def _disconnected(self, reason):
+        # 只取消自己：同一插槽下可能已经登记了新连接的请求，不能按 owner 整体取消
+        cancellations.unregister(self.owners, self._token)
+        if not self.event.is_set():
+            metrics.inc("twwe_eval_cancelled_total", reason=reason)
+        self._fire(reason)
+
+    def __enter__(self):
+        self._token = cancellations.register(self.owners, self._fire)
+        if self._watch and self._environ is not None:
+            self._watch_token = disconnect_watcher.watch(self._environ, self._disconnected)
+        return self.event
+
+    def __exit__(self, *exc):
+        disconnect_watcher.unwatch(self._watch_token)
+        cancellations.unregister(self.owners, self._token)
+        return False
+
+def _slot_owner(data):
+    """请求所属插槽 "tab_id-slot_id"，未提供时返回 None"""
+    if data.get("tab_id") is None or data.get("slot_id") is None:
+        return None
+    return f"{data['tab_id']}-{data['slot_id']}"
+
+@app.route("/api/evaluate/cancel", methods=["POST"])
+def cancel_evaluation():
+    """
+    请求体: {"tab_id": ..., "slot_id": ...} 取消该插槽的评估；只给 tab_id 时取消整个标签页的评估；
+    {"job_id": ...} 取消参数扫描 / 蒙特卡洛 (job_id 即 sweep_id / mc_id)。
+    """
+    data = request.get_json(silent=True) or {}
+    tab_id = data.get("tab_id")
+    slot_id = data.get("slot_id")
+    job_id = data.get("job_id")
+    if job_id:
+        cancelled = cancellations.cancel(owner=str(job_id))
+    elif tab_id is not None and slot_id is not None:
+        proc_key = f"{tab_id}-{slot_id}"
+        cancelled = cancellations.cancel(owner=proc_key)
+        # 兜底: 不在 registry 中的同插槽进程 (例如请求线程已结束但进程尚未回收) 也一并终止
+        if eval_supervisor.kill_key(proc_key, "cancelled"):
+            cancelled = max(cancelled, 1)
+    elif tab_id is not None:
+        cancelled = cancellations.cancel(prefix=f"{tab_id}-")
+    else:
+        return jsonify({"success": False, "error": "tab_id or job_id is required"}), 400
+    print(f"[Cancel] {job_id or tab_id}{'-' + str(slot_id) if slot_id is not None and not job_id else ''}: {cancelled} evaluation(s) cancelled")
+    return jsonify({"success": True, "cancelled": cancelled})
+
+@app.route("/api/processes")
+def list_processes():
+    stats = eval_supervisor.stats()
+    stats["success"] = True
+    stats["backend_rss_mb"] = round(get_process_rss(os.getpid()) / (1024 * 1024), 2)
+    return jsonify(stats)
+
+@metrics.collector
+def _collect_runtime_metrics():
+    stats = eval_supervisor.stats()
+    metrics.set("twwe_eval_processes", stats["running"], state="running")
+    metrics.set("twwe_eval_processes", stats["count"] - stats["running"], state="exited")
+    # 两个 _total 计数器直接取监督器里只增不减的累计值
+    metrics.set("twwe_eval_processes_spawned_total", stats["spawned_total"])
+    for reason, count in stats["killed_total"].items():
+        metrics.set("twwe_eval_processes_killed_total", count, reason=reason)
+    metrics.set("twwe_backend_rss_bytes", get_process_rss(os.getpid()))
+    store = result_store.stats()
+    metrics.set("twwe_result_store_entries", store["count"])
+    metrics.set("twwe_result_store_bytes", store["bytes"])
+
+    caches = {labels["cache"] for labels in metrics.label_sets("twwe_cache_requests_total")}
+    for cache in caches:
+        hits = metrics.get("twwe_cache_requests_total", cache=cache, result="hit")
+        misses = metrics.get("twwe_cache_requests_total", cache=cache, result="miss")
+        if hits + misses:
+            metrics.set("twwe_cache_hit_ratio", round(hits / (hits + misses), 4), cache=cache)
+
+@app.before_request
+def _start_request_timer():
+    request.environ["twwe.start_time"] = time.perf_counter()
+
+@app.after_request
+def _record_request_latency(response):
+    start = request.environ.get("twwe.start_time")
+    if start is not None:
+        # 用路由模板而不是实际路径作为标签，避免 /api/icon/<path> 之类的基数爆炸
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.observe("twwe_http_request_duration_seconds", time.perf_counter() - start,
+                        route=route, method=request.method, status=str(response.status_code))
+    return response
+
+@app.route("/metrics")
+def export_metrics():
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+def _limit_eval_resources():
+    """在 luajit 子进程 exec 前设置 rlimit (仅 POSIX)"""
+    import resource
+    if EVAL_MEMORY_LIMIT_MB > 0:
+        mem_bytes = EVAL_MEMORY_LIMIT_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (mem_bytes, mem_bytes))
+    if EVAL_CPU_LIMIT_SEC > 0:
+        # 软限制到达时发送 SIGXCPU，硬限制留出余量后由内核直接 SIGKILL
+        resource.setrlimit(resource.RLIMIT_CPU, (EVAL_CPU_LIMIT_SEC, EVAL_CPU_LIMIT_SEC + 5))
+
+def _drain_eval_stdout(proc, limit_bytes, state):
+    """流式读取评估输出，一旦超过 limit_bytes 立即杀掉进程，而不是等全部缓冲完再检查"""
+    chunks = []
+    total = 0
+    try:
+        while True:
+            chunk = proc.stdout.read1(65536)
+            if not chunk:
+                break
+            total += len(chunk)
+            if limit_bytes and total > limit_bytes:
+                state["limit"] = "output"
+                eval_supervisor.kill(proc, "output")
+                break
+            chunks.append(chunk)
+    except Exception as e:
+        print(f"[Eval] Error reading evaluator output: {e}")
+    state["stdout"] = b"".join(chunks)
+    state["bytes"] = total
+
+def _drain_eval_stderr(proc, state):
+    # stderr 只保留前 1MB，防止刷屏的 Lua 报错也占满内存
+    chunks = []
+    total = 0
+    try:
+        while True:
+            chunk = proc.stderr.read1(65536)
+            if not chunk:
+                break
+            if total < 1024 * 1024:
+                chunks.append(chunk)
+            total += len(chunk)
+    except Exception:
+        pass
+    state["stderr"] = b"".join(chunks)
+
+def run_evaluator(cmd, proc_key, output_limit_mb, env=None, cancel=None):
+    """
+    运行一次 wand_eval_tree 并在运行期间强制执行资源限制。
+    返回 dict: status 为 ok / failed / cancelled / timeout / limit，limit 时附带 limit 字段 (output / memory / cpu)
+    cancel 为取消标志 (Event)：启动前已取消则不再启动进程
+    """
+    if cancel is not None and cancel.is_set():
+        return {"status": "cancelled", "returncode": None, "stdout": b"", "stderr": b"", "bytes": 0}
+    popen_kwargs = {}
+    if sys.platform != "win32" and (EVAL_MEMORY_LIMIT_MB > 0 or EVAL_CPU_LIMIT_SEC > 0):
+        popen_kwargs["preexec_fn"] = _limit_eval_resources
+
+    # 启动新进程 (旧的同插槽进程由 supervisor 整组终止，截止时间也由它强制执行)
+    t_start = time.perf_counter()
+    proc = eval_supervisor.spawn(
+        cmd,
+        key=proc_key,
+        timeout=EVAL_TIMEOUT_SEC if EVAL_TIMEOUT_SEC > 0 else None,
+        cwd=WAND_EVAL_DIR,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        shell=False,
+        env=env,
+        **popen_kwargs
+    )
+
+    # 登记到取消标志上；登记之前到达的取消请求找不到这个进程，这里补上
+    if cancel is not None:
+        getattr(cancel, "twwe_procs", []).append(proc)
+        if cancel.is_set():
+            eval_supervisor.kill(proc, "cancelled")
+
+    t_spawned = time.perf_counter()
+    metrics.observe("twwe_eval_spawn_seconds", t_spawned - t_start)
+    trace_add("eval_spawn", t_spawned - t_start)
+
+    state = {"limit": None}
+    limit_bytes = int(output_limit_mb * 1024 * 1024) if output_limit_mb and output_limit_mb > 0 else 0
+    readers = [
+        Thread(target=_drain_eval_stdout, args=(proc, limit_bytes, state), daemon=True),
+        Thread(target=_drain_eval_stderr, args=(proc, state), daemon=True),
+    ]
+    for t in readers:
+        t.start()
+
+    try:
+        # supervisor 负责超时终止；这里额外留出余量作为兜底，防止线程永久阻塞
+        backstop = EVAL_TIMEOUT_SEC + 10 if EVAL_TIMEOUT_SEC > 0 else None
+        proc.wait(timeout=backstop)
+    except subprocess.TimeoutExpired:
+        eval_supervisor.kill(proc, "timeout")
+        proc.wait()
+    finally:
+        t_exited = time.perf_counter()
+        for t in readers:
+            t.join(timeout=5)
+        t_read = time.perf_counter()
+        metrics.observe("twwe_eval_simulate_seconds", t_exited - t_spawned)
+        metrics.observe("twwe_eval_read_seconds", t_read - t_exited)
+        trace_add("eval_simulate", t_exited - t_spawned)
+        trace_add("eval_read", t_read - t_exited)
+
+    stdout = state.get("stdout", b"")
+    stderr = state.get("stderr", b"")
+    result = {"returncode": proc.returncode, "stdout": stdout, "stderr": stderr, "bytes": state.get("bytes", 0)}
+
+    kill_reason = proc.twwe_kill_reason
+    if state["limit"]:
+        result.update(status="limit", limit=state["limit"])
+    elif kill_reason == "timeout":
+        result["status"] = "timeout"
+    elif kill_reason == "memory":
+        result.update(status="limit", limit="memory")
+    elif kill_reason in ("superseded", "cancelled"):
+        result["status"] = "cancelled"
+    elif proc.returncode != 0:
+        err_text = stderr.decode("utf-8", "replace")
+        if "not enough memory" in err_text:
+            result.update(status="limit", limit="memory")
+        elif hasattr(signal, "SIGXCPU") and proc.returncode == -signal.SIGXCPU:
+            # RLIMIT_CPU 软限制到达
+            result.update(status="limit", limit="cpu")
+        elif proc.returncode < 0:
+            # 如果是被 terminate 杀掉的，returncode 通常是负数 (-15)
+            result["status"] = "cancelled"
+        else:
+            result["status"] = "failed"
+    else:
+        result["status"] = "ok"
+    metrics.inc("twwe_eval_runs_total", status=result.get("limit") or result["status"])
+    metrics.observe("twwe_eval_output_bytes", result["bytes"])
+    return result
+
+# ==== 纯 Python 快速评估 ====
+# 大部分日常魔杖只有投射物与简单修正 (没有触发、定时、条件、随机)，没必要每次都启动 LuaJIT
+# 并加载整套 Noita 数据。这里按 gun.lua 的抽牌逻辑在进程内模拟这一子集，输出与
+# wand_eval_tree 的 JSON 逐字节一致；遇到任何无法精确复现的情况都抛出 FastEvalUnsupported，
+# 由调用方退回 Lua 引擎。
+FAST_EVAL_ENABLED = os.environ.get("TWWE_FAST_EVAL", "1") != "0"
+FAST_EVAL_MAX_DRAWS = 200000   # 单次评估抽牌总数上限
+FAST_EVAL_MAX_NODES = 200000   # 树节点上限，超过交给 Lua 引擎 (它有输出限制与自动折叠)
+
+FAST_ACTION_TYPES = {
+    "ACTION_TYPE_PROJECTILE": 0, "ACTION_TYPE_STATIC_PROJECTILE": 1, "ACTION_TYPE_MODIFIER": 2,
+    "ACTION_TYPE_DRAW_MANY": 3, "ACTION_TYPE_MATERIAL": 4, "ACTION_TYPE_OTHER": 5,
+    "ACTION_TYPE_UTILITY": 6, "ACTION_TYPE_PASSIVE": 7,
+}
+_FAST_NUM = r'(-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+_FAST_STATEMENTS = [
+    ("arith", re.compile(r'c\.(\w+)\s*=\s*c\.(\w+)\s*([-+*/])\s*' + _FAST_NUM)),
+    ("concat", re.compile(r'c\.(\w+)\s*=\s*c\.(\w+)\s*\.\.\s*"([^"\\]*)"')),
+    ("set", re.compile(r'c\.(\w+)\s*=\s*' + _FAST_NUM)),
+    ("set_str", re.compile(r'c\.(\w+)\s*=\s*"([^"\\]*)"')),
+    ("set_bool", re.compile(r'c\.(\w+)\s*=\s*(true|false)')),
+    ("reload", re.compile(r'current_reload_time\s*=\s*current_reload_time\s*([-+])\s*' + _FAST_NUM)),
+    ("noop", re.compile(r'shot_effects\.(\w+)\s*=\s*shot_effects\.(\w+)\s*[-+*/]\s*' + _FAST_NUM)),
+    ("noop", re.compile(r'add_projectile\s*\(\s*"[^"\\]*"\s*\)')),
+    ("draw", re.compile(r'draw_actions\s*\(\s*(\d+)\s*,\s*(true|false)\s*\)')),
+]
+_FAST_LUA_NUMBER_RE = re.compile(r'\s*[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?\s*|\s*[-+]?0[xX][0-9a-fA-F]+\s*')
+_FAST_XML_SUFFIX_RE = re.compile(r'/[^/]+\.xml')
+
+class FastEvalUnsupported(Exception):
+    """该魔杖 / 参数组合超出快速评估器能精确复现的范围"""
+
+class _FastSpell:
+    __slots__ = ("id", "type", "mana", "sound_loop_tag", "max_uses", "never_unlimited", "ops")
+
+def _strip_lua_comments(content):
+    content = re.sub(r'--\[\[.*?\]\]', '', content, flags=re.DOTALL)
+    return re.sub(r'--.*', '', content)
+
+def _parse_lua_literal(text):
+    text = text.strip()
+    if text in ("true", "false"):
+        return text == "true"
+    if text in FAST_ACTION_TYPES:
+        return float(FAST_ACTION_TYPES[text])
+    if len(text) >= 2 and text[0] == text[-1] == '"' and "\\" not in text:
+        return text[1:-1]
+    if re.fullmatch(_FAST_NUM, text):
+        return float(text)
+    raise ValueError(f"unsupported literal {text!r}")
+
+def _parse_fast_action_body(body):
+    """把 action 函数体逐行解析为操作列表，出现任何不认识的语句返回 None"""
+    ops = []
+    for line in body.split("\n"):
+        line = line.strip().rstrip(";").strip()
+        if not line:
+            continue
+        for kind, pattern in _FAST_STATEMENTS:
+            m = pattern.fullmatch(line)
+            if not m:
+                continue
+            if kind in ("arith", "concat") and m.group(1) != m.group(2):
+                return None
+            if kind == "arith":
+                ops.append(("arith", m.group(1), m.group(3), float(m.group(4))))
+            elif kind == "concat":
+                ops.append(("concat", m.group(1), m.group(3)))
+            elif kind == "set":
+                ops.append(("set", m.group(1), float(m.group(2))))
+            elif kind == "set_str":
+                ops.append(("set", m.group(1), m.group(2)))
+            elif kind == "set_bool":
+                ops.append(("set", m.group(1), m.group(2) == "true"))
+            elif kind == "reload":
+                val = float(m.group(2))
+                ops.append(("reload", val if m.group(1) == "+" else -val))
+            elif kind == "draw":
+                ops.append(("draw", int(m.group(1)), m.group(2) == "true"))
+            break
+        else:
+            return None
+    return ops
+
+def _parse_fast_actions(content):
+    """
+    解析 gun_actions.lua: 返回 {ID 大写: _FastSpell}。
+    无法解析的法术 ops 为 None (存在但不支持)，同 ID 只取第一个 (与 easy_add 的查找顺序一致)。
+    """
+    content = _strip_lua_comments(content)
+    starts = list(re.finditer(r'\{\s*id\s*=\s*"([^"]+)"', content))
+    spells = {}
+    for i, m in enumerate(starts):
+        block = content[m.start():starts[i + 1].start() if i + 1 < len(starts) else len(content)]
+        spell = _FastSpell()
+        spell.id = m.group(1)
+        action_m = re.search(r'\baction\s*=\s*function\s*\([^)]*\)', block)
+        head = block[:action_m.start()] if action_m else block
+        fields = {}
+        for key in ("type", "mana", "sound_loop_tag", "max_uses", "never_unlimited"):
+            fm = re.search(rf'(?<![\w.]){key}\s*=\s*([^,\n]+)', head)
+            if fm:
+                fields[key] = fm.group(1)
+        try:
+            spell.type = _parse_lua_literal(fields["type"]) if "type" in fields else None
+            spell.mana = _parse_lua_literal(fields["mana"]) if "mana" in fields else None
+            spell.sound_loop_tag = _parse_lua_literal(fields["sound_loop_tag"]) if "sound_loop_tag" in fields else None
+            spell.max_uses = _parse_lua_literal(fields["max_uses"]) if "max_uses" in fields else None
+            spell.never_unlimited = _parse_lua_literal(fields["never_unlimited"]) if "never_unlimited" in fields else False
+            ends = list(re.finditer(r'\bend\b', block))
+            if action_m and ends and ends[-1].start() > action_m.end():
+                spell.ops = _parse_fast_action_body(block[action_m.end():ends[-1].start()])
+            else:
+                spell.ops = None
+        except (ValueError, KeyError):
+            spell.ops = None
+        if spell.mana is not None and not isinstance(spell.mana, float):
+            spell.ops = None
+        spells.setdefault(spell.id.upper(), spell)
+    return spells
+
+def _parse_lua_return_table(content):
+    """解析 `return { key = literal, ... }` 形式的表 (取最后一个 return)"""
+    content = _strip_lua_comments(content)
+    body = content[content.rindex("return"):]
+    body = body[body.index("{") + 1:body.rindex("}")]
+    table = {}
+    for part in body.split("\n"):
+        part = part.strip().rstrip(",").strip()
+        if not part:
+            continue
+        key, sep, value = part.partition("=")
+        if not sep:
+            raise ValueError(f"unsupported table entry {part!r}")
+        table[key.strip()] = _parse_lua_literal(value)
+    return table
+
+def _parse_lua_string_list(content):
+    content = _strip_lua_comments(content)
+    return re.findall(r'"(\w+)"', content[content.rindex("return"):])
+
+_FAST_EVAL_DATA = None
+_FAST_EVAL_KEY = None
+_FAST_EVAL_LOCK = Lock()
+
+def _fast_eval_sources():
+    return {
+        "actions": os.path.join(EXTRACTED_DATA_ROOT, "data/scripts/gun/gun_actions.lua"),
+        "generated": os.path.join(EXTRACTED_DATA_ROOT, "data/scripts/gun/gunaction_generated.lua"),
+        "defaults": os.path.join(WAND_EVAL_DIR, "src", "data.lua"),
+        "arg_list": os.path.join(WAND_EVAL_DIR, "src", "arg_list.lua"),
+    }
+
+def load_fast_eval_data():
+    """按源文件 mtime/大小缓存解析结果；任何文件缺失或格式不符时返回 None (快速评估整体停用)"""
+    global _FAST_EVAL_DATA, _FAST_EVAL_KEY
+    sources = _fast_eval_sources()
+    try:
+        key = tuple((os.path.getmtime(p), os.path.getsize(p)) for p in sources.values())
+    except OSError:
+        return None
+    record_cache("fast_eval_data", key == _FAST_EVAL_KEY)
+    if key == _FAST_EVAL_KEY:
+        return _FAST_EVAL_DATA
+    with _FAST_EVAL_LOCK:
+        if key != _FAST_EVAL_KEY:
+            data = None
+            try:
+                contents = {}
+                for name, path in sources.items():
+                    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                        contents[name] = f.read()
+                defaults = _parse_lua_return_table(contents["defaults"])
+                arg_list = _parse_lua_string_list(contents["arg_list"])
+                copied = re.findall(r'dest\.(\w+)\s*=\s*source\.\1', contents["generated"])
+                # ReadToLua / Copy 覆盖的字段必须与 data.lua 完全一致，初始状态才能直接取 data.lua
+                if set(arg_list) == set(defaults) == set(copied):
+                    data = {"spells": _parse_fast_actions(contents["actions"]), "defaults": defaults}
+                else:
+                    print("[FastEval] data.lua / arg_list.lua / gunaction_generated.lua fields differ, fast path disabled")
+            except (OSError, ValueError) as e:
+                print(f"[FastEval] Failed to load simulator data: {e}")
+            _FAST_EVAL_DATA = data
+            _FAST_EVAL_KEY = key
+        return _FAST_EVAL_DATA
+
+def _lua_eq(a, b):
+    """Lua 的 == (不同类型永远不相等，Python 里 False == 0.0 为真)"""
+    return type(a) is type(b) and a == b
+
+def lua_tostring(val):
+    """与 LuaJIT tostring 一致 (数字为 %.14g)"""
+    if isinstance(val, bool):
+        return "true" if val else "false"
+    if isinstance(val, float):
+        if val != val:
+            raise FastEvalUnsupported("NaN in output")
+        return "%.14g" % val
+    return val
+
+def _lua_number_arg(val, integer=False):
+    """模拟 format_lua_arg + arg_parser 的 numeric / integer 解析"""
+    text = format_lua_arg(val)
+    if text.startswith(".-"):
+        text = text[1:]
+    if not re.fullmatch(_FAST_NUM, text):
+        raise FastEvalUnsupported(f"argument {text!r}")
+    num = float(text)
+    return float(math.floor(num)) if integer else num
+
+class _FastWandRun:
+    """gun.lua + fake_engine.lua 中与该子集相关的逻辑，变量名与 Lua 侧保持一致"""
+
+    def __init__(self, spells, defaults, options):
+        self.defaults = defaults
+        self.opt = options
+        self.deck = list(spells)
+        self.hand = []
+        self.discarded = []
+        self.first_shot = True
+        self.current_reload_time = 0.0
+        self.reloading = False
+        self.start_reload = False
+        self.mana = options["mana"]
+        self.gun_reload_time = options["reload_time"]
+        self.actions_per_round = options["spells_per_cast"]
+        self.reload_time_event = None
+        self.draws = 0
+        self.nodes = 0
+        self.c = None
+        self.cur_node = None
+        self.cur_cast = 0
+        self.counts = {}
+        self.cast_counts = {}
+        self.root = {"name": "Wand", "children": [], "index": None}
+        self.shots = []   # [(cast_node, state)]
+
+        state_from_game = dict(defaults)
+        state_from_game["fire_rate_wait"] = options["cast_delay"]
+        state_from_game["speed_multiplier"] = options["speed_multiplier"]
+        state_from_game["spread_degrees"] = options["spread_degrees"]
+        self.state_from_game = state_from_game
+
+    def order_deck(self):
+        self.deck.sort(key=lambda card: card[0])
+
+    def set_current_action(self, spell):
+        c = self.c
+        c["action_id"] = spell.id
+        if spell.type is None:
+            c.pop("action_type", None)
+        else:
+            c["action_type"] = spell.type
+        c["action_spawn_manual_unlock"] = False
+        c["action_ai_never_uses"] = False
+        c["action_never_unlimited"] = False
+        c["action_mana_drain"] = 10.0 if spell.mana is None else spell.mana
+        c["action_unidentified_sprite_filename"] = "data/ui_gfx/gun_actions/unidentified.png"
+        # clone_action 不会复制这些字段，set_current_action 赋值为 nil 即删除
+        for key in ("action_name", "action_description", "action_sprite_filename", "action_recursive",
+                    "action_spawn_level", "action_spawn_probability", "action_spawn_requires_flag",
+                    "action_max_uses", "custom_xml_file", "action_is_dangerous_blast"):
+            c.pop(key, None)
+        if spell.sound_loop_tag is None:
+            c.pop("sound_loop_tag", None)
+        else:
+            c["sound_loop_tag"] = spell.sound_loop_tag
+
+    def play_action(self, card):
+        index, spell = card
+        self.hand.append(card)
+        self.set_current_action(spell)
+
+        node = {"name": spell.id, "children": [], "index": index}
+        self.nodes += 1
+        if self.nodes > FAST_EVAL_MAX_NODES:
+            raise FastEvalUnsupported("tree too large")
+        self.counts[spell.id] = self.counts.get(spell.id, 0) + 1
+        cast_counts = self.cast_counts.setdefault(self.cur_cast, {})
+        cast_counts[spell.id] = cast_counts.get(spell.id, 0) + 1
+        old_node = self.cur_node
+        old_node.append(node)
+        self.cur_node = node["children"]
+        c = self.c
+        for op in spell.ops:
+            kind = op[0]
+            if kind == "arith":
+                cur = c.get(op[1])
+                if not isinstance(cur, float):
+                    raise FastEvalUnsupported(f"arithmetic on c.{op[1]}")
+                sign = op[2]
+                if sign == "+":
+                    c[op[1]] = cur + op[3]
+                elif sign == "-":
+                    c[op[1]] = cur - op[3]
+                elif sign == "*":
+                    c[op[1]] = cur * op[3]
+                else:
+                    if op[3] == 0:
+                        raise FastEvalUnsupported("division by zero")
+                    c[op[1]] = cur / op[3]
+            elif kind == "concat":
+                cur = c.get(op[1])
+                if not isinstance(cur, str):
+                    raise FastEvalUnsupported(f"concat on c.{op[1]}")
+                c[op[1]] = cur + op[2]
+            elif kind == "set":
+                c[op[1]] = op[2]
+            elif kind == "reload":
+                self.current_reload_time += op[1]
+            elif kind == "draw":
+                self.draw_actions(op[1], op[2])
+        self.cur_node = old_node
+
+    def draw_action(self, instant_reload_if_empty):
+        self.draws += 1
+        if self.draws > FAST_EVAL_MAX_DRAWS:
+            raise FastEvalUnsupported("too many draws")
+        if not self.deck:
+            if instant_reload_if_empty:
+                self.deck.extend(self.discarded)
+                self.discarded = []
+                self.order_deck()
+                self.start_reload = True
+            else:
+                self.reloading = True
+                return True
+        if self.deck:
+            card = self.deck.pop(0)
+            spell = card[1]
+            required = 10.0 if spell.mana is None else spell.mana
+            if required > self.mana:
+                self.discarded.append(card)
+                return False
+            self.mana -= required
+            self.play_action(card)
+        return True
+
+    def draw_actions(self, how_many, instant_reload_if_empty):
+        self.c["action_draw_many_count"] = float(how_many)
+        i = 1
+        while i <= how_many:
+            if self.draw_action(instant_reload_if_empty) is False:
+                while self.deck:
+                    if self.draw_action(instant_reload_if_empty):
+                        break
+            if self.reloading:
+                return
+            i += 1
+
+    def handle_reload(self):
+        self.discarded.extend(self.hand)
+        self.hand = []
+        if not self.reloading and (not self.deck or self.start_reload):
+            self.deck.extend(self.discarded)
+            self.discarded = []
+            self.order_deck()
+            self.reload_time_event = self.current_reload_time
+            self.current_reload_time = self.gun_reload_time
+            self.start_reload = False
+
+    def eval_cast(self, cast):
+        opt = self.opt
+        self.cur_cast = cast
+        self.mana = min(self.mana, opt["mana_max"])
+        cast_node = {"name": f"Cast #{cast}", "children": [], "index": None}
+        self.root["children"].append(cast_node)
+        self.cur_node = cast_node["children"]
+
+        old_mana = self.mana
+        # _start_shot
+        state = dict(self.state_from_game)
+        self.c = state
+        self.shots.append((cast_node, state))
+        if self.first_shot:
+            self.order_deck()
+            self.current_reload_time = self.gun_reload_time
+            self.first_shot = False
+        # _draw_actions_for_shot(true)
+        self.draw_actions(self.actions_per_round, False)
+        state["reload_time"] = self.current_reload_time
+        self.handle_reload()
+        self.reloading = False
+
+        cast_delay = state["fire_rate_wait"]
+        if not isinstance(cast_delay, float):
+            raise FastEvalUnsupported("non-numeric cast delay")
+        recharge_time = 0.0
+        delay = cast_delay
+        self.handle_reload()
+        if self.reload_time_event is not None:
+            recharge_time = self.reload_time_event
+            delay = max(delay, self.reload_time_event)
+            self.reload_time_event = None
+        delay = max(delay, 1.0)
+        cast_node["extra"] = (f"CastDelay: {lua_tostring(cast_delay)}f, Recharge: {lua_tostring(recharge_time)}f, "
+                              f"Delay: {lua_tostring(delay)}f, ΔMana: {lua_tostring(old_mana - self.mana)}")
+        self.mana = self.mana + delay * opt["mana_charge"] / 60
+
+    def fold(self, node):
+        """renderer.lua 的 fold (折叠相同的相邻兄弟节点并合并 index)"""
+        node["count"] = 1
+        children = node["children"]
+        i = 0
+        last = ""
+        cur_c = 1
+        index_set = set()
+
+        def close_run(prev_node):
+            idx = prev_node["index"]
+            if isinstance(idx, list):
+                index_set.update(idx)
+            elif idx is not None:
+                index_set.add(idx)
+            prev_node["count"] = cur_c
+            prev_node["index"] = sorted(index_set)
+            index_set.clear()
+
+        while i < len(children):
+            child = children[i]
+            self.fold(child)
+            cur = self._make_text(child)
+            if last == cur and cur is not False:
+                idx = child["index"]
+                if isinstance(idx, list):
+                    index_set.update(idx)
+                elif idx is not None:
+                    index_set.add(idx)
+                cur_c += 1
+                del children[i]
+            else:
+                last = cur
+                if i != 0:
+                    close_run(children[i - 1])
+                    cur_c = 1
+                i += 1
+        if i != 0:
+            close_run(children[i - 1])
+
+    def _make_text(self, node):
+        if node.get("shot"):
+            return False
+        parts = [f"{node.get('count', 1)} {node['name']} ["]
+        for child in node["children"]:
+            text = self._make_text(child)
+            if text is False:
+                return False
+            parts.append(text)
+        parts.append("]")
+        return "".join(parts)
+
+    def render_node(self, node, out):
+        out.append('{"name":"')
+        out.append(node["name"])
+        out.append('"')
+        if node.get("shot"):
+            out.append(',"shot_id":1')
+        out.append(',"count":')
+        out.append(str(node.get("count", 1)))
+        if node.get("extra"):
+            out.append(',"extra":"')
+            out.append(node["extra"])
+            out.append('"')
+        idx = node["index"]
+        if idx is None:
+            idx = []
+        elif not isinstance(idx, list):
+            idx = [idx]
+        out.append(',"index":[')
+        out.append(",".join(lua_tostring(float(v)) for v in idx))
+        out.append('],"children":[')
+        for k, child in enumerate(node["children"]):
+            if k:
+                out.append(",")
+            self.render_node(child, out)
+        out.append("]}")
+
+    def state_diff(self, state):
+        defaults = self.defaults
+        diff = {}
+        for key, val in state.items():
+            if not _lua_eq(defaults.get(key), val):
+                diff[key] = lua_tostring(val)
+        for key in ("action_name", "action_description", "action_id", "action_mana_drain",
+                    "action_draw_many_count", "action_type", "action_recursive"):
+            diff.pop(key, None)
+        for key in ("extra_entities", "game_effect_entities"):
+            if key not in diff:
+                continue
+            counted = {}
+            for entry in re.findall(r'[^,]+', diff[key]):
+                m = _FAST_XML_SUFFIX_RE.search(entry)
+                if not m:
+                    raise FastEvalUnsupported(f"{key} entry without xml suffix")
+                name = m.group()[1:-4]
+                counted[name] = counted.get(name, 0) + 1
+            # 多个不同条目在 Lua 里按 pairs 的顺序拼接，顺序不确定
+            if len(counted) > 1:
+                raise FastEvalUnsupported(f"multiple distinct {key}")
+            text = ", ".join(name + ("" if n == 1 else f" ×{n}") for name, n in counted.items())
+            if text:
+                diff[key] = text
+            else:
+                del diff[key]
+        return sorted(diff.items())
+
+    def render_cast(self, num, fold):
+        """
+        渲染第 num 轮 (从 0 开始) 的施法节点与射击状态，返回两个 JSON 字符串。
+        施法节点带有射击标记，根节点折叠时永远不会合并它们，所以逐轮折叠与整棵树折叠的结果一致。
+        """
+        cast_node, state = self.shots[num]
+        cast_node["shot"] = True
+        if fold:
+            # fold 会把与默认值完全相同的射击状态去掉并重新编号，编号冲突时 Lua 的结果依赖 pairs 顺序
+            if all(_lua_eq(self.defaults.get(k), v) for k, v in state.items()
+                   if k not in ("action_draw_many_count", "reload_time")):
+                raise FastEvalUnsupported("default shot state")
+            self.fold(cast_node)
+            cast_node["index"] = []
+
+        node_out = []
+        self.render_node(cast_node, node_out)
+        out = ['{"id":1,"cast":', str(num + 1), ',"stats":{']
+        diff = self.state_diff(state)
+        for i, (key, val) in enumerate(diff):
+            if i:
+                out.append(",")
+            out.append('"')
+            out.append(key)
+            out.append('":')
+            if re.fullmatch(r'(?i)\s*[-+]?(inf|nan).*', val) or '"' in val or "\\" in val:
+                raise FastEvalUnsupported(f"ambiguous stat value {val!r}")
+            out.append(val if _FAST_LUA_NUMBER_RE.fullmatch(val) else f'"{val}"')
+        out.append("}}")
+        return "".join(node_out), "".join(out)
+
+    @staticmethod
+    def render_counts(counts):
+        return "{" + ",".join(f'"{k}":{v}' for k, v in sorted(counts.items(), key=lambda kv: kv[0].encode())) + "}"
+
+    def render(self, fold):
+        casts = [self.render_cast(num, fold) for num in range(len(self.shots))]
+        out = ['{"tree":{"name":"Wand","count":1,"index":[],"children":[']
+        out.append(",".join(node for node, _ in casts))
+        out.append(']},"states":[')
+        out.append(",".join(state for _, state in casts))
+        out.append('],"counts":')
+        out.append(self.render_counts(self.counts))
+        out.append(',"cast_counts":{')
+        out.append(",".join(f'"{cast}":{self.render_counts(self.cast_counts[cast])}' for cast in sorted(self.cast_counts)))
+        out.append("}}")
+        return "".join(out).encode("utf-8")
+
+def fast_evaluate(data, active_mods=(), cancel=None, snapshot=None):
+    """
+    在进程内评估魔杖，返回与 wand_eval_tree -j 输出一致的字节串。
+    不支持的情况抛出 FastEvalUnsupported(原因)，被取消时抛出 EvalCancelled。
+    """
+    return run_fast_wand(data, active_mods, cancel, snapshot).render(fold=data.get("fold_nodes") != False)
+
+def run_fast_wand(data, active_mods=(), cancel=None, snapshot=None):
+    """执行全部施法轮次但不渲染，返回 _FastWandRun (参数扫描只需要每轮的汇总)"""
+    run = prepare_fast_run(data, active_mods, snapshot)
+    cast = 1
+    while cast <= run.opt["number_of_casts"]:
+        if cancel is not None and cancel.is_set():
+            raise EvalCancelled()
+        run.eval_cast(cast)
+        cast += 1
+    return run
+
+def prepare_fast_run(data, active_mods=(), snapshot=None):
+    """检查请求并构建尚未开始施法的 _FastWandRun，由调用方逐轮调用 eval_cast"""
+    if (snapshot or _SNAPSHOT).appends:
+        raise FastEvalUnsupported("mod appends")
+    if shuffle_seed_of(data) is not None:
+        raise FastEvalUnsupported("shuffle")
+    if any(isinstance(m, str) and m != "wand_sync" for m in active_mods):
+        raise FastEvalUnsupported("active mods")
+    sim = load_fast_eval_data()
+    if sim is None:
+        raise FastEvalUnsupported("simulator data unavailable")
+
+    unlimited = bool(data.get("unlimited_spells", True))
+    cards = []
+    for i, s in enumerate(data.get("spells", [])):
+        if not s:
+            continue
+        if not isinstance(s, str) or ":" in s:
+            raise FastEvalUnsupported("unsupported spell entry")
+        spell = sim["spells"].get(s.upper())
+        if spell is None:
+            raise FastEvalUnsupported(f"unknown spell {s}")
+        if spell.ops is None:
+            raise FastEvalUnsupported(f"spell {spell.id}")
+        if spell.max_uses is not None and (not unlimited or spell.never_unlimited):
+            raise FastEvalUnsupported(f"limited uses {spell.id}")
+        cards.append((float(i + 1), spell))
+    if not cards:
+        raise FastEvalUnsupported("no spells")
+
+    options = {
+        "spells_per_cast": _lua_number_arg(data.get("actions_per_round", 1)),
+        "mana": _lua_number_arg(data.get("mana_max", 100)),
+        "mana_max": _lua_number_arg(data.get("mana_max", 100)),
+        "mana_charge": _lua_number_arg(data.get("mana_charge_speed", 10)),
+        "reload_time": _lua_number_arg(data.get("reload_time", 0), integer=True),
+        "cast_delay": _lua_number_arg(data.get("fire_rate_wait", 0), integer=True),
+        "speed_multiplier": _lua_number_arg(data.get("speed_multiplier", 1.0)),
+        "spread_degrees": _lua_number_arg(data.get("spread_degrees", 0.0)),
+        "number_of_casts": _lua_number_arg(data.get("number_of_casts", 10), integer=True),
+    }
+    return _FastWandRun(cards, sim["defaults"], options)
+
+# ==== 树节点哈希合并 (DAG) ====
+# 评估结果里大量子树完全相同 (同一个法术在不同位置展开出相同的结构)。
+# 这里顺序扫描评估器输出的 JSON 文本，自底向上给每个子树分配编号，内容相同的子树只保存一次 (hash-consing)，
+# 不需要先把整棵树 json.loads 成 Python 对象。结果:
+#   {"tree_dag":{"root":根编号,"expanded_nodes":展开后的节点数,"nodes":[{...,"children":[子节点编号]}]},"states":...}
+# nodes 按后序排列 (子节点编号总是小于父节点)，按编号替换 children 即可无损还原出原来的树。
+_DAG_FIELDS = r'(?:"[^"\\]*(?:\\.[^"\\]*)*"|[^"{}\[\]]|\[[^\[\]{}"]*\])*'  # 节点自身的字段 (不含 children)
+_DAG_OPEN_RE = re.compile(r'\s*,?\s*\{(' + _DAG_FIELDS + r')(?:"children"\s*:\s*\[|\})')
+_DAG_CLOSE_RE = re.compile(r'\s*\](' + _DAG_FIELDS + r')\}')
+_DAG_TREE_RE = re.compile(r'\s*\{\s*"tree"\s*:')
+
+class TreeDagBuilder:
+    def __init__(self):
+        self.table = {}  # (字段原文, 子节点编号) -> 编号
+        self.nodes = []
+        self.expanded = 0
+
+    def intern(self, head, tail, children):
+        self.expanded += 1
+        key = (head, tail, tuple(children))
+        node_id = self.table.get(key)
+        if node_id is None:
+            # 只有第一次出现的子树才需要真正解析字段
+            fields = [part.strip().strip(",") for part in (head, tail)]
+            node = json.loads("{" + ",".join(part for part in fields if part) + "}")
+            node["children"] = children
+            node_id = len(self.nodes)
+            self.nodes.append(node)
+            self.table[key] = node_id
+        return node_id
+
+def tree_to_dag(text, pos=0):
+    """从 text[pos] 处的节点对象开始读取整棵树，返回 (TreeDagBuilder, 根编号, 树结束后的位置)"""
+    builder = TreeDagBuilder()
+    open_node = _DAG_OPEN_RE.match
+    close_node = _DAG_CLOSE_RE.match
+    stack = []  # [(字段原文, 子节点编号)]
+    while True:
+        m = open_node(text, pos)
+        if m:
+            pos = m.end()
+            if text[pos - 1] == "[":
+                stack.append((m.group(1), []))
+                continue
+            node_id = builder.intern(m.group(1), "", [])  # 没有 children 字段的节点
+        else:
+            m = close_node(text, pos)
+            if not m or not stack:
+                raise ValueError(f"Malformed tree at {pos}")
+            pos = m.end()
+            head, children = stack.pop()
+            node_id = builder.intern(head, m.group(1), children)
+        if not stack:
+            return builder, node_id, pos
+        stack[-1][1].append(node_id)
+
+def output_to_dag(raw):
+    """解析评估器输出 ({"tree":...,"states":...})，返回 (TreeDagBuilder, 根编号, tree 之后的剩余文本)"""
+    text = raw.decode("utf-8")
+    m = _DAG_TREE_RE.match(text)
+    if not m:
+        raise ValueError("Evaluator output does not start with a tree")
+    with trace_span("tree_dag"):
+        builder, root, end = tree_to_dag(text, m.end())
+    metrics.observe("twwe_tree_dag_ratio", len(builder.nodes) / max(builder.expanded, 1))
+    return builder, root, text[end:]
+
+class UnfoldedTreeTooLarge(Exception):
+    """未折叠的树展开后超过 EVAL_UNFOLDED_MAX_NODES，浏览器无法渲染"""
+
+def unfolded_too_large_response():
+    return jsonify({
+        "success": False,
+        "error": "结果数据过大 (超过 {:.1f}MB)，浏览器无法在‘未开启折叠’的情况下渲染。".format(EVAL_UNFOLDED_LIMIT_MB),
+        "details": "检测到数百万级法术递归，请在右侧设置中开启‘合并完全一致的节点’后再进行评估。"
+    }), 400
+
+def tree_dag_payload(raw, max_expanded=0):
+    """把评估器输出中的 tree 换成 tree_dag，其余部分原样保留；max_expanded > 0 时展开后的节点数不能超过它"""
+    builder, root, rest = output_to_dag(raw)
+    if max_expanded > 0 and builder.expanded > max_expanded:
+        raise UnfoldedTreeTooLarge(f"{builder.expanded} nodes")
+    nodes = json.dumps(builder.nodes, ensure_ascii=False, separators=(",", ":"))
+    head = f'{{"tree_dag":{{"root":{root},"expanded_nodes":{builder.expanded},"nodes":'
+    return (head + nodes + "}" + rest).encode("utf-8")
+
+# ==== 服务端保存的评估结果 (按需展开) ====
+# tree_format: "lazy" 时评估结果以 DAG 形式留在服务端，响应里只有树的前几层；
+# 更深的节点带 child_count / subtree_nodes，用户展开时再通过 /api/evaluate/<id>/node/<路径> 获取。
+# 存储有总大小上限，按最近使用淘汰，超过 TTL 未访问的结果也会被清理；同一插槽的新结果会替换旧结果。
+RESULT_STORE_TTL_SEC = float(os.environ.get("TWWE_RESULT_TTL", 600))
+RESULT_STORE_MAX_MB = float(os.environ.get("TWWE_RESULT_STORE_MB", 256))
+RESULT_DEFAULT_DEPTH = 3
+RESULT_MAX_DEPTH = 64
+RESULT_MAX_NODES = int(os.environ.get("TWWE_RESULT_MAX_NODES", 5000))
+
+class ResultTooLarge(Exception):
+    """单个结果就超过了结果存储的总大小上限"""
+
+class EvalResultStore:
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = Lock()
+        self._entries = OrderedDict()  # result_id -> entry，按最近使用排序
+        self._by_owner = {}            # proc_key -> result_id
+        self._bytes = 0
+        self.evicted_total = 0
+
+    def _drop(self, result_id):
+        entry = self._entries.pop(result_id, None)
+        if entry:
+            self._bytes -= entry["bytes"]
+            if self._by_owner.get(entry["owner"]) == result_id:
+                del self._by_owner[entry["owner"]]
+        return entry
+
+    def _expire(self, now, keep=None):
+        while self._entries:
+            result_id, entry = next(iter(self._entries.items()))
+            if result_id == keep:
+                break
+            if now - entry["accessed"] <= self.ttl and self._bytes <= self.max_bytes:
+                break
+            self._drop(result_id)
+            self.evicted_total += 1
+
+    def put(self, owner, builder, root):
+        """保存结果，返回 (result_id, entry)。刚放入的结果不会被这次淘汰清理掉"""
+        nodes = builder.nodes
+        # 每个节点展开后的子树大小 (nodes 按后序排列，子节点总是先算好)
+        sizes = [0] * len(nodes)
+        for i, node in enumerate(nodes):
+            sizes[i] = 1 + sum(sizes[c] for c in node["children"])
+        entry = {
+            "nodes": nodes,
+            "sizes": sizes,
+            "root": root,
+            "owner": owner,
+            "accessed": time.time(),
+            "bytes": sum(len(n) * 64 + len(n["children"]) * 8 for n in nodes),
+        }
+        if entry["bytes"] > self.max_bytes:
+            raise ResultTooLarge(
+                f"结果约 {entry['bytes'] / (1024 * 1024):.1f}MB，超过服务端结果存储上限 "
+                f"({self.max_bytes / (1024 * 1024):.0f}MB, TWWE_RESULT_STORE_MB)")
+        result_id = uuid.uuid4().hex
+        with self._lock:
+            old_id = self._by_owner.get(owner)
+            if old_id:
+                self._drop(old_id)
+            self._entries[result_id] = entry
+            self._by_owner[owner] = result_id
+            self._bytes += entry["bytes"]
+            self._expire(entry["accessed"], keep=result_id)
+        return result_id, entry
+
+    def get(self, result_id):
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(result_id)
+            if entry:
+                entry["accessed"] = now
+                self._entries.move_to_end(result_id)
+            return entry
+
+    def stats(self):
+        with self._lock:
+            return {"count": len(self._entries), "bytes": self._bytes, "evicted_total": self.evicted_total}
+
+result_store = EvalResultStore(RESULT_STORE_MAX_MB * 1024 * 1024, RESULT_STORE_TTL_SEC)
+
+def render_lazy_node(entry, node_id, depth, offset=0):
+    """
+    展开 depth 层子节点，更深的只给出数量 (children 为空，truncated 为 true)。
+    DAG 展开后可能是指数级的，所以按层展开并且每次最多返回 RESULT_MAX_NODES 个节点。
+    预算用完时剩下的节点同样标记为 truncated，由前端继续按路径获取；子节点只返回了一部分的节点
+    带 next_offset，用 ?offset= 获取之后的子节点。offset 只作用于 node_id 本身的子节点列表。
+    """
+    nodes = entry["nodes"]
+    sizes = entry["sizes"]
+
+    def render(node_id):
+        node = nodes[node_id]
+        out = {k: v for k, v in node.items() if k != "children"}
+        out["child_count"] = len(node["children"])
+        out["subtree_nodes"] = sizes[node_id]
+        out["children"] = []
+        out["truncated"] = bool(node["children"])
+        return out
+
+    root = render(node_id)
+    if offset:
+        root["offset"] = offset
+    budget = RESULT_MAX_NODES - 1
+    pending = deque([(root, node_id, depth, offset)])
+    while pending and budget > 0:
+        out, node_id, depth, start = pending.popleft()
+        children = nodes[node_id]["children"][start:]
+        if depth <= 0 or not children:
+            continue
+        page = children[:budget]
+        budget -= len(page)
+        out["truncated"] = len(page) < len(children)
+        if out["truncated"]:
+            out["next_offset"] = start + len(page)
+        for c in page:
+            child = render(c)
+            out["children"].append(child)
+            pending.append((child, c, depth - 1, 0))
+    return root
+
+def lazy_result_payload(raw, owner, depth):
+    """保存评估结果并返回只包含前 depth 层的响应体 (data 部分)"""
+    builder, root, rest = output_to_dag(raw)
+    result_id, entry = result_store.put(owner, builder, root)
+    top = json.dumps(render_lazy_node(entry, root, depth), ensure_ascii=False, separators=(",", ":"))
+    return f'{{"result_id":"{result_id}","tree":{top}{rest}'.encode("utf-8")
+
+@app.route("/api/evaluate/<result_id>/node", defaults={"path": ""})
+@app.route("/api/evaluate/<result_id>/node/<path:path>")
+def get_result_node(result_id, path):
+    """
+    path 为从根节点开始的子节点下标，用 / 分隔 (例如 0/3/1 是根的第 1 个子节点的第 4 个子节点的第 2 个子节点)。
+    ?depth=N 控制返回几层子节点 (默认 RESULT_DEFAULT_DEPTH)；?offset=N 从该节点的第 N 个子节点开始返回 (见 next_offset)。
+    """
+    entry = result_store.get(result_id)
+    if entry is None:
+        return jsonify({"success": False, "error": "Result expired or not found"}), 404
+    nodes = entry["nodes"]
+    node_id = entry["root"]
+    for part in filter(None, path.split("/")):
+        try:
+            node_id = nodes[node_id]["children"][int(part)]
+        except (ValueError, IndexError):
+            return jsonify({"success": False, "error": f"Invalid node path: {path}"}), 404
+    depth = _int_arg("depth", RESULT_DEFAULT_DEPTH, minimum=0, maximum=RESULT_MAX_DEPTH)
+    offset = _int_arg("offset", 0, minimum=0)
+    node = render_lazy_node(entry, node_id, depth, offset)
+    return jsonify({"success": True, "path": path, "node": node})
+
+def format_tree_output(raw, data, proc_key):
+    if data.get("tree_format") == "lazy":
+        try:
+            depth = min(max(int(data.get("depth", RESULT_DEFAULT_DEPTH)), 0), RESULT_MAX_DEPTH)
+        except (TypeError, ValueError):
+            depth = RESULT_DEFAULT_DEPTH
+        return lazy_result_payload(raw, proc_key, depth)
+    # 客户端会把未折叠的 DAG 还原成完整的树再渲染
+    return tree_dag_payload(raw, EVAL_UNFOLDED_MAX_NODES if data.get("fold_nodes") == False else 0)
+
+def eval_output_limit(folded):
+    """评估输出上限 (MB)。未折叠的结果超过 EVAL_UNFOLDED_LIMIT_MB 时浏览器必死无疑，没必要继续读下去"""
+    if folded or EVAL_UNFOLDED_LIMIT_MB <= 0:
+        return EVAL_OUTPUT_LIMIT_MB
+    if EVAL_OUTPUT_LIMIT_MB <= 0:
+        return EVAL_UNFOLDED_LIMIT_MB
+    return min(EVAL_OUTPUT_LIMIT_MB, EVAL_UNFOLDED_LIMIT_MB)
+
+@app.route("/api/evaluate", methods=["POST"])
+def evaluate_wand():
+    data = request.get_json()
+    
+    # 获取标识符，用于管理该插槽的进程
+    tab_id = data.get("tab_id", "default")
+    slot_id = data.get("slot_id", "1")
+    proc_key = f"{tab_id}-{slot_id}"
+
+    if not data.get("spells", []):
+        return jsonify({"success": False, "error": "No spells to evaluate"})
+
+    # 逐轮流式返回 (NDJSON)
+    if data.get("stream") or "application/x-ndjson" in request.headers.get("Accept", ""):
+        return stream_evaluation(data, proc_key)
+
+    # 整个评估使用同一个法术库快照
+    snapshot = get_snapshot()
+    # /api/evaluate/cancel 或客户端断开时终止本次评估
+    with cancellable([proc_key]) as cancel:
+        response = app.make_response(_evaluate_wand(data, proc_key, cancel, snapshot))
+    response.headers["X-TWWE-Snapshot"] = str(snapshot.version)
+    return response
+
+def _evaluate_wand(data, proc_key, cancel, snapshot):
+    fold_nodes = data.get("fold_nodes", True)
+    auto_fold = data.get("auto_fold", EVAL_AUTO_FOLD)
+    # tree_format: "dag" 时把树里完全相同的子树合并后返回，未折叠的结果改为按展开后的节点数 (EVAL_UNFOLDED_MAX_NODES) 限制；
+    # "lazy" 时结果留在服务端，只返回前 depth 层 (见 lazy_result_payload)
+    tree_format = data.get("tree_format")
+    tree_dag = tree_format in ("dag", "lazy")
+
+    # engine: auto (默认，先尝试进程内快速评估) / lua (强制 LuaJIT) / fast (只用快速评估)
+    engine = data.get("engine", "auto")
+    active_mods = None
+    if FAST_EVAL_ENABLED and engine != "lua":
+        active_mods = get_active_mods(snapshot)
+        try:
+            with trace_span("fast_eval"):
+                fast_out = fast_evaluate(data, active_mods, cancel, snapshot)
+            limit_mb = eval_output_limit(fold_nodes != False or tree_dag)
+            if limit_mb > 0 and len(fast_out) > limit_mb * 1024 * 1024:
+                raise FastEvalUnsupported("output limit")
+        except EvalCancelled:
+            return jsonify({"success": False, "error": "Cancelled"}), 200
+        except Exception as e:
+            metrics.inc("twwe_fast_eval_total", result="fallback")
+            if not isinstance(e, FastEvalUnsupported):
+                import traceback
+                traceback.print_exc()
+            print(f"[FastEval] Falling back to LuaJIT: {e}")
+            if engine == "fast":
+                return jsonify({"success": False, "error": "Wand not supported by the fast evaluator", "details": str(e)}), 422
+        else:
+            metrics.inc("twwe_fast_eval_total", result="hit")
+            # 与 Lua 路径一致：新的评估顶替同插槽仍在运行的旧进程
+            eval_supervisor.kill_key(proc_key, "superseded")
+            metrics.observe("twwe_eval_output_bytes", len(fast_out))
+            if tree_dag:
+                try:
+                    fast_out = format_tree_output(fast_out, data, proc_key)
+                except ResultTooLarge as e:
+                    return jsonify({"success": False, "error": str(e), "details": "请改用 tree_format: dag 或开启折叠后再评估。"}), 413
+                except UnfoldedTreeTooLarge as e:
+                    print(f"[Eval] Unfolded tree too large for the browser: {e}")
+                    return unfolded_too_large_response()
+                except Exception as e:
+                    import traceback
+                    traceback.print_exc()
+                    return jsonify({"success": False, "error": "Failed to format evaluator output", "details": str(e)}), 500
+            response = app.response_class(
+                response=b'{"success":true,"data":' + fast_out + b'}',
+                status=200,
+                mimetype='application/json'
+            )
+            response.headers["X-TWWE-Engine"] = "fast"
+            return response
+
+    with trace_span("build_command"):
+        cmd = build_eval_command(data, active_mods, snapshot)
+    if cmd is None:
         return jsonify({"success": False, "error": "No spells selected for evaluation"})
 
     print(f"[Eval] Executing in {WAND_EVAL_DIR}")
     print(f"[Eval] Command: {' '.join(cmd)}")
 
     try:
-        # 管理旧进程：如果该位置已有进程在运行，先杀掉它释放内存
-        with process_lock:
-            if proc_key in active_processes:
-                try:
-                    old_proc = active_processes[proc_key]
-                    if old_proc.poll() is None: # 仍在运行
-                        print(f"[Eval] Terminating stale process for {proc_key}")
-                        old_proc.terminate()
-                        # 不等待 wait，防止阻塞当前线程
-                except Exception as e:
-                    print(f"[Eval] Error terminating process: {e}")
-                del active_processes[proc_key]
-
-        # 启动新进程
-        proc = subprocess.Popen(
-            cmd, 
-            cwd=WAND_EVAL_DIR, 
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=False
-        )
-        
-        with process_lock:
-            active_processes[proc_key] = proc
+        auto_folded = False
+        env = eval_env(data)
+        result = run_evaluator(cmd, proc_key, eval_output_limit(fold_nodes or tree_dag), env, cancel)
 
-        try:
-            # 等待结果，设置合理超时（针对超大规模递归）
-            stdout, stderr = proc.communicate(timeout=60)
-        except subprocess.TimeoutExpired:
-            proc.kill()
+        # 触发资源限制且用户关闭了折叠：自动开启折叠重新评估一次
+        if result["status"] == "limit" and not fold_nodes and auto_fold and "-f" in cmd:
+            print(f"[Eval] {result['limit']} limit hit with folding disabled, retrying with folding enabled")
+            cmd = [arg for arg in cmd if arg != "-f"]
+            result = run_evaluator(cmd, proc_key, eval_output_limit(True), env, cancel)
+            auto_folded = True
+
+        if result["status"] == "timeout":
             return jsonify({"success": False, "error": "Evaluation timeout"}), 504
-        finally:
-            with process_lock:
-                if proc_key in active_processes and active_processes[proc_key] == proc:
-                    del active_processes[proc_key]
 
-        if proc.returncode != 0:
-            # 如果是被 terminate 杀掉的，returncode 通常是负数 (-15)
-            if proc.returncode < 0:
-                return jsonify({"success": False, "error": "Cancelled"}), 200
-            
+        if result["status"] == "cancelled":
+            return jsonify({"success": False, "error": "Cancelled"}), 200
+
+        if result["status"] == "limit":
+            limit_desc = {
+                "output": f"输出大小 ({result['bytes'] / (1024 * 1024):.1f}MB+)",
+                "memory": f"内存 ({EVAL_MEMORY_LIMIT_MB}MB)",
+                "cpu": f"CPU 时间 ({EVAL_CPU_LIMIT_SEC}s)",
+            }.get(result["limit"], result["limit"])
+            print(f"[Eval] Aborted: {result['limit']} limit exceeded")
+            if result["limit"] == "output" and not fold_nodes and not auto_folded and not tree_dag:
+                return unfolded_too_large_response()
+            return jsonify({
+                "success": False,
+                "error": f"评估超出资源限制: {limit_desc}",
+                "limit": result["limit"],
+                "details": "该魔杖的递归规模过大，请减少模拟轮数或开启‘合并完全一致的节点’。"
+            }), 400
+
+        if result["status"] == "failed":
+            stderr = result["stderr"]
             err_msg = stderr.decode("utf-8", "replace") if stderr else "Unknown error"
-            print(f"[Eval] Failed with return code {proc.returncode}")
+            print(f"[Eval] Failed with return code {result['returncode']}")
             print(f"[Eval] Lua Error: {err_msg}") # 打印具体的 Lua 报错
             return jsonify({
                 "success": False, 
@@ -1074,31 +4801,38 @@ def evaluate_wand():
                 "details": err_msg
             }), 500
         
+        stdout = result["stdout"]
         # 解析返回的 JSON
         try:
             # 性能优化：直接返回字节流，避免 Python 层的 JSON 解析与二次序列化
             if stdout:
                 size_mb = len(stdout) / (1024 * 1024)
-                
-                # 安全护栏：如果数据量巨大（超过 15MB）且用户关闭了折叠，
-                # 浏览器必死无疑，此时应拒绝传输并提醒用户开启折叠。
-                if size_mb > 15 and not data.get("fold_nodes", True):
-                    return jsonify({
-                        "success": False,
-                        "error": "结果数据过大 ({:.1f}MB)，浏览器无法在‘未开启折叠’的情况下渲染。".format(size_mb),
-                        "details": "检测到数百万级法术递归，请在右侧设置中开启‘合并完全一致的节点’后再进行评估。"
-                    }), 400
-
-                if size_mb > 20:
+
+                if tree_dag:
+                    stdout = format_tree_output(stdout, data, proc_key)
+                    print(f"[Eval] Tree folded into a DAG ({tree_format}): {size_mb:.1f} MB -> {len(stdout) / (1024 * 1024):.1f} MB")
+                elif size_mb > 20:
                     print(f"[Eval] Warning: Huge result detected ({size_mb:.1f} MB). Rendering in browser may be slow.")
                 
-                return app.response_class(
-                    response=b'{"success":true,"data":' + stdout + b'}',
+                t_respond = time.perf_counter()
+                prefix = b'{"success":true,"auto_folded":true,"data":' if auto_folded else b'{"success":true,"data":'
+                response = app.response_class(
+                    response=prefix + stdout + b'}',
                     status=200,
                     mimetype='application/json'
                 )
+                # 响应体写完 (连接关闭) 时记录传输耗时
+                t_ready = time.perf_counter()
+                trace_add("respond", t_ready - t_respond)
+                response.call_on_close(lambda: metrics.observe("twwe_eval_transfer_seconds", time.perf_counter() - t_ready))
+                return response
             else:
                 return jsonify({"success": False, "error": "Empty output from evaluator"}), 500
+        except ResultTooLarge as e:
+            return jsonify({"success": False, "error": str(e), "details": "请改用 tree_format: dag 或开启折叠后再评估。"}), 413
+        except UnfoldedTreeTooLarge as e:
+            print(f"[Eval] Unfolded tree too large for the browser: {e}")
+            return unfolded_too_large_response()
         except Exception as je:
             print(f"[Eval] JSON parse error: {je}")
             # stdout 已经是字节流，需要解码才能打印
@@ -1115,19 +4849,726 @@ def evaluate_wand():
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
 
+# ==== 逐轮流式评估 ====
+# /api/evaluate 请求带 "stream": true (或 Accept: application/x-ndjson) 时，每算完一轮施法就输出一行 NDJSON:
+#   {"type":"start","casts":N}
+#   {"type":"cast","cast":k,"engine":"fast|lua","node":{施法节点},"states":[该轮的射击状态],"counts":{该轮法术计数}}
+#   {"type":"done","casts":已输出轮数,"counts":{总计数}} 或 {"type":"error",...}
+# 把各轮的 node 依次放进 {"name":"Wand","count":1,"index":[],"children":[...]} 即得到与普通请求相同的结果。
+# 快速评估按需逐轮计算，客户端看够了直接断开连接，后面的轮次就不会再算。
+# 中途遇到快速评估不支持的情况时改用 LuaJIT 完整评估一次，从下一轮接着输出 (两种引擎的结果逐字节一致)。
+
+def _ndjson(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+def _lua_cast_lines(data, proc_key, active_mods, first_cast, cancel=None, snapshot=None):
+    """用 LuaJIT 完整评估后按轮拆分，只输出 first_cast 及之后的轮次"""
+    fold_nodes = data.get("fold_nodes", True)
+    cmd = build_eval_command(data, active_mods, snapshot)
+    if cmd is None:
+        yield _ndjson({"type": "error", "error": "No spells selected for evaluation"})
+        return
+    env = eval_env(data)
+    auto_folded = False
+    result = run_evaluator(cmd, proc_key, eval_output_limit(fold_nodes), env, cancel)
+    if result["status"] == "limit" and not fold_nodes and data.get("auto_fold", EVAL_AUTO_FOLD) and "-f" in cmd:
+        cmd = [arg for arg in cmd if arg != "-f"]
+        result = run_evaluator(cmd, proc_key, eval_output_limit(True), env, cancel)
+        auto_folded = True
+    if result["status"] != "ok":
+        error = {"type": "error", "error": result.get("limit") or result["status"]}
+        if result["status"] == "failed":
+            error["details"] = result["stderr"].decode("utf-8", "replace")[:2000]
+        yield _ndjson(error)
+        return
+    try:
+        parsed = json.loads(result["stdout"])
+    except Exception as e:
+        yield _ndjson({"type": "error", "error": "Failed to parse evaluator output", "details": str(e)})
+        return
+
+    states = {}
+    for state in parsed.get("states", []):
+        states.setdefault(state.get("cast"), []).append(state)
+    cast_counts = parsed.get("cast_counts") or {}
+    casts = parsed["tree"]["children"]
+    for k, node in enumerate(casts, start=1):
+        if k < first_cast:
+            continue
+        yield _ndjson({
+            "type": "cast",
+            "cast": k,
+            "engine": "lua",
+            "node": node,
+            "states": states.get(k, []),
+            "counts": cast_counts.get(str(k), {}),
+        })
+    yield _ndjson({"type": "done", "casts": len(casts), "counts": parsed.get("counts", {}), "auto_folded": auto_folded})
+
+def stream_evaluation(data, proc_key):
+    engine = data.get("engine", "auto")
+    fold = data.get("fold_nodes") != False
+    snapshot = get_snapshot()
+    active_mods = get_active_mods(snapshot)
+    try:
+        number_of_casts = int(_lua_number_arg(data.get("number_of_casts", 10), integer=True))
+    except Exception:
+        number_of_casts = 10
+    # 生成器在请求上下文之外运行，断开检测需要的 environ 先取出来
+    environ = request.environ
+
+    def generate():
+        sent = 0
+        finished = False
+        guard = cancellable([proc_key], environ=environ)
+        cancel = guard.__enter__()
+        try:
+            yield _ndjson({"type": "start", "casts": number_of_casts, "snapshot": snapshot.version})
+            if FAST_EVAL_ENABLED and engine != "lua":
+                try:
+                    run = prepare_fast_run(data, active_mods, snapshot)
+                    # 与普通请求一致：新的评估顶替同插槽仍在运行的旧进程
+                    eval_supervisor.kill_key(proc_key, "superseded")
+                    limit_mb = eval_output_limit(fold)
+                    size = 0
+                    cast = 1
+                    while cast <= run.opt["number_of_casts"]:
+                        if cancel.is_set():
+                            raise EvalCancelled()
+                        run.eval_cast(cast)
+                        node, state = run.render_cast(cast - 1, fold)
+                        counts = run.render_counts(run.cast_counts.get(cast, {}))
+                        line = f'{{"type":"cast","cast":{cast},"engine":"fast","node":{node},"states":[{state}],"counts":{counts}}}\n'
+                        size += len(line)
+                        if limit_mb > 0 and size > limit_mb * 1024 * 1024:
+                            raise FastEvalUnsupported("output limit")
+                        yield line
+                        sent = cast
+                        cast += 1
+                    metrics.inc("twwe_fast_eval_total", result="hit")
+                    yield f'{{"type":"done","casts":{sent},"counts":{run.render_counts(run.counts)}}}\n'
+                    finished = True
+                    return
+                except EvalCancelled:
+                    yield _ndjson({"type": "error", "error": "Cancelled"})
+                    finished = True
+                    return
+                except Exception as e:
+                    metrics.inc("twwe_fast_eval_total", result="fallback")
+                    if not isinstance(e, FastEvalUnsupported):
+                        import traceback
+                        traceback.print_exc()
+                    print(f"[FastEval] Falling back to LuaJIT after {sent} streamed casts: {e}")
+                    if engine == "fast":
+                        yield _ndjson({"type": "error", "error": "Wand not supported by the fast evaluator", "details": str(e)})
+                        finished = True
+                        return
+            yield from _lua_cast_lines(data, proc_key, active_mods, sent + 1, cancel, snapshot)
+            finished = True
+        finally:
+            guard.__exit__(None, None, None)
+            if not finished:
+                # 客户端提前断开：停止本次请求还在运行的评估进程
+                guard.kill_started()
+                print(f"[Eval] Stream for {proc_key} closed by client after {sent} casts")
+
+    response = app.response_class(generate(), mimetype="application/x-ndjson")
+    response.headers["X-Accel-Buffering"] = "no"
+    response.headers["X-TWWE-Snapshot"] = str(snapshot.version)
+    return response
+
+# ==== 参数扫描评估 ====
+# 同一个法术列表在一组法杖参数网格上批量评估，逐点以 NDJSON 流式返回汇总指标 (不返回完整的树)。
+# 能走快速评估的点直接在进程内完成，其余点在线程池里并行启动 LuaJIT。
+SWEEP_PARAMS = ("actions_per_round", "mana_max", "mana_charge_speed", "reload_time", "fire_rate_wait")
+SWEEP_MAX_POINTS = int(os.environ.get("TWWE_SWEEP_MAX_POINTS", 2000))
+SWEEP_WORKERS = int(os.environ.get("TWWE_SWEEP_WORKERS", min(8, os.cpu_count() or 2)))
+
+_CAST_EXTRA_RE = re.compile(r'CastDelay: (\S+)f, Recharge: (\S+)f, Delay: (\S+)f, ΔMana: (\S+)')
+
+_EVAL_POOL = None
+_EVAL_POOL_LOCK = Lock()
+
+def get_eval_pool():
+    """参数扫描与蒙特卡洛评估共用一个常驻线程池，同时运行的 luajit 进程数也由它限制"""
+    global _EVAL_POOL
+    with _EVAL_POOL_LOCK:
+        if _EVAL_POOL is None:
+            _EVAL_POOL = ThreadPoolExecutor(max_workers=max(1, SWEEP_WORKERS), thread_name_prefix="EvalPool")
+        return _EVAL_POOL
+
+def _sweep_values(name, spec):
+    """参数取值: 单个数字、数字列表，或 {"start", "stop", "step"} (包含 stop)"""
+    if isinstance(spec, dict):
+        start = spec.get("start")
+        stop = spec.get("stop", start)
+        step = spec.get("step", 1)
+        if not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in (start, stop, step)):
+            raise ValueError(f"{name}: start/stop/step must be numbers")
+        if step == 0 or (stop - start) * step < 0:
+            raise ValueError(f"{name}: step does not reach stop")
+        count = int(math.floor((stop - start) / step + 1e-9)) + 1
+        if count > SWEEP_MAX_POINTS:
+            raise ValueError(f"{name}: more than {SWEEP_MAX_POINTS} values")
+        if all(isinstance(v, int) for v in (start, step)):
+            return [start + i * step for i in range(count)]
+        return [round(start + i * step, 10) for i in range(count)]
+    values = spec if isinstance(spec, list) else [spec]
+    if not values:
+        raise ValueError(f"{name}: no values")
+    for v in values:
+        if not isinstance(v, (int, float)) or isinstance(v, bool) or not math.isfinite(v):
+            raise ValueError(f"{name}: values must be finite numbers")
+    return values
+
+def build_sweep_grid(sweep):
+    """返回 (参数名列表, [取值元组, ...])，按 SWEEP_PARAMS 的顺序做笛卡尔积"""
+    if not isinstance(sweep, dict) or not sweep:
+        raise ValueError("sweep must map parameter names to values")
+    unknown = sorted(set(sweep) - set(SWEEP_PARAMS))
+    if unknown:
+        raise ValueError(f"Unsupported sweep parameters: {', '.join(unknown)}")
+    names = [name for name in SWEEP_PARAMS if name in sweep]
+    axes = [_sweep_values(name, sweep[name]) for name in names]
+    total = 1
+    for axis in axes:
+        total *= len(axis)
+    if total > SWEEP_MAX_POINTS:
+        raise ValueError(f"Sweep has {total} points, the limit is {SWEEP_MAX_POINTS}")
+    return names, list(itertools.product(*axes))
+
+def _lua_float(text):
+    try:
+        return float(text)
+    except ValueError:
+        return float("nan")
+
+def summarize_casts(cast_nodes, cast_counts):
+    """
+    由每轮施法节点上的 extra (CastDelay/Recharge/Delay/ΔMana) 与 cast_counts 计算汇总指标。
+    两种评估引擎的输出都带有这些信息，所以汇总结果与引擎无关。
+    """
+    delays = []
+    cast_delays = []
+    recharges = []
+    mana = []
+    for node in cast_nodes:
+        m = _CAST_EXTRA_RE.match(node.get("extra") or "")
+        if not m:
+            continue
+        cast_delay, recharge, delay, mana_used = (_lua_float(v) for v in m.groups())
+        cast_delays.append(cast_delay)
+        recharges.append(recharge)
+        delays.append(delay)
+        mana.append(mana_used)
+
+    casts = len(delays)
+    spells = [sum(cast_counts.get(str(i + 1), cast_counts.get(i + 1, {})).values()) for i in range(casts)]
+    frames = sum(delays, 0.0)
+
+    def avg(values):
+        return round(sum(values, 0.0) / len(values), 4) if values else 0.0
+
+    return {
+        "casts": casts,
+        "frames": round(frames, 4),
+        "casts_per_second": round(casts * 60 / frames, 4) if frames > 0 else None,
+        "cast_delay_avg": avg(cast_delays),
+        "recharge_total": round(sum(recharges, 0.0), 4),
+        "mana_per_cast_avg": avg(mana),
+        "mana_per_cast_max": round(max(mana), 4) if mana else 0.0,
+        "spells_per_cast_avg": avg(spells),
+        "empty_casts": sum(1 for n in spells if n == 0),
+    }
+
+def _evaluate_sweep_point(data, engine, active_mods, proc_key, cancel, snapshot):
+    if cancel.is_set():
+        return {"error": "Cancelled"}
+    t0 = time.perf_counter()
+    if FAST_EVAL_ENABLED and engine != "lua":
+        try:
+            run = run_fast_wand(data, active_mods, cancel, snapshot)
+        except EvalCancelled:
+            return {"error": "Cancelled"}
+        except Exception as e:
+            metrics.inc("twwe_fast_eval_total", result="fallback")
+            if not isinstance(e, FastEvalUnsupported):
+                import traceback
+                traceback.print_exc()
+            if engine == "fast":
+                return {"error": "Wand not supported by the fast evaluator", "details": str(e)}
+        else:
+            metrics.inc("twwe_fast_eval_total", result="hit")
+            summary = summarize_casts(run.root["children"], run.cast_counts)
+            return {"engine": "fast", "ms": round((time.perf_counter() - t0) * 1000, 3), "summary": summary}
+
+    cmd = build_eval_command(data, active_mods, snapshot)
+    if cmd is None:
+        return {"error": "No spells selected for evaluation"}
+    result = run_evaluator(cmd, proc_key, EVAL_OUTPUT_LIMIT_MB, eval_env(data), cancel)
+    if result["status"] != "ok":
+        error = {"error": result.get("limit") or result["status"]}
+        if result["status"] == "failed":
+            error["details"] = result["stderr"].decode("utf-8", "replace")[:2000]
+        return error
+    try:
+        parsed = json.loads(result["stdout"])
+        summary = summarize_casts(parsed["tree"]["children"], parsed.get("cast_counts") or {})
+    except Exception as e:
+        return {"error": "Failed to parse evaluator output", "details": str(e)}
+    return {"engine": "lua", "ms": round((time.perf_counter() - t0) * 1000, 3), "summary": summary}
+
+@app.route("/api/evaluate/sweep", methods=["POST"])
+def evaluate_sweep():
+    """
+    请求体与 /api/evaluate 相同，另加 "sweep": {"mana_max": [100, 200], "reload_time": {"start": 0, "stop": 30, "step": 5}, ...}
+    响应为 NDJSON: 先是一行 start，然后每完成一个点输出一行 point (按完成顺序，带 index)，最后一行 done。
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"success": False, "error": "Expected a JSON object"}), 400
+    if not data.get("spells", []):
+        return jsonify({"success": False, "error": "No spells to evaluate"}), 400
+    try:
+        names, points = build_sweep_grid(data.get("sweep"))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    engine = data.get("engine", "auto")
+    # 快照与活动模组只取一次，所有点共用 (每个点都去问游戏会把扫描拖慢一个数量级)
+    snapshot = get_snapshot()
+    active_mods = get_active_mods(snapshot)
+    base = {k: v for k, v in data.items() if k not in ("sweep", "tab_id", "slot_id")}
+    # 汇总只用到每轮施法节点，施法节点本身不会被折叠，所以总是开启折叠以减小 Lua 的输出
+    base["fold_nodes"] = True
+    sweep_id = uuid.uuid4().hex[:12]
+    cancel = Event()
+    futures = {}
+    # 生成器在请求上下文之外运行，断开检测需要的 environ 先取出来
+    environ = request.environ
+
+    def stop_points(reason="cancelled"):
+        # 取消尚未开始的点，并终止正在运行的 luajit
+        cancel.set()
+        for future, i in futures.items():
+            if not future.cancel():
+                eval_supervisor.kill_key(f"sweep-{sweep_id}-{i}", "cancelled")
+
+    def generate():
+        t_start = time.perf_counter()
+        failed = 0
+        done = 0
+        # 登记与提交都放在生成器里：响应没有被迭代时 (生成器从未开始) 不会留下登记或空跑的点
+        # 可以用 sweep_id 或发起请求的插槽取消
+        guard = cancellable([sweep_id, _slot_owner(data)], stop_points, environ=environ)
+        guard.__enter__()
+        try:
+            pool = get_eval_pool()
+            for i, values in enumerate(points):
+                point = dict(base, **dict(zip(names, values)))
+                future = pool.submit(_evaluate_sweep_point, point, engine, active_mods, f"sweep-{sweep_id}-{i}", cancel, snapshot)
+                futures[future] = i
+            print(f"[Sweep] {sweep_id}: {len(points)} points over {', '.join(names)}")
+            yield json.dumps({"type": "start", "sweep_id": sweep_id, "points": len(points), "params": names,
+                              "snapshot": snapshot.version}) + "\n"
+            for future in as_completed(futures):
+                if cancel.is_set():
+                    yield json.dumps({"type": "error", "error": "Cancelled", "points": done}) + "\n"
+                    break
+                i = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"error": str(e)}
+                done += 1
+                if "error" in result:
+                    failed += 1
+                metrics.inc("twwe_sweep_points_total", engine=result.get("engine", "error"))
+                line = {"type": "point", "index": i, "params": dict(zip(names, points[i]))}
+                line.update(result)
+                yield json.dumps(line) + "\n"
+            yield json.dumps({
+                "type": "done",
+                "points": len(points),
+                "failed": failed,
+                "elapsed_ms": round((time.perf_counter() - t_start) * 1000, 3),
+            }) + "\n"
+        finally:
+            guard.__exit__(None, None, None)
+            # 客户端断开时生成器被关闭
+            if done < len(points):
+                stop_points()
+                print(f"[Sweep] {sweep_id}: cancelled after {done}/{len(points)} points")
+
+    response = app.response_class(generate(), mimetype="application/x-ndjson")
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+# ==== 乱序魔杖蒙特卡洛评估 ====
+# 乱序魔杖的结果取决于洗牌顺序：用 N 个由同一个种子派生的 shuffle_seed 并行评估，汇总分布并给出几棵有代表性的树。
+MONTE_CARLO_MAX_RUNS = int(os.environ.get("TWWE_MONTE_CARLO_MAX_RUNS", 1000))
+MONTE_CARLO_MAX_BUDGET_SEC = float(os.environ.get("TWWE_MONTE_CARLO_MAX_BUDGET", 300))
+MONTE_CARLO_KEEP_BYTES = 64 * 1024 * 1024 # 保留候选代表树的原始输出总量上限
+PERCENTILES = (5, 25, 50, 75, 95)
+
+def percentiles(values, points=PERCENTILES):
+    """线性插值的百分位数 (与 numpy.percentile 默认方式一致)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    result = {}
+    for p in points:
+        pos = (len(ordered) - 1) * p / 100
+        lo = int(math.floor(pos))
+        hi = min(lo + 1, len(ordered) - 1)
+        result[f"p{p}"] = round(ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo), 4)
+    result["mean"] = round(sum(ordered, 0.0) / len(ordered), 4)
+    return result
+
+def _cast_rows(parsed):
+    """[(CastDelay, Recharge, Delay, ΔMana, {法术: 次数}), ...]，按施法轮次排列"""
+    rows = []
+    cast_counts = parsed.get("cast_counts") or {}
+    for i, node in enumerate(parsed["tree"]["children"]):
+        m = _CAST_EXTRA_RE.match(node.get("extra") or "")
+        if m:
+            rows.append(tuple(_lua_float(v) for v in m.groups()) + (cast_counts.get(str(i + 1), {}),))
+    return rows
+
+def _run_monte_carlo(data, index, seed, active_mods, proc_key, cancel, snapshot):
+    if cancel.is_set():
+        return {"error": "Cancelled"}
+    cmd = build_eval_command(data, active_mods, snapshot)
+    if cmd is None:
+        return {"error": "No spells selected for evaluation"}
+    result = run_evaluator(cmd, proc_key, EVAL_OUTPUT_LIMIT_MB, eval_env(dict(data, shuffle_seed=seed)), cancel)
+    if result["status"] != "ok":
+        error = {"error": result.get("limit") or result["status"]}
+        if result["status"] == "failed":
+            error["details"] = result["stderr"].decode("utf-8", "replace")[:2000]
+        return error
+    try:
+        parsed = json.loads(result["stdout"])
+        rows = _cast_rows(parsed)
+        summary = summarize_casts(parsed["tree"]["children"], parsed.get("cast_counts") or {})
+    except Exception as e:
+        return {"error": "Failed to parse evaluator output", "details": str(e)}
+    # 按每轮施法的法术组成区分不同的洗牌结果
+    signature = tuple(tuple(sorted(row[4].items())) for row in rows)
+    return {"index": index, "seed": seed, "parsed": parsed, "bytes": result["bytes"],
+            "rows": rows, "summary": summary, "signature": signature}
+
+@app.route("/api/evaluate/monte-carlo", methods=["POST"])
+def evaluate_monte_carlo():
+    """
+    请求体与 /api/evaluate 相同，另加:
+      runs: 评估次数 (默认 64)；seed: 基础种子 (省略时随机生成并在响应中返回)；
+      time_budget: 秒，到时未完成的评估会被取消并只汇总已完成的部分；representatives: 返回几棵代表树 (默认 3)
+    每次评估的 shuffle_seed 会随代表树一起返回，可以用 /api/evaluate 单独复现。
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"success": False, "error": "Expected a JSON object"}), 400
+    if not data.get("spells", []):
+        return jsonify({"success": False, "error": "No spells to evaluate"}), 400
+    try:
+        runs = int(data.get("runs", 64))
+        budget = float(data.get("time_budget", 30))
+        keep = int(data.get("representatives", 3))
+        base_seed = data.get("seed")
+        base_seed = random.SystemRandom().randrange(2 ** 31) if base_seed is None else int(base_seed)
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "runs, seed, time_budget and representatives must be numbers"}), 400
+    if not 1 <= runs <= MONTE_CARLO_MAX_RUNS:
+        return jsonify({"success": False, "error": f"runs must be between 1 and {MONTE_CARLO_MAX_RUNS}"}), 400
+    budget = min(max(budget, 0.1), MONTE_CARLO_MAX_BUDGET_SEC)
+    keep = min(max(keep, 0), 10)
+
+    # 同一个基础种子总是派生出同一组种子；派生种子相距很远，避免相邻种子的洗牌序列互相重叠
+    rng = random.Random(base_seed)
+    seeds = [rng.randrange(2 ** 31) for _ in range(runs)]
+    base = {k: v for k, v in data.items() if k not in ("runs", "seed", "time_budget", "representatives", "tab_id", "slot_id")}
+    base["shuffle_deck_when_empty"] = True
+    snapshot = get_snapshot()
+    active_mods = get_active_mods(snapshot)
+    mc_id = uuid.uuid4().hex[:12]
+    cancel = Event()
+    pool = get_eval_pool()
+    t_start = time.perf_counter()
+    futures = {pool.submit(_run_monte_carlo, base, i, seed, active_mods, f"mc-{mc_id}-{i}", cancel, snapshot): i
+               for i, seed in enumerate(seeds)}
+    print(f"[MonteCarlo] {mc_id}: {runs} runs, seed {base_seed}, budget {budget}s")
+
+    def stop_runs(reason="cancelled"):
+        cancel.set()
+        for future, i in futures.items():
+            if not future.cancel():
+                eval_supervisor.kill_key(f"mc-{mc_id}-{i}", "cancelled")
+
+    completed = []
+    errors = {}
+    groups = {} # 洗牌结果 -> {"count", "first", "data"}
+    kept_bytes = 0
+    timed_out = False
+    try:
+        with cancellable([mc_id, _slot_owner(data)], stop_runs):
+            for future in as_completed(futures, timeout=budget):
+                if cancel.is_set():
+                    break
+                result = future.result()
+                if "error" in result:
+                    errors[result["error"]] = errors.get(result["error"], 0) + 1
+                    metrics.inc("twwe_monte_carlo_runs_total", result="error")
+                    continue
+                metrics.inc("twwe_monte_carlo_runs_total", result="ok")
+                # 只为每种洗牌结果保留一棵树 (种子最小的那次)，其余的只留汇总数据
+                parsed = result.pop("parsed")
+                group = groups.setdefault(result["signature"], {"count": 0, "first": None, "data": None})
+                group["count"] += 1
+                if group["first"] is None or result["index"] < group["first"]["index"]:
+                    if group["data"] is None:
+                        if kept_bytes + result["bytes"] > MONTE_CARLO_KEEP_BYTES:
+                            parsed = None
+                        else:
+                            kept_bytes += result["bytes"]
+                    if parsed is not None:
+                        group["first"] = result
+                        group["data"] = parsed
+                completed.append(result)
+    except FuturesTimeoutError:
+        timed_out = True
+    finally:
+        if len(completed) + sum(errors.values()) < runs:
+            stop_runs()
+    elapsed = time.perf_counter() - t_start
+    if cancel.is_set() and not timed_out and len(completed) + sum(errors.values()) < runs:
+        print(f"[MonteCarlo] {mc_id}: cancelled after {len(completed)} runs")
+        return jsonify({"success": False, "error": "Cancelled", "seed": base_seed}), 200
+    if not completed:
+        return jsonify({
+            "success": False,
+            "error": "Evaluation timeout" if timed_out else "All runs failed",
+            "errors": errors,
+            "seed": base_seed,
+        }), 504 if timed_out else 500
+
+    # 按种子顺序汇总，结果与完成顺序无关
+    completed.sort(key=lambda r: r["index"])
+    n = len(completed)
+    casts = []
+    for c in range(max(len(r["rows"]) for r in completed)):
+        rows = [r["rows"][c] for r in completed if c < len(r["rows"])]
+        spell_totals = {}
+        spell_present = {}
+        for row in rows:
+            for spell, count in row[4].items():
+                spell_totals[spell] = spell_totals.get(spell, 0) + count
+                spell_present[spell] = spell_present.get(spell, 0) + 1
+        casts.append({
+            "cast": c + 1,
+            "spells": {
+                spell: {"mean": round(spell_totals[spell] / len(rows), 4), "probability": round(spell_present[spell] / len(rows), 4)}
+                for spell in sorted(spell_totals)
+            },
+            "cast_delay": percentiles([row[0] for row in rows]),
+            "recharge": percentiles([row[1] for row in rows]),
+            "delay": percentiles([row[2] for row in rows]),
+            "mana": percentiles([row[3] for row in rows]),
+        })
+
+    summaries = [r["summary"] for r in completed]
+    overall = {
+        "casts_per_second": percentiles([s["casts_per_second"] for s in summaries if s["casts_per_second"] is not None]),
+        "frames": percentiles([s["frames"] for s in summaries]),
+        "cast_delay": percentiles([row[0] for r in completed for row in r["rows"]]),
+        "mana_per_cast": percentiles([row[3] for r in completed for row in r["rows"]]),
+        "spells_per_cast": percentiles([s["spells_per_cast_avg"] for s in summaries]),
+    }
+
+    # 代表树：出现次数最多的几种洗牌结果，次数相同时按种子顺序
+    ranked = sorted((g for g in groups.values() if g["data"] is not None), key=lambda g: (-g["count"], g["first"]["index"]))
+    representatives = [
+        {"share": round(g["count"] / n, 4), "count": g["count"], "shuffle_seed": g["first"]["seed"], "data": g["data"]}
+        for g in ranked[:keep]
+    ]
+
+    return jsonify({
+        "success": True,
+        "seed": base_seed,
+        "snapshot": snapshot.version,
+        "runs": runs,
+        "completed": n,
+        "failed": errors,
+        "timed_out": timed_out,
+        "elapsed_ms": round(elapsed * 1000, 3),
+        "distinct_orderings": len(groups),
+        "casts": casts,
+        "overall": overall,
+        "representatives": representatives,
+    })
+
+# ==== 静态资源 (预压缩 + 内存缓存) ====
+# 前端构建产物与 /static_data 由这里统一提供：
+#   - 按 Accept-Encoding 返回 br / gzip 版本。构建时生成的同名 .br/.gz 文件优先，否则首次请求 (或启动预热) 时压缩一次并缓存
+#   - 小文件连同压缩版本常驻内存，总量受 STATIC_CACHE_MAX_MB 限制；大文件的原始内容仍通过 send_file 发送
+#   - 带哈希的 /assets/* 永久缓存 (immutable)，其余文件用 ETag 协商 (304)
+STATIC_CACHE_MAX_MB = float(os.environ.get("TWWE_STATIC_CACHE_MB", 64))
+STATIC_MEMORY_FILE_MAX = 1024 * 1024       # 不超过该大小的文件原样缓存在内存里
+STATIC_COMPRESS_MIN = 512                   # 太小的文件压缩不划算
+STATIC_COMPRESS_MAX = 32 * 1024 * 1024
+STATIC_COMPRESSIBLE = ("text/", "application/json", "application/javascript", "image/svg+xml", "application/wasm")
+_HASHED_ASSET_RE = re.compile(r'[-.][A-Za-z0-9_-]{8,}\.[A-Za-z0-9]+$')
+
+def _parse_accept_encoding(header):
+    """返回客户端接受的编码集合 (q=0 的视为不接受)"""
+    accepted = set()
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, val = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(val)
+                except ValueError:
+                    q = 0.0
+        if name and q > 0:
+            accepted.add(name.strip().lower())
+    return accepted
+
+class StaticFileCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._entries = {}  # 绝对路径 -> entry
+        self._bytes = 0
+
+    def _load(self, path, st):
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        entry = {
+            "key": (st.st_mtime_ns, st.st_size),
+            "mimetype": mimetype,
+            "etag": f"{st.st_mtime_ns:x}-{st.st_size:x}",
+            "data": None,
+            "variants": {},  # 编码 -> bytes
+            "bytes": 0,
+        }
+        raw = None
+        if st.st_size <= STATIC_MEMORY_FILE_MAX:
+            with open(path, "rb") as f:
+                raw = f.read()
+            entry["data"] = raw
+        if mimetype.startswith(STATIC_COMPRESSIBLE) and STATIC_COMPRESS_MIN <= st.st_size <= STATIC_COMPRESS_MAX:
+            for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+                if encoding == "br" and not HAS_BROTLI:
+                    continue
+                prebuilt = path + suffix
+                try:
+                    if os.stat(prebuilt).st_mtime_ns >= st.st_mtime_ns:
+                        with open(prebuilt, "rb") as f:
+                            entry["variants"][encoding] = f.read()
+                        continue
+                except OSError:
+                    pass
+                if raw is None:
+                    with open(path, "rb") as f:
+                        raw = f.read()
+                t0 = time.perf_counter()
+                if encoding == "br":
+                    compressed = brotli.compress(raw, quality=9)
+                else:
+                    compressed = gzip.compress(raw, compresslevel=9, mtime=0)
+                metrics.observe("twwe_static_compress_seconds", time.perf_counter() - t0, encoding=encoding)
+                if len(compressed) < len(raw):
+                    entry["variants"][encoding] = compressed
+        entry["bytes"] = len(entry["data"] or b"") + sum(len(v) for v in entry["variants"].values())
+        return entry
+
+    def get(self, path):
+        st = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None and entry["key"] == (st.st_mtime_ns, st.st_size):
+            record_cache("static_files", True)
+            return entry
+        record_cache("static_files", False)
+        entry = self._load(path, st)
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old:
+                self._bytes -= old["bytes"]
+            # 超出内存预算时不缓存内容，只保留元数据 (每次都从磁盘读取)
+            if self._bytes + entry["bytes"] <= self.max_bytes:
+                self._entries[path] = entry
+                self._bytes += entry["bytes"]
+            else:
+                entry = dict(entry, data=None)
+        return entry
+
+    def warm(self, root):
+        """启动时在后台预先读取并压缩可压缩的文件，避免第一次打开页面时现场压缩"""
+        count = 0
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                if name.endswith((".br", ".gz")):
+                    continue
+                path = os.path.join(dirpath, name)
+                if not (mimetypes.guess_type(path)[0] or "").startswith(STATIC_COMPRESSIBLE):
+                    continue
+                try:
+                    self.get(path)
+                    count += 1
+                except OSError:
+                    pass
+        print(f"[Static] Warmed {count} files ({self._bytes / (1024 * 1024):.1f} MB in memory)")
+
+static_cache = StaticFileCache(STATIC_CACHE_MAX_MB * 1024 * 1024)
+
+def serve_static(root, rel_path, immutable=False):
+    path = safe_join(root, rel_path)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    entry = static_cache.get(path)
+
+    accepted = _parse_accept_encoding(request.headers.get("Accept-Encoding"))
+    encoding = next((e for e in ("br", "gzip") if e in accepted and e in entry["variants"]), None)
+    etag = entry["etag"] + (f"-{encoding}" if encoding else "")
+    cache_control = "public, max-age=31536000, immutable" if immutable else "no-cache"
+
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    elif encoding:
+        response = app.response_class(entry["variants"][encoding], mimetype=entry["mimetype"])
+        response.headers["Content-Encoding"] = encoding
+    elif entry["data"] is not None:
+        response = app.response_class(entry["data"], mimetype=entry["mimetype"])
+    else:
+        response = send_file(path, mimetype=entry["mimetype"], conditional=False, etag=False)
+    response.headers["ETag"] = f'"{etag}"'
+    response.headers["Cache-Control"] = cache_control
+    if entry["variants"]:
+        response.headers["Vary"] = "Accept-Encoding"
+    return response
+
 @app.route("/")
 def index():
-    return send_from_directory(app.static_folder, "index.html")
+    return serve_static(app.static_folder, "index.html")
 
 @app.route("/assets/<path:path>")
 def send_assets(path):
-    return send_from_directory(os.path.join(app.static_folder, "assets"), path)
+    # vite 构建出的文件名带内容哈希，内容变了文件名也会变
+    return serve_static(os.path.join(app.static_folder, "assets"), path, immutable=bool(_HASHED_ASSET_RE.search(path)))
+
+@app.route("/static_data/<path:path>")
+def send_static_data(path):
+    return serve_static(os.path.join(app.static_folder, "static_data"), path)
 
 if __name__ == "__main__":
     is_frozen = getattr(sys, 'frozen', False)
     
     # 启动前清理旧进程，防止端口占用导致无法连接游戏或逻辑错误
     kill_existing_instance()
+    reset_shared_state()
 
     def open_browser():
         webbrowser.open_new("http://127.0.0.1:17471")
@@ -1136,6 +5577,9 @@ if __name__ == "__main__":
     if is_frozen and not os.environ.get("WERKZEUG_RUN_MAIN"):
         Timer(1.5, open_browser).start()
 
+    if os.path.isdir(app.static_folder):
+        Thread(target=static_cache.warm, args=(app.static_folder,), daemon=True).start()
+
     # 打包模式下必须关闭 debug，否则 reloader 会导致打包后的 EXE 运行异常（循环启动）
     # 开发模式下保持 debug=True
     app.run(host="0.0.0.0", port=17471, debug=not is_frozen)
@@ -0,0 +1,55 @@
+return {
+	{
+		item_name = "Bench trigger wand",
+		mana_max = 1200, mana_charge_speed = 420, reload_time = 18, fire_rate_wait = 4,
+		deck_capacity = 12, shuffle_deck_when_empty = false, spread_degrees = -3, speed_multiplier = 1.1,
+		actions_per_round = 1,
+		spells = {
+			spells = {
+				{ id = "LIGHT_BULLET_TRIGGER", uses_remaining = -1 },
+				{ id = "DAMAGE", uses_remaining = -1 },
+				{ id = "BURST_3", uses_remaining = -1 },
+				{ id = "LIGHT_BULLET", uses_remaining = -1 },
+				{ id = "nil" },
+				{ id = "CHAINSAW", uses_remaining = -1 },
+				{ id = "BLACK_HOLE", uses_remaining = 3 },
+			},
+			always = {
+				{ id = "HOMING" },
+			},
+		},
+	},
+	{
+		item_name = "Bench divide wand",
+		mana_max = 3000, mana_charge_speed = 900, reload_time = 40, fire_rate_wait = 10,
+		deck_capacity = 8, shuffle_deck_when_empty = true, spread_degrees = 5, speed_multiplier = 1,
+		actions_per_round = 2,
+		spells = {
+			spells = {
+				{ id = "DIVIDE_10", uses_remaining = -1 },
+				{ id = "DIVIDE_4", uses_remaining = -1 },
+				{ id = "LIGHT_BULLET", uses_remaining = -1 },
+				{ id = "WORM_SHOT", uses_remaining = -1 },
+			},
+			always = {},
+		},
+	},
+	{
+		item_name = "Bench greek wand",
+		mana_max = 5000, mana_charge_speed = 2000, reload_time = 60, fire_rate_wait = 20,
+		deck_capacity = 16, shuffle_deck_when_empty = false, spread_degrees = 0, speed_multiplier = 0.9,
+		actions_per_round = 1,
+		spells = {
+			spells = {
+				{ id = "BURST_8", uses_remaining = -1 },
+				{ id = "DUPLICATE", uses_remaining = -1 },
+				{ id = "GAMMA", uses_remaining = -1 },
+				{ id = "ALPHA", uses_remaining = -1 },
+				{ id = "LIGHT_BULLET", uses_remaining = -1 },
+				{ id = "HEAVY_SHOT", uses_remaining = -1 },
+				{ id = "OMEGA", uses_remaining = -1 },
+			},
+			always = {},
+		},
+	},
+}
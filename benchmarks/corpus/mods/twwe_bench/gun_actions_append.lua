@@ -0,0 +1,37 @@
+-- 基准测试用的模组法术，通过 ModLuaFileAppend 追加到 data/scripts/gun/gun_actions.lua
+table.insert( actions,
+{
+	id          = "TWWE_BENCH_BOLT",
+	name 		= "Bench bolt",
+	description = "Benchmark projectile",
+	sprite 		= "data/ui_gfx/gun_actions/light_bullet.png",
+	related_projectiles	= {"data/entities/projectiles/deck/light_bullet.xml"},
+	type 		= ACTION_TYPE_PROJECTILE,
+	spawn_level                       = "0,1,2",
+	spawn_probability                 = "1,1,1",
+	price = 100,
+	mana = 5,
+	action 		= function()
+		add_projectile("data/entities/projectiles/deck/light_bullet.xml")
+		c.fire_rate_wait = c.fire_rate_wait + 3
+		c.spread_degrees = c.spread_degrees - 1.0
+	end,
+} )
+
+table.insert( actions,
+{
+	id          = "TWWE_BENCH_SPLIT",
+	name 		= "Bench splitter",
+	description = "Benchmark modifier that draws two more spells",
+	sprite 		= "data/ui_gfx/gun_actions/burst_2.png",
+	type 		= ACTION_TYPE_DRAW_MANY,
+	spawn_level                       = "0,1,2",
+	spawn_probability                 = "1,1,1",
+	price = 100,
+	mana = 10,
+	action 		= function()
+		c.damage_projectile_add = c.damage_projectile_add + 0.2
+		c.fire_rate_wait = c.fire_rate_wait + 5
+		draw_actions( 2, true )
+	end,
+} )
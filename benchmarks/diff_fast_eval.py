@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+快速评估器差分测试：同一个评估请求分别交给进程内的 fast_evaluate() 与 wand_eval_tree (LuaJIT)，
+逐字节比较输出的 JSON。快速评估器声明不支持的请求只统计原因，不算失败。
+
+语料来自 benchmarks/corpus/wands.json，每个魔杖再派生出 折叠开/关、不同施法轮数、法力不足 的变体；
+--random N 额外生成 N 个只由快速评估器支持的法术组成的随机魔杖。
+
+用法 (在包含 noitadata / wand_eval_tree 的运行目录下执行):
+  python benchmarks/diff_fast_eval.py
+  python benchmarks/diff_fast_eval.py --random 200 --seed 7
+  python benchmarks/diff_fast_eval.py --only simple_spark_bolt --show-diff
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+from run_benchmark import REPO_ROOT, load_corpus
+
+LUA_PREFIX = b'{"success":true,"data":'
+
+def variants(case):
+    """由语料中的一个请求派生出若干覆盖不同代码路径的请求"""
+    base = dict(case["request"])
+    yield "default", base
+    yield "unfolded", dict(base, fold_nodes=not base.get("fold_nodes", True))
+    yield "one_cast", dict(base, number_of_casts=1)
+    yield "many_casts", dict(base, number_of_casts=26)
+    yield "low_mana", dict(base, mana_max=30, mana_charge_speed=45, number_of_casts=12)
+    yield "multicast", dict(base, actions_per_round=3)
+
+def random_requests(server, count, seed):
+    sim = server.load_fast_eval_data()
+    if sim is None:
+        return
+    pool = sorted(spell.id for spell in sim["spells"].values() if spell.ops is not None and spell.max_uses is None)
+    if not pool:
+        return
+    rng = random.Random(seed)
+    for i in range(count):
+        spells = [rng.choice(pool) if rng.random() > 0.1 else "" for _ in range(rng.randint(1, 26))]
+        yield f"random_{i}", {
+            "spells": spells,
+            "actions_per_round": rng.choice([1, 1, 1, 2, 3]),
+            "mana_max": rng.choice([50, 200, 1000, 100000]),
+            "mana_charge_speed": rng.choice([10, 100, 600, 100000]),
+            "reload_time": rng.randint(-20, 60),
+            "fire_rate_wait": rng.randint(-20, 30),
+            "speed_multiplier": rng.choice([1.0, 0.75, 1.5]),
+            "spread_degrees": rng.choice([0.0, -3.0, 5.5]),
+            "number_of_casts": rng.randint(1, 15),
+            "fold_nodes": rng.random() > 0.3,
+        }
+
+def run_lua(server, request):
+    client = server.app.test_client()
+    resp = client.post("/api/evaluate", json=dict(request, engine="lua", tab_id="diff", slot_id="diff"))
+    body = resp.get_data()
+    resp.close()
+    if resp.status_code != 200 or not body.startswith(LUA_PREFIX):
+        return None, body[:300].decode("utf-8", "replace")
+    return body[len(LUA_PREFIX):-1].strip(), None
+
+def first_difference(a, b, context=80):
+    n = next((i for i, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+    lo = max(0, n - context)
+    return n, a[lo:n + context].decode("utf-8", "replace"), b[lo:n + context].decode("utf-8", "replace")
+
+def main():
+    parser = argparse.ArgumentParser(description="Differential test: fast evaluator vs wand_eval_tree")
+    parser.add_argument("--random", type=int, default=0, help="number of random supported wands to add")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", help="comma separated corpus case names")
+    parser.add_argument("--show-diff", action="store_true", help="print the first differing bytes")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.join(REPO_ROOT, "backend"))
+    import server
+
+    corpus = load_corpus()
+    only = set(args.only.split(",")) if args.only else None
+    cases = []
+    for case in corpus["wands"]:
+        if only and case["name"] not in only:
+            continue
+        mod = corpus.get("mods", {}).get(case.get("mod")) if case.get("mod") else None
+        for variant, request in variants(case):
+            cases.append((f"{case['name']}/{variant}", request, mod))
+    for name, request in random_requests(server, args.random, args.seed):
+        cases.append((name, request, None))
+
+    stats = {"match": 0, "mismatch": 0, "unsupported": 0, "lua_error": 0}
+    reasons = {}
+    fast_time = lua_time = 0.0
+    for name, request, mod in cases:
+        snapshot = server.publish_snapshot(appends=mod["appends"] if mod else {},
+                                           active_mods=mod["active_mods"] if mod else [])
+
+        t0 = time.perf_counter()
+        try:
+            fast = server.fast_evaluate(request, snapshot.active_mods, snapshot=snapshot)
+        except server.FastEvalUnsupported as e:
+            stats["unsupported"] += 1
+            reason = str(e).split(" ")[0] if str(e).startswith(("spell", "unknown", "limited")) else str(e)
+            reasons[reason] = reasons.get(reason, 0) + 1
+            continue
+        t1 = time.perf_counter()
+        lua, error = run_lua(server, request)
+        t2 = time.perf_counter()
+        if lua is None:
+            stats["lua_error"] += 1
+            print(f"[Diff] {name}: Lua engine failed but fast path answered: {error}")
+            continue
+        fast_time += t1 - t0
+        lua_time += t2 - t1
+        if fast == lua:
+            stats["match"] += 1
+        else:
+            stats["mismatch"] += 1
+            print(f"[Diff] MISMATCH {name}")
+            if args.show_diff:
+                pos, a, b = first_difference(fast, lua)
+                print(f"    at byte {pos}\n    fast: {a}\n    lua:  {b}")
+
+    compared = stats["match"] + stats["mismatch"]
+    print(f"\n[Diff] {len(cases)} requests: {stats['match']} identical, {stats['mismatch']} different, "
+          f"{stats['unsupported']} unsupported (fallback), {stats['lua_error']} Lua errors")
+    if compared:
+        print(f"[Diff] mean fast {fast_time / compared * 1000:.2f} ms vs Lua {lua_time / compared * 1000:.1f} ms")
+    for reason, n in sorted(reasons.items(), key=lambda kv: -kv[1]):
+        print(f"    fallback: {reason} x{n}")
+    return 1 if stats["mismatch"] or stats["lua_error"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
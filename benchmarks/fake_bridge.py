@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+模拟 Noita 里 wand_sync 模组的 TCP 桥 (默认 127.0.0.1:12345)，用于在没有游戏的机器上
+测量和优化 talk_to_game() / sync_game_spells() / pull_game_wands() / 实时导入等路径。
+
+协议与 wand_sync/init.lua 一致：每个连接发送一行命令，服务端回复一行后关闭连接 (WATCH 除外)。
+  PING / 魔杖推送 (JSON)         -> OK
+  WATCH                          -> WATCHING，连接保持打开，之后推送 mods / wands 事件与每 2 秒一次的 ping
+  GET_ALL_SPELLS                 -> {"spells": [...], "appends": {...}, "active_mods": [...]}
+  GET_ALL_WANDS                  -> {"1": {...}, ...}   (推送过的魔杖会反映在这里)
+  GET_WAND_HASHES                -> {"1": "<哈希>", ...}
+  GET_WANDS:<槽位,...>           -> {"wands": {...}, "hashes": {...}}
+  SYNC_BATCH <n> + n 行魔杖 JSON -> [{"ok": true}, {"ok": false, "error": "..."}, ...]
+  GET_ACTIVE_MODS                -> [...]
+  GET_MOD_APPENDS                -> {...}
+  GET_WAND_EDITOR_DATA           -> ["<lua page>", ...]
+  GET_SPELL_LAB_DATA             -> {"original": "..."}
+  GET_GAME_INFO                  -> {"root": "..."}
+
+用法:
+  python benchmarks/fake_bridge.py --spells 2000 --append-kb 256 --latency-ms 20 --jitter-ms 10 --fail-rate 0.05
+然后正常启动后端 (TWWE_GAME_PORT 可以让后端连到其它端口)。
+"""
+import argparse
+import json
+import os
+import random
+import socketserver
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_DIR = os.path.join(BENCH_DIR, "corpus")
+
+FAILURE_MODES = ("drop", "hang", "garbage", "truncate")
+SPELL_TYPES = 8
+
+def _read_corpus(rel_path):
+    with open(os.path.join(CORPUS_DIR, rel_path), "r", encoding="utf-8") as f:
+        return f.read()
+
+def default_game_root():
+    # 评估器会从游戏根目录读取 data/translations 等文件，优先用解包好的 noitadata
+    data_root = os.environ.get("NOITA_DATA_PATH", os.path.join(os.getcwd(), "noitadata"))
+    return data_root if os.path.isdir(data_root) else os.getcwd()
+
+def make_spells(count):
+    """生成与 REQUEST_ALL_SPELLS 结构一致的法术列表"""
+    spells = []
+    for i in range(count):
+        spells.append({
+            "id": f"FAKE_SPELL_{i}",
+            "name": f"假法术 {i}",
+            "sprite": "data/ui_gfx/gun_actions/light_bullet.png",
+            "type": i % SPELL_TYPES,
+            "max_uses": -1 if i % 5 else 10,
+            "mana": 5 + i % 40,
+            "fire_rate_wait": i % 7,
+            "reload_time": 0,
+            "spread_degrees": 0,
+            "speed_multiplier": 1,
+            "never_unlimited": False,
+        })
+    return spells
+
+def content_hash(s):
+    """与 init.lua 的 content_hash 相同 (两个 32 位字符串哈希拼接)"""
+    h1, h2 = 5381, 0
+    for c in s.encode("utf-8"):
+        h1 = (h1 * 33 + c) % 4294967296
+        h2 = (h2 * 65599 + c) % 4294967296
+    return f"{h1:08x}{h2:08x}"
+
+def make_wand(capacity, seed):
+    rng = random.Random(seed)
+    ids = ["LIGHT_BULLET", "LIGHT_BULLET_TRIGGER", "DAMAGE", "BURST_2", "DIVIDE_2", "HOMING", "SPEED", "HEAVY_SHOT"]
+    return {
+        "mana_max": rng.randint(100, 3000),
+        "mana_charge_speed": rng.randint(20, 1000),
+        "reload_time": rng.randint(0, 60),
+        "fire_rate_wait": rng.randint(-10, 30),
+        "deck_capacity": capacity,
+        "shuffle_deck_when_empty": False,
+        "spread_degrees": rng.randint(-5, 10),
+        "speed_multiplier": 1,
+        "actions_per_round": 1,
+        "spells": {str(i + 1): rng.choice(ids) for i in range(capacity)},
+        "always_cast": [],
+    }
+
+
+class FakeNoitaBridge:
+    """
+    可编程的假桥。所有参数都可以在运行中修改 (例如负载测试中途提高失败率)。
+    fail_rate 按命令随机注入故障，failure_mode 决定故障表现：
+      drop      收到命令后直接断开 (后端得到空响应)
+      hang      不回复，直到超过后端 2s 的超时
+      garbage   回复一行不是 JSON 的内容
+      truncate  只回复前一半且不带换行
+    """
+
+    def __init__(self, host="127.0.0.1", port=12345, spells=500, append_kb=0, wand_capacity=26,
+                 latency_ms=0.0, jitter_ms=0.0, fail_rate=0.0, failure_mode="drop",
+                 game_root=None, seed=0, mod="twwe_bench"):
+        self.host = host
+        self.port = port
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.fail_rate = fail_rate
+        self.failure_mode = failure_mode
+        self.game_root = game_root or default_game_root()
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"commands": {}, "failures": {}, "bytes_sent": 0, "pushes": 0}
+        self.wands = {str(slot): make_wand(wand_capacity, seed + slot) for slot in range(1, 5)}
+        self.configure_payload(spells, append_kb, mod)
+        self._server = None
+        self._thread = None
+
+    # ---------- 数据 ----------
+
+    def configure_payload(self, spells, append_kb=0, mod="twwe_bench"):
+        corpus = {}
+        with open(os.path.join(CORPUS_DIR, "wands.json"), "r", encoding="utf-8") as f:
+            corpus = json.load(f)
+        mod_def = corpus.get("mods", {}).get(mod) if mod else None
+
+        self.active_mods = ["wand_sync"] + (list(mod_def["active_mods"]) if mod_def else [])
+        self.appends = {path: _read_corpus(src) for path, src in (mod_def or {}).get("appends", {}).items()}
+        if append_kb > 0:
+            # 用 Lua 注释撑大追加文件，模拟体积很大的模组
+            filler = "-- " + "x" * 96 + "\n"
+            self.appends["mods/twwe_bench_filler/files/filler.lua"] = filler * (append_kb * 1024 // len(filler) + 1)
+        self.spells = make_spells(spells)
+        self.wand_editor_pages = [_read_corpus(p).strip() for p in corpus.get("imports", {}).get("wand_editor", [])]
+        spell_lab = [_read_corpus(p).strip() for p in corpus.get("imports", {}).get("spell_lab", [])]
+        self.spell_lab = {"original": spell_lab[0]} if spell_lab else {}
+
+    def set_mod(self, mod_def):
+        """run_benchmark 用：直接替换模组追加与激活列表"""
+        with self.lock:
+            self.active_mods = ["wand_sync"] + list(mod_def["active_mods"]) if mod_def else ["wand_sync"]
+            self.appends = dict(mod_def["appends"]) if mod_def else {}
+
+    def respond(self, line, batch=()):
+        """返回回复内容 (不含换行)，与 init.lua 的分支一一对应；batch 为 SYNC_BATCH 首行之后的魔杖行"""
+        if line == "WATCH":
+            return "WATCHING"
+        if line == "GET_ALL_WANDS":
+            with self.lock:
+                return json.dumps(self.wands)
+        if line == "GET_WAND_HASHES":
+            with self.lock:
+                return json.dumps({slot: content_hash(json.dumps(w)) for slot, w in self.wands.items()})
+        if line.startswith("GET_WANDS:"):
+            slots = [n.strip() for n in line[10:].split(",") if n.strip().isdigit() and 1 <= int(n) <= 4]
+            with self.lock:
+                wands = {slot: self.wands[slot] for slot in slots if slot in self.wands}
+            return json.dumps({"wands": wands, "hashes": {slot: content_hash(json.dumps(w)) for slot, w in wands.items()}})
+        if line.startswith("SYNC_BATCH "):
+            acks = []
+            for item in batch:
+                error = self.apply_push(item)
+                acks.append({"ok": True} if error is None else {"ok": False, "error": error})
+            return json.dumps(acks)
+        if line == "GET_WAND_EDITOR_DATA":
+            return json.dumps(self.wand_editor_pages)
+        if line == "GET_SPELL_LAB_DATA":
+            return json.dumps(self.spell_lab)
+        if line == "GET_ALL_SPELLS":
+            with self.lock:
+                return json.dumps({"spells": self.spells, "appends": self.appends, "active_mods": self.active_mods})
+        if line == "GET_MOD_APPENDS":
+            with self.lock:
+                return json.dumps(self.appends)
+        if line == "GET_ACTIVE_MODS":
+            with self.lock:
+                return json.dumps(self.active_mods)
+        if line == "GET_GAME_INFO":
+            return json.dumps({"root": self.game_root.replace("\\", "/")})
+        # 其余一律当作 DATA: 推送 (PING 也走这里)
+        self.apply_push(line)
+        return "OK"
+
+    def apply_push(self, line):
+        """应用一条魔杖推送，失败时返回原因"""
+        try:
+            data = json.loads(line)
+        except ValueError:
+            return "invalid json"
+        if not isinstance(data, dict):
+            return "invalid json"
+        if data.get("ping"):
+            return None
+        slot = str(data.get("slot", 1))
+        with self.lock:
+            self.stats["pushes"] += 1
+            if data.get("delete"):
+                self.wands.pop(slot, None)
+                return None
+            if slot not in self.wands and not (slot.isdigit() and 1 <= int(slot) <= 4):
+                return f"no wand in slot {slot}"
+            wand = self.wands.setdefault(slot, make_wand(0, int(slot)))
+            for key, value in data.items():
+                if key != "slot":
+                    wand[key] = value
+        return None
+
+    # ---------- 网络 ----------
+
+    @staticmethod
+    def command_name(line):
+        if line.startswith("{") or line.startswith("["):
+            return "WAND_PUSH"
+        return line.split(" ", 1)[0].split(":", 1)[0][:40] or "EMPTY"
+
+    def watch(self, sock):
+        """WATCH 连接：先推送一次模组与魔杖，之后魔杖变化时推送 (与游戏每 30 帧检查一次相当)，每 2 秒一次心跳"""
+        with self.lock:
+            mods = list(self.active_mods)
+        sock.sendall((json.dumps({"type": "mods", "active_mods": mods}) + "\n").encode("utf-8"))
+        last_wands = None
+        last_heartbeat = time.time()
+        while self._server is not None:
+            with self.lock:
+                wands = json.dumps(self.wands)
+            if wands != last_wands:
+                last_wands = wands
+                sock.sendall(('{"type":"wands","wands":' + wands + "}\n").encode("utf-8"))
+            if time.time() - last_heartbeat >= 2:
+                sock.sendall(b'{"type":"ping"}\n')
+                last_heartbeat = time.time()
+            time.sleep(0.5)
+
+    def handle(self, sock):
+        sock.settimeout(5)
+        buf = b""
+        while b"\n" not in buf:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            buf += chunk
+        line, _, buf = buf.partition(b"\n")
+        line = line.decode("utf-8", "replace").rstrip("\r")
+        name = self.command_name(line)
+        batch = []
+        if line.startswith("SYNC_BATCH "):
+            # 分帧的批量推送：首行之后还有 n 行魔杖
+            count = int(line[11:]) if line[11:].strip().isdigit() else 0
+            while buf.count(b"\n") < count:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                buf += chunk
+            batch = [item.decode("utf-8", "replace").rstrip("\r") for item in buf.split(b"\n")[:count]]
+
+        delay = self.latency_ms + (self.rng.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        if self.fail_rate > 0 and self.rng.random() < self.fail_rate:
+            with self.lock:
+                self.stats["failures"][name] = self.stats["failures"].get(name, 0) + 1
+            if self.failure_mode == "hang":
+                time.sleep(3)
+                return
+            if self.failure_mode == "garbage":
+                sock.sendall(b"<<not json>>\n")
+                return
+            if self.failure_mode == "truncate":
+                payload = self.respond(line, batch).encode("utf-8")
+                sock.sendall(payload[: len(payload) // 2])
+                return
+            return  # drop
+
+        payload = self.respond(line, batch).encode("utf-8") + b"\n"
+        sock.sendall(payload)
+        with self.lock:
+            self.stats["commands"][name] = self.stats["commands"].get(name, 0) + 1
+            self.stats["bytes_sent"] += len(payload)
+        if line == "WATCH":
+            self.watch(sock)
+
+    def start(self):
+        bridge = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                try:
+                    bridge.handle(self.request)
+                except OSError:
+                    pass
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self._server = Server((self.host, self.port), Handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="FakeNoitaBridge", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def snapshot_stats(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+def add_bridge_arguments(parser):
+    group = parser.add_argument_group("fake bridge")
+    group.add_argument("--bridge-host", default="127.0.0.1")
+    group.add_argument("--bridge-port", type=int, default=12345)
+    group.add_argument("--spells", type=int, default=500, help="number of spells returned by GET_ALL_SPELLS")
+    group.add_argument("--append-kb", type=int, default=0, help="extra mod append payload size in KB")
+    group.add_argument("--wand-capacity", type=int, default=26, help="spells per wand returned by GET_ALL_WANDS")
+    group.add_argument("--latency-ms", type=float, default=0.0, help="added latency per command")
+    group.add_argument("--jitter-ms", type=float, default=0.0, help="uniform +/- jitter on the latency")
+    group.add_argument("--fail-rate", type=float, default=0.0, help="probability that a command fails")
+    group.add_argument("--failure-mode", choices=FAILURE_MODES, default="drop")
+    group.add_argument("--seed", type=int, default=0)
+    group.add_argument("--game-root", help="path reported by GET_GAME_INFO (default: ./noitadata)")
+    return group
+
+def bridge_from_args(args):
+    return FakeNoitaBridge(
+        host=args.bridge_host, port=args.bridge_port, spells=args.spells, append_kb=args.append_kb,
+        wand_capacity=args.wand_capacity, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        fail_rate=args.fail_rate, failure_mode=args.failure_mode, seed=args.seed, game_root=args.game_root,
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Noita wand_sync bridge")
+    add_bridge_arguments(parser)
+    args = parser.parse_args()
+
+    bridge = bridge_from_args(args).start()
+    print(f"[FakeBridge] Listening on {bridge.host}:{bridge.port} "
+          f"(spells={args.spells}, latency={args.latency_ms}±{args.jitter_ms}ms, "
+          f"fail_rate={args.fail_rate} {args.failure_mode})")
+    try:
+        while True:
+            time.sleep(10)
+            stats = bridge.snapshot_stats()
+            print(f"[FakeBridge] commands={stats['commands']} failures={stats['failures']} "
+                  f"pushes={stats['pushes']} sent={stats['bytes_sent'] / 1024:.1f}KB")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bridge.stop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+负载测试：启动假的 Noita 桥 (fake_bridge.py)，再用多个并发客户端按权重混合调用
+依赖游戏连接的后端接口，统计每个接口的延迟分布、错误数、吞吐量以及桥上的命令分布。
+
+用法:
+  python benchmarks/load_test.py --clients 8 --duration 30
+  python benchmarks/load_test.py --clients 16 --latency-ms 30 --jitter-ms 20 --fail-rate 0.1 --failure-mode hang
+  python benchmarks/load_test.py --url http://127.0.0.1:17471 --bridge-port 12345   # 后端需连到同一端口 (TWWE_GAME_PORT)
+  python benchmarks/load_test.py --mix status=5,pull=3,push=3,evaluate=1
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+from fake_bridge import add_bridge_arguments, bridge_from_args
+from run_benchmark import HttpTarget, InProcessTarget, RssSampler, is_success, load_corpus, percentile
+
+DEFAULT_MIX = "status=4,pull=3,push=3,sync-spells=1,import-wand-editor=1,import-spell-lab=1,evaluate=1"
+
+def build_operations(corpus):
+    """操作名 -> 生成 (method, path, body) 的函数"""
+    simple_wand = next(c for c in corpus["wands"] if c["category"] == "simple")
+
+    def push(rng):
+        slot = rng.randint(1, 4)
+        spells = {str(i + 1): rng.choice(["LIGHT_BULLET", "DAMAGE", "BURST_2", "HOMING"]) for i in range(rng.randint(1, 26))}
+        return ("POST", "/api/sync", {"slot": slot, "mana_max": rng.randint(100, 2000), "spells": spells})
+
+    def evaluate(rng):
+        body = dict(simple_wand["request"], tab_id="load", slot_id=f"load-{rng.getrandbits(32)}")
+        return ("POST", "/api/evaluate", body)
+
+    return {
+        "status": lambda rng: ("GET", "/api/status", None),
+        "pull": lambda rng: ("GET", "/api/pull", None),
+        "push": push,
+        "sync-spells": lambda rng: ("GET", "/api/sync-game-spells", None),
+        "import-wand-editor": lambda rng: ("GET", "/api/import/wand-editor", None),
+        "import-spell-lab": lambda rng: ("GET", "/api/import/spell-lab", None),
+        "evaluate": evaluate,
+    }
+
+def parse_mix(text, operations):
+    weights = {}
+    for part in text.split(","):
+        if not part.strip():
+            continue
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in operations:
+            raise SystemExit(f"unknown operation '{name}', expected one of: {', '.join(operations)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+def run_load(target, operations, weights, clients, duration, seed):
+    names = list(weights)
+    cum_weights = []
+    total = 0.0
+    for name in names:
+        total += weights[name]
+        cum_weights.append(total)
+
+    samples = {name: [] for name in names}
+    errors = {name: [] for name in names}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(index):
+        rng = random.Random(seed + index)
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, cum_weights=cum_weights)[0]
+            method, path, body = operations[name](rng)
+            start = time.perf_counter()
+            try:
+                status, data = target.request(method, path, body)
+                ok = is_success(status, data)
+                detail = f"{status}: {data[:120].decode('utf-8', 'replace')}"
+            except Exception as e:
+                ok, detail = False, repr(e)
+            elapsed = time.perf_counter() - start
+            with lock:
+                samples[name].append(elapsed)
+                if not ok:
+                    errors[name].append(detail)
+
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(clients)]
+    with RssSampler(target) as sampler:
+        wall_start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - wall_start
+
+    results = []
+    for name in names:
+        ordered = sorted(samples[name])
+        results.append({
+            "name": name,
+            "requests": len(ordered),
+            "errors": len(errors[name]),
+            "error_samples": errors[name][:3],
+            "p50_ms": round(percentile(ordered, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(ordered, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(ordered, 0.99) * 1000, 2),
+            "max_ms": round(ordered[-1] * 1000, 2) if ordered else 0.0,
+            "throughput_rps": round(len(ordered) / wall, 2) if wall > 0 else 0.0,
+        })
+    summary = {
+        "wall_sec": round(wall, 2),
+        "requests": sum(r["requests"] for r in results),
+        "errors": sum(r["errors"] for r in results),
+        "throughput_rps": round(sum(r["requests"] for r in results) / wall, 2) if wall > 0 else 0.0,
+        "peak_rss_mb": round(sampler.peak_total / (1024 * 1024), 1),
+    }
+    return results, summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent load test against a fake Noita bridge")
+    parser.add_argument("--url", help="load a running backend over HTTP instead of in-process")
+    parser.add_argument("--server-pid", type=int, help="backend PID for RSS sampling in --url mode")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weighted operations, e.g. status=4,pull=2")
+    parser.add_argument("--output", help="write results JSON here")
+    add_bridge_arguments(parser)
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    operations = build_operations(corpus)
+    weights = parse_mix(args.mix, operations)
+
+    bridge = bridge_from_args(args).start()
+    if args.url:
+        target = HttpTarget(args.url, args.server_pid, bridge)
+    else:
+        target = InProcessTarget(corpus)
+        target.server.GAME_PORT = bridge.port
+    print(f"[Load] bridge {bridge.host}:{bridge.port}, target={target.name}, "
+          f"clients={args.clients}, duration={args.duration}s, mix={weights}")
+
+    try:
+        results, summary = run_load(target, operations, weights, args.clients, args.duration, args.seed)
+    finally:
+        bridge.stop()
+    bridge_stats = bridge.snapshot_stats()
+
+    header = f"{'operation':<22} {'n':>6} {'err':>5} {'p50ms':>9} {'p95ms':>9} {'p99ms':>9} {'maxms':>9} {'req/s':>8}"
+    print()
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['name']:<22} {r['requests']:>6} {r['errors']:>5} {r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} "
+              f"{r['p99_ms']:>9.2f} {r['max_ms']:>9.2f} {r['throughput_rps']:>8.2f}")
+        for sample in r["error_samples"]:
+            print(f"    ! {sample}")
+    print(f"\n[Load] total {summary['requests']} requests, {summary['errors']} errors, "
+          f"{summary['throughput_rps']} req/s, peak RSS {summary['peak_rss_mb']} MB")
+    print(f"[Load] bridge commands={bridge_stats['commands']} injected failures={bridge_stats['failures']} "
+          f"pushes={bridge_stats['pushes']} sent={bridge_stats['bytes_sent'] / 1024:.1f}KB")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "summary": summary, "results": results, "bridge": bridge_stats},
+                      f, indent=2, ensure_ascii=False)
+        print(f"[Load] 结果已写入 {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
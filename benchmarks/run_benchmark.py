@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+"""
+TWWE 端到端基准测试
+
+针对 benchmarks/corpus 中的代表性魔杖 (simple / trigger_heavy / deeply_recursive / modded)
+驱动 /api/evaluate、/api/fetch-spells、两个导入接口与 /api/icon，记录
+p50/p95/p99 延迟、吞吐量、峰值 RSS (后端 + luajit 子进程) 与输出大小，并与保存的基线对比。
+
+用法 (在仓库根目录，或任何包含 noitadata / wand_eval_tree 的运行目录下执行):
+  python benchmarks/run_benchmark.py                      # 进程内加载 backend/server.py (Flask test client)
+  python benchmarks/run_benchmark.py --url http://127.0.0.1:17471   # 针对正在运行的后端 (走真实 HTTP)
+  python benchmarks/run_benchmark.py --save-baseline      # 本次结果写入基线文件
+  python benchmarks/run_benchmark.py --only evaluate --repeat 30 --concurrency 4
+  python benchmarks/run_benchmark.py --url http://127.0.0.1:17471 --fake-bridge   # 远程模式下由假桥提供模组数据
+
+基线默认保存在 benchmarks/baseline.json；只有在同一台机器、同一环境下的对比才有意义。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import threading
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+CORPUS_DIR = os.path.join(BENCH_DIR, "corpus")
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+# 延迟在这个绝对值以内的波动不算回归 (毫秒)
+NOISE_FLOOR_MS = 5.0
+
+try:
+    import psutil
+    HAS_PSUTIL = True
+except ImportError:
+    HAS_PSUTIL = False
+
+# ============================================================
+# 语料
+# ============================================================
+
+def read_corpus_file(rel_path):
+    with open(os.path.join(CORPUS_DIR, rel_path), "r", encoding="utf-8") as f:
+        return f.read()
+
+def load_corpus():
+    with open(os.path.join(CORPUS_DIR, "wands.json"), "r", encoding="utf-8") as f:
+        corpus = json.load(f)
+    # 把模组追加文件读成 {路径: 内容}，与 GET_ALL_SPELLS 返回的 appends 结构一致
+    for mod in corpus.get("mods", {}).values():
+        mod["appends"] = {path: read_corpus_file(src) for path, src in mod.get("appends", {}).items()}
+    imports = corpus.get("imports", {})
+    corpus["imports"] = {kind: [read_corpus_file(p).strip() for p in paths] for kind, paths in imports.items()}
+    return corpus
+
+# ============================================================
+# 请求目标：进程内 Flask app 或远程 HTTP
+# ============================================================
+
+class InProcessTarget:
+    """直接加载 backend/server.py，用 test client 发请求 (luajit 子进程仍然真实运行)"""
+
+    name = "in-process"
+
+    def __init__(self, corpus):
+        sys.path.insert(0, os.path.join(REPO_ROOT, "backend"))
+        import server
+        self.server = server
+        self.corpus = corpus
+        self.pid = os.getpid()
+        self._orig_read_settings = server.read_noita_mod_settings
+
+    def request(self, method, path, body=None):
+        client = self.server.app.test_client()
+        if method == "POST":
+            resp = client.post(path, json=body)
+        else:
+            resp = client.get(path)
+        data = resp.get_data()
+        resp.close()
+        return resp.status_code, data
+
+    def use_mod(self, mod):
+        # 相当于已经执行过一次 /api/sync-game-spells
+        self.server.publish_snapshot(appends=mod["appends"] if mod else {},
+                                     active_mods=mod["active_mods"] if mod else [])
+
+    def use_import_settings(self, settings):
+        # 导入接口在没有游戏时会读取 mod_config.xml，这里用语料代替存档里的设置
+        if settings is None:
+            self.server.read_noita_mod_settings = self._orig_read_settings
+        else:
+            self.server.read_noita_mod_settings = lambda: settings
+
+    def supports_mods(self):
+        return True
+
+    def supports_imports(self):
+        return True
+
+
+class HttpTarget:
+    name = "http"
+
+    def __init__(self, url, server_pid=None, bridge=None):
+        self.url = url.rstrip("/")
+        self.pid = server_pid
+        self.bridge = bridge
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        req = urllib.request.Request(self.url + path, data=data, method=method)
+        if data is not None:
+            req.add_header("Content-Type", "application/json")
+        try:
+            with urllib.request.urlopen(req, timeout=300) as resp:
+                return resp.status, resp.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def use_mod(self, mod):
+        # 远程后端只能通过桥同步模组数据：先让假桥换上语料里的模组，再触发一次同步
+        if self.bridge:
+            self.bridge.set_mod(mod)
+            self.request("GET", "/api/sync-game-spells")
+
+    def use_import_settings(self, settings):
+        pass
+
+    def supports_mods(self):
+        # 没有假桥时远程后端的模组数据来自游戏，无法由语料控制
+        return self.bridge is not None
+
+    def supports_imports(self):
+        return True
+
+# ============================================================
+# 峰值内存采样
+# ============================================================
+
+def _children_rss_proc(pid):
+    """不依赖 psutil，扫描 /proc 统计 pid 的所有后代进程 RSS"""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                stat = f.read()
+            ppid = int(stat.rsplit(")", 1)[1].split()[1])
+            parents.setdefault(ppid, []).append(int(entry))
+        except (OSError, ValueError, IndexError):
+            continue
+    total = 0
+    stack = list(parents.get(pid, []))
+    while stack:
+        child = stack.pop()
+        total += _rss_proc(child)
+        stack.extend(parents.get(child, []))
+    return total
+
+def _rss_proc(pid):
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def process_tree_rss(pid):
+    """返回 (后端 RSS, 子进程 RSS 合计)，单位字节"""
+    if HAS_PSUTIL:
+        try:
+            proc = psutil.Process(pid)
+            children = 0
+            for child in proc.children(recursive=True):
+                try:
+                    children += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            return proc.memory_info().rss, children
+        except psutil.Error:
+            return 0, 0
+    if os.path.isdir("/proc"):
+        return _rss_proc(pid), _children_rss_proc(pid)
+    return 0, 0
+
+class RssSampler:
+    def __init__(self, target, interval=0.05):
+        self.target = target
+        self.interval = interval
+        self.peak_backend = 0
+        self.peak_children = 0
+        self.peak_total = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        if self.target.pid:
+            return process_tree_rss(self.target.pid)
+        # 远程且没给 pid：用后端自己上报的数据 (精度受其采样间隔限制)
+        status, data = self.target.request("GET", "/api/processes")
+        if status != 200:
+            return 0, 0
+        stats = json.loads(data)
+        children = sum(p.get("rss_mb", 0) for p in stats.get("processes", [])) * 1024 * 1024
+        return stats.get("backend_rss_mb", 0) * 1024 * 1024, children
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                backend, children = self._sample()
+            except Exception:
+                backend, children = 0, 0
+            self.peak_backend = max(self.peak_backend, backend)
+            self.peak_children = max(self.peak_children, children)
+            self.peak_total = max(self.peak_total, backend + children)
+            self._stop.wait(self.interval if self.target.pid else max(self.interval, 0.25))
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+# ============================================================
+# 场景
+# ============================================================
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    pos = (len(sorted_values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+def is_success(status, data):
+    if status != 200:
+        return False
+    # 评估被取消等情况也返回 200，需要看 success 字段
+    if data[:1] == b"{":
+        head = data[:64]
+        if b'"success":false' in head.replace(b" ", b""):
+            return False
+    return True
+
+def run_scenario(target, name, requests, repeat, concurrency, warmup):
+    """requests: [(method, path, body)]，每轮按顺序全部发一遍"""
+    for _ in range(warmup):
+        for method, path, body in requests:
+            target.request(method, path, body)
+
+    latencies = []
+    sizes = []
+    failures = []
+    lock = threading.Lock()
+
+    def one(job):
+        index, (method, path, body) = job
+        if isinstance(body, dict) and "slot_id" in body:
+            # 每个请求独立插槽，否则并发时同插槽的旧评估会被顶替取消
+            body = dict(body, slot_id=f"{body['slot_id']}-{index}")
+        start = time.perf_counter()
+        status, data = target.request(method, path, body)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            sizes.append(len(data))
+            if not is_success(status, data):
+                failures.append(f"{status} {path}: {data[:200].decode('utf-8', 'replace')}")
+
+    jobs = list(enumerate(req for _ in range(repeat) for req in requests))
+    with RssSampler(target) as sampler:
+        wall_start = time.perf_counter()
+        if concurrency <= 1:
+            for req in jobs:
+                one(req)
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(one, jobs))
+        wall = time.perf_counter() - wall_start
+
+    ordered = sorted(latencies)
+    return {
+        "name": name,
+        "requests": len(jobs),
+        "failures": len(failures),
+        "failure_samples": failures[:3],
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 2),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2) if ordered else 0.0,
+        "throughput_rps": round(len(jobs) / wall, 2) if wall > 0 else 0.0,
+        "peak_rss_mb": round(sampler.peak_total / (1024 * 1024), 1),
+        "peak_backend_rss_mb": round(sampler.peak_backend / (1024 * 1024), 1),
+        "peak_children_rss_mb": round(sampler.peak_children / (1024 * 1024), 1),
+        "output_bytes": max(sizes) if sizes else 0,
+    }
+
+def build_scenarios(corpus, target, only):
+    """返回 [(场景名, 请求列表, setup, teardown)]"""
+    scenarios = []
+
+    def wanted(group):
+        return not only or group in only
+
+    if wanted("evaluate"):
+        for case in corpus["wands"]:
+            mod = corpus.get("mods", {}).get(case["mod"]) if case.get("mod") else None
+            if case.get("mod") and not target.supports_mods():
+                print(f"[Bench] 跳过 {case['name']}: 远程模式下模组数据来自游戏，需要 --fake-bridge")
+                continue
+            body = dict(case["request"])
+            body.setdefault("tab_id", "bench")
+            body.setdefault("slot_id", case["name"])
+            scenarios.append((
+                f"evaluate/{case['category']}/{case['name']}",
+                [("POST", "/api/evaluate", body)],
+                (lambda m=mod: target.use_mod(m)),
+                (lambda: target.use_mod(None)),
+            ))
+
+    if wanted("fetch-spells"):
+        scenarios.append(("fetch-spells", [("GET", "/api/fetch-spells", None)], None, None))
+
+    if wanted("import") and target.supports_imports():
+        imports = corpus.get("imports", {})
+        if imports.get("wand_editor"):
+            settings = {f"wand_editorWandDepot{i + 1}": page for i, page in enumerate(imports["wand_editor"])}
+            scenarios.append((
+                "import/wand-editor",
+                [("GET", "/api/import/wand-editor", None)],
+                (lambda s=settings: target.use_import_settings(s)),
+                (lambda: target.use_import_settings(None)),
+            ))
+        if imports.get("spell_lab"):
+            settings = {"spell_lab_saved_wands": imports["spell_lab"][0]}
+            scenarios.append((
+                "import/spell-lab",
+                [("GET", "/api/import/spell-lab", None)],
+                (lambda s=settings: target.use_import_settings(s)),
+                (lambda: target.use_import_settings(None)),
+            ))
+
+    if wanted("icon") and corpus.get("icons"):
+        scenarios.append((
+            "icon",
+            [("GET", "/api/icon/" + path, None) for path in corpus["icons"]],
+            None,
+            None,
+        ))
+    return scenarios
+
+# ============================================================
+# 基线对比
+# ============================================================
+
+def compare(result, base, threshold):
+    """返回回归描述列表 (空列表表示没有回归)"""
+    issues = []
+    for key in ("p50_ms", "p95_ms", "p99_ms"):
+        old, new = base.get(key), result.get(key)
+        if old is None or new is None:
+            continue
+        if new > old * (1 + threshold) and new - old > NOISE_FLOOR_MS:
+            issues.append(f"{key} {old} -> {new}")
+    old_tp = base.get("throughput_rps")
+    if old_tp and result["throughput_rps"] < old_tp * (1 - threshold):
+        issues.append(f"throughput_rps {old_tp} -> {result['throughput_rps']}")
+    old_rss = base.get("peak_rss_mb")
+    if old_rss and result["peak_rss_mb"] > old_rss * (1 + threshold):
+        issues.append(f"peak_rss_mb {old_rss} -> {result['peak_rss_mb']}")
+    old_size = base.get("output_bytes")
+    if old_size and result["output_bytes"] > old_size * (1 + threshold):
+        issues.append(f"output_bytes {old_size} -> {result['output_bytes']}")
+    if result["failures"] > base.get("failures", 0):
+        issues.append(f"failures {base.get('failures', 0)} -> {result['failures']}")
+    return issues
+
+def print_table(results, baseline, threshold):
+    header = f"{'scenario':<48} {'n':>4} {'fail':>4} {'p50ms':>9} {'p95ms':>9} {'p99ms':>9} {'req/s':>8} {'rssMB':>7} {'outKB':>9}  vs baseline"
+    print(header)
+    print("-" * len(header))
+    regressions = 0
+    for r in results:
+        base = baseline.get(r["name"]) if baseline else None
+        if base is None:
+            verdict = "(no baseline)" if baseline else ""
+        else:
+            issues = compare(r, base, threshold)
+            verdict = "REGRESSION: " + "; ".join(issues) if issues else "ok"
+            regressions += bool(issues)
+        print(f"{r['name']:<48} {r['requests']:>4} {r['failures']:>4} {r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} "
+              f"{r['p99_ms']:>9.2f} {r['throughput_rps']:>8.2f} {r['peak_rss_mb']:>7.1f} {r['output_bytes'] / 1024:>9.1f}  {verdict}")
+        for sample in r["failure_samples"]:
+            print(f"    ! {sample}")
+    return regressions
+
+# ============================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="TWWE end-to-end benchmark")
+    parser.add_argument("--url", help="benchmark a running backend over HTTP instead of loading it in-process")
+    parser.add_argument("--server-pid", type=int, help="backend PID for RSS sampling in --url mode")
+    parser.add_argument("--repeat", type=int, default=10, help="measured rounds per scenario")
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured rounds per scenario")
+    parser.add_argument("--concurrency", type=int, default=1, help="concurrent clients per scenario")
+    parser.add_argument("--only", action="append", choices=["evaluate", "fetch-spells", "import", "icon"],
+                        help="restrict to a scenario group (repeatable)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline file to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative change reported as regression")
+    parser.add_argument("--output", help="write the full results JSON here (default: benchmarks/results/<time>.json)")
+    parser.add_argument("--fake-bridge", action="store_true",
+                        help="serve bridge commands from benchmarks/fake_bridge.py during the run")
+    parser.add_argument("--bridge-port", type=int, default=12345, help="port for --fake-bridge")
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    bridge = None
+    if args.fake_bridge:
+        from fake_bridge import FakeNoitaBridge
+        bridge = FakeNoitaBridge(port=args.bridge_port, spells=0, mod=None).start()
+        print(f"[Bench] fake bridge on port {bridge.port}")
+    if args.url:
+        target = HttpTarget(args.url, args.server_pid, bridge)
+    else:
+        target = InProcessTarget(corpus)
+        if bridge:
+            target.server.GAME_PORT = bridge.port
+    print(f"[Bench] target={target.name} repeat={args.repeat} concurrency={args.concurrency}")
+
+    results = []
+    for name, requests, setup, teardown in build_scenarios(corpus, target, set(args.only or [])):
+        if setup:
+            setup()
+        try:
+            print(f"[Bench] {name} ...", flush=True)
+            results.append(run_scenario(target, name, requests, args.repeat, args.concurrency, args.warmup))
+        finally:
+            if teardown:
+                teardown()
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = {r["name"]: r for r in json.load(f).get("results", [])}
+
+    print()
+    regressions = print_table(results, baseline, args.threshold)
+
+    report = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "target": target.name,
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "repeat": args.repeat,
+        "concurrency": args.concurrency,
+        "results": results,
+    }
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\n[Bench] 结果已写入 {output}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"[Bench] 基线已更新: {args.baseline}")
+
+    if bridge:
+        bridge.stop()
+    if regressions:
+        print(f"[Bench] {regressions} 个场景相对基线出现回归 (阈值 {args.threshold:.0%})")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
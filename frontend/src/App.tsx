@@ -101,7 +101,7 @@ const readMetadataFromPng = async (file: File): Promise<string | null> => {
     reader.readAsArrayBuffer(file);
   });
 };
-import { evaluateWand, getIconUrl } from './lib/evaluatorAdapter';
+import { evaluateWand, getIconUrl, cancelEvaluation } from './lib/evaluatorAdapter';
 import { useTranslation } from 'react-i18next';
 
 const cloneTabs = (tbs: any[]): any[] => {
@@ -112,6 +112,9 @@ const cloneTabs = (tbs: any[]): any[] => {
   }));
 };
 
+// Game state seen within this long after a local edit may still predate our own sync, so it is not applied yet
+const LOCAL_EDIT_SETTLE_MS = 5000;
+
 function App() {
   const { t, i18n } = useTranslation();
   const [tabs, setTabs] = useState<Tab[]>(() => {
@@ -209,6 +212,12 @@ function App() {
   const lastLocalUpdateRef = useRef<number>(0);
   const preloadedRef = useRef<boolean>(false);
   const wasConnectedRef = useRef<boolean>(false); // Track connection state change
+  // Game state pushed over /api/events (null until the first wands event)
+  const [pushActive, setPushActive] = useState(false);
+  const [pushedWands, setPushedWands] = useState<Record<string, WandData> | null>(null);
+  const applyGameWandsRef = useRef<(gameWands: Record<string, WandData>, force?: boolean) => void>(() => { });
+  const gameModsRef = useRef<string | null>(null);
+  const snapshotVersionRef = useRef<number | null>(null);
 
   // --- Context Menus ---
   const [tabMenu, setTabMenu] = useState<{ x: number, y: number, tabId: string } | null>(null);
@@ -309,6 +318,8 @@ function App() {
 
   // --- Conflict Resolution ---
   const lastKnownGameWandsRef = useRef<Record<string, Record<string, WandData>>>({});
+  // Last diff pull: slot -> wand / content hash as reported by /api/pull?diff=1
+  const pulledWandsRef = useRef<{ wands: Record<string, WandData>, hashes: Record<string, string> }>({ wands: {}, hashes: {} });
   const [conflict, setConflict] = useState<{
     tabId: string;
     gameWands: Record<string, WandData>;
@@ -514,7 +525,17 @@ function App() {
         [key]: { ...(prev[key] || { data: null, id: 0 }), loading: true }
       }));
 
-      const res = await evaluateWand(wand, settings, isConnected, tabId, slot, force);
+      // 逐轮显示：先到的施法轮次立即渲染，完整结果到达后再替换
+      const onProgress = (partial: EvalResponse, id: number) => {
+        if (id < (latestRequestIdsRef.current[key] || 0)) return;
+        latestRequestIdsRef.current[key] = id;
+        setEvalResults(prev => ({
+          ...prev,
+          [key]: { data: partial, id, loading: true }
+        }));
+      };
+
+      const res = await evaluateWand(wand, settings, isConnected, tabId, slot, force, onProgress);
       if (res) {
         // Only update if this is still the latest request for this slot
         if (res.id >= (latestRequestIdsRef.current[key] || 0)) {
@@ -1562,8 +1583,47 @@ function App() {
       setIsConnected(false);
       return;
     }
-    const statusTimer = setInterval(checkStatus, 3000);
-    return () => clearInterval(statusTimer);
+    // Connection, hotbar wands, mod list and spell DB changes are pushed by the backend;
+    // fall back to polling /api/status when the event stream is unavailable
+    let statusTimer: any;
+    const startPolling = () => {
+      if (statusTimer) return;
+      setPushActive(false);
+      checkStatus();
+      statusTimer = setInterval(checkStatus, 3000);
+    };
+    if (typeof EventSource === 'undefined') {
+      startPolling();
+      return () => clearInterval(statusTimer);
+    }
+    const events = new EventSource('/api/events');
+    const parse = (e: Event) => JSON.parse((e as MessageEvent).data);
+    events.onopen = () => setPushActive(true);
+    events.onerror = () => {
+      setIsConnected(false);
+      // CLOSED: the backend does not serve the stream; otherwise the browser reconnects by itself
+      if (events.readyState === EventSource.CLOSED) startPolling();
+      else setPushActive(false);
+    };
+    events.addEventListener('status', e => setIsConnected(!!parse(e).connected));
+    events.addEventListener('wands', e => setPushedWands(parse(e).wands || {}));
+    events.addEventListener('mods', e => {
+      const mods = (parse(e).active_mods || []).join(',');
+      if (gameModsRef.current !== null && gameModsRef.current !== mods) {
+        setNotification({ msg: t('app.notification.game_mods_changed'), type: 'info' });
+      }
+      gameModsRef.current = mods;
+    });
+    events.addEventListener('snapshot', e => {
+      // Spells synced from another page or worker
+      const { version } = parse(e);
+      if (snapshotVersionRef.current !== null && snapshotVersionRef.current !== version) fetchSpellDb();
+      snapshotVersionRef.current = version;
+    });
+    return () => {
+      events.close();
+      clearInterval(statusTimer);
+    };
   }, []);
 
   // Preload Images to solve the flickering issue
@@ -1603,16 +1663,34 @@ function App() {
 
   useEffect(() => {
     let pullTimer: any;
-    if (activeTab.isRealtime && isConnected) {
+    if (activeTab.isRealtime && isConnected && !pushActive) {
       pullTimer = setInterval(pullData, 1000);
     }
     return () => clearInterval(pullTimer);
-  }, [activeTabId, activeTab.isRealtime, isConnected]);
+  }, [activeTabId, activeTab.isRealtime, isConnected, pushActive]);
+
+  useEffect(() => {
+    if (!pushedWands || !activeTab.isRealtime || !isConnected) return;
+    // A push right after a local edit is usually the echo of our own sync; look at it again once that settles
+    // (re-checked on every attempt, since another local edit may land while we wait)
+    let timer: any;
+    const apply = () => {
+      const wait = LOCAL_EDIT_SETTLE_MS - (Date.now() - lastLocalUpdateRef.current);
+      if (wait > 0) {
+        timer = setTimeout(apply, wait);
+        return;
+      }
+      applyGameWandsRef.current(pushedWands);
+    };
+    apply();
+    return () => clearTimeout(timer);
+  }, [pushedWands, activeTabId, activeTab.isRealtime, isConnected]);
 
   useEffect(() => {
     if (isConnected && !wasConnectedRef.current) {
       console.log('[Sync] Game connected/restarted. Clearing session cache and forcing pull...');
       lastKnownGameWandsRef.current = {};
+      pulledWandsRef.current = { wands: {}, hashes: {} };
       if (activeTab.isRealtime) {
         pullData(true);
       }
@@ -1678,78 +1756,88 @@ function App() {
     if (!force && Date.now() - lastLocalUpdateRef.current < 3000) return;
 
     try {
-      const res = await fetch('/api/pull');
+      // Diff pull: the backend only returns wands whose content hash differs from what we already have
+      const pulled = pulledWandsRef.current;
+      const known = Object.entries(pulled.hashes).map(([slot, hash]) => `${slot}:${hash}`).join(',');
+      const res = await fetch(`/api/pull?diff=1&known=${encodeURIComponent(known)}`);
       const data = await res.json();
       if (data.success) {
-        const gameWands = data.wands || {};
-        const lastKnown = lastKnownGameWandsRef.current[activeTabId];
-        const currentWeb = activeTab.wands;
+        const wands = { ...pulled.wands, ...(data.changed || {}) };
+        (data.removed || []).forEach((slot: string) => delete wands[slot]);
+        pulledWandsRef.current = { wands, hashes: data.hashes || {} };
+        applyGameWandsSnapshot(JSON.parse(JSON.stringify(wands)), force);
+      }
+    } catch { }
+  };
 
-        const gameChanged = lastKnown && JSON.stringify(gameWands) !== JSON.stringify(lastKnown);
-        const webChanged = lastKnown && JSON.stringify(currentWeb) !== JSON.stringify(lastKnown);
-        const inSync = JSON.stringify(gameWands) === JSON.stringify(currentWeb);
+  const applyGameWandsSnapshot = (gameWands: Record<string, WandData>, force = false) => {
+    const lastKnown = lastKnownGameWandsRef.current[activeTabId];
+    const currentWeb = activeTab.wands;
 
-        const applyGameWands = (tabId: string, wands: Record<string, WandData>, name: string) => {
-          performAction(() => wands, name, [], force);
-          lastKnownGameWandsRef.current[tabId] = JSON.parse(JSON.stringify(wands));
-        };
+    const gameChanged = lastKnown && JSON.stringify(gameWands) !== JSON.stringify(lastKnown);
+    const webChanged = lastKnown && JSON.stringify(currentWeb) !== JSON.stringify(lastKnown);
+    const inSync = JSON.stringify(gameWands) === JSON.stringify(currentWeb);
 
-        if (inSync) {
-          // Both sides are identical, just update the reference point
-          lastKnownGameWandsRef.current[activeTabId] = JSON.parse(JSON.stringify(gameWands));
-          return;
-        }
+    const applyGameWands = (tabId: string, wands: Record<string, WandData>, name: string) => {
+      performAction(() => wands, name, [], force);
+      lastKnownGameWandsRef.current[tabId] = JSON.parse(JSON.stringify(wands));
+    };
 
-        // If forced (manual click), skip the "recently updated" check and apply directly
-        if (force) {
-          applyGameWands(activeTabId, gameWands, t('app.notification.force_pull_game_data'));
-          return;
-        }
+    if (inSync) {
+      // Both sides are identical, just update the reference point
+      lastKnownGameWandsRef.current[activeTabId] = JSON.parse(JSON.stringify(gameWands));
+      return;
+    }
 
-        if (gameChanged && webChanged) {
-          // Double change -> Respect setting or ask
-          if (settings.conflictStrategy === 'override_game') {
-            // Web wins, push to game
-            Object.entries(currentWeb).forEach(([slot, d]) => syncWand(slot, d));
-            lastKnownGameWandsRef.current[activeTabId] = JSON.parse(JSON.stringify(currentWeb));
-            setNotification({ msg: t('app.notification.auto_sync_web_over_game'), type: 'success' });
-          } else if (settings.conflictStrategy === 'new_workflow') {
-            // Game wins but as new workflow
-            const id = Date.now().toString();
-            setTabs(prev => [...prev, {
-              id,
-              name: `[同步保存] ${activeTab.name}`,
-              isRealtime: false,
-              wands: gameWands,
-              expandedWands: new Set(Object.keys(gameWands)),
-              past: [],
-              future: []
-            }]);
-            lastKnownGameWandsRef.current[activeTabId] = JSON.parse(JSON.stringify(currentWeb));
-            setNotification({ msg: t('app.notification.auto_sync_game_to_new'), type: 'info' });
-          } else {
-            // Ask
-            setConflict({ tabId: activeTabId, gameWands });
-          }
-        } else if (webChanged && !gameChanged) {
-          // Only web changed -> If realtime, game should have been updated by syncWand
-          // but if we were offline, we might need to push now
-          if (activeTab.isRealtime) {
-            Object.entries(currentWeb).forEach(([slot, d]) => syncWand(slot, d));
-          }
-          lastKnownGameWandsRef.current[activeTabId] = JSON.parse(JSON.stringify(currentWeb));
-        } else if (gameChanged && !webChanged) {
-          // Only game changed -> Pull normally
-          // Optimization: If we recently updated locally, ignore game "changes" that might be stale data
-          if (!force && Date.now() - lastLocalUpdateRef.current < 5000) return;
-          applyGameWands(activeTabId, gameWands, t('app.notification.sync_from_game'));
-        } else if (!lastKnown) {
-          // First time seeing the game
-          applyGameWands(activeTabId, gameWands, t('app.notification.initial_sync'));
-        }
+    // If forced (manual click), skip the "recently updated" check and apply directly
+    if (force) {
+      applyGameWands(activeTabId, gameWands, t('app.notification.force_pull_game_data'));
+      return;
+    }
+
+    if (gameChanged && webChanged) {
+      // Double change -> Respect setting or ask
+      if (settings.conflictStrategy === 'override_game') {
+        // Web wins, push to game
+        Object.entries(currentWeb).forEach(([slot, d]) => syncWand(slot, d));
+        lastKnownGameWandsRef.current[activeTabId] = JSON.parse(JSON.stringify(currentWeb));
+        setNotification({ msg: t('app.notification.auto_sync_web_over_game'), type: 'success' });
+      } else if (settings.conflictStrategy === 'new_workflow') {
+        // Game wins but as new workflow
+        const id = Date.now().toString();
+        setTabs(prev => [...prev, {
+          id,
+          name: `[同步保存] ${activeTab.name}`,
+          isRealtime: false,
+          wands: gameWands,
+          expandedWands: new Set(Object.keys(gameWands)),
+          past: [],
+          future: []
+        }]);
+        lastKnownGameWandsRef.current[activeTabId] = JSON.parse(JSON.stringify(currentWeb));
+        setNotification({ msg: t('app.notification.auto_sync_game_to_new'), type: 'info' });
+      } else {
+        // Ask
+        setConflict({ tabId: activeTabId, gameWands });
       }
-    } catch { }
+    } else if (webChanged && !gameChanged) {
+      // Only web changed -> If realtime, game should have been updated by syncWand
+      // but if we were offline, we might need to push now
+      if (activeTab.isRealtime) {
+        Object.entries(currentWeb).forEach(([slot, d]) => syncWand(slot, d));
+      }
+      lastKnownGameWandsRef.current[activeTabId] = JSON.parse(JSON.stringify(currentWeb));
+    } else if (gameChanged && !webChanged) {
+      // Only game changed -> Pull normally
+      // Optimization: If we recently updated locally, ignore game "changes" that might be stale data
+      if (!force && Date.now() - lastLocalUpdateRef.current < LOCAL_EDIT_SETTLE_MS) return;
+      applyGameWands(activeTabId, gameWands, t('app.notification.sync_from_game'));
+    } else if (!lastKnown) {
+      // First time seeing the game
+      applyGameWands(activeTabId, gameWands, t('app.notification.initial_sync'));
+    }
   };
+  applyGameWandsRef.current = applyGameWandsSnapshot;
 
   const toggleSync = (id: string) => {
     setTabs(prev => prev.map(t => t.id === id ? { ...t, isRealtime: !t.isRealtime } : t));
@@ -1765,19 +1853,26 @@ function App() {
     if (entries.length === 0) return;
 
     try {
-      // Use Promise.all for faster sync if many wands, but sequential is safer for Noita
-      for (const [slot, data] of entries) {
-        await fetch('/api/sync', {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({
+      // One framed batch: the game applies every wand in the same frame and acknowledges each one
+      const res = await fetch('/api/sync/batch', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          wands: entries.map(([slot, data]) => ({
             slot: parseInt(slot),
             delete: false,
             ...data
-          })
-        });
+          }))
+        })
+      });
+      const result = await res.json();
+      if (!res.ok || !result.acks) throw new Error(result.error);
+      if (result.success) {
+        setNotification({ msg: t('app.notification.pushed_to_game', { count: entries.length }), type: 'success' });
+      } else {
+        const failed = result.acks.filter((a: any) => !a.ok).map((a: any) => a.slot).join(', ');
+        setNotification({ msg: t('app.notification.pushed_to_game_partial', { applied: result.applied, count: entries.length, slots: failed }), type: 'info' });
       }
-      setNotification({ msg: t('app.notification.pushed_to_game', { count: entries.length }), type: 'success' });
     } catch (e) {
       setNotification({ msg: t('app.notification.push_failed'), type: 'info' });
     }
@@ -1803,6 +1898,7 @@ function App() {
   const deleteTab = (id: string, e: React.MouseEvent) => {
     e.stopPropagation();
     if (tabs.length <= 1) return;
+    cancelEvaluation(id);
     setTabs(prev => prev.filter(t => t.id !== id));
     if (activeTabId === id) setActiveTabId(tabs.find(t => t.id !== id)?.id || tabs[0].id);
   };
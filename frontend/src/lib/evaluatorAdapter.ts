@@ -1,7 +1,9 @@
-import { WandData, EvalResponse } from '../types';
+import { WandData, EvalResponse, EvalNode, EvalTreeDag } from '../types';
 
 let worker: Worker | null = null;
 let lastRequestId = 0;
+// 每个插槽正在进行的流式评估，新请求到来时中止旧的 (后端随即停止计算剩余轮次)
+const inflightRequests: Record<string, AbortController> = {};
 
 /**
  * 获取图标路径
@@ -17,6 +19,91 @@ export function getIconUrl(iconPath: string, isConnected: boolean): string {
   return `/api/icon/${iconPath}`;
 }
 
+/**
+ * 把 DAG 形式的树还原成普通的树。相同的子树还原为同一个对象 (只读共享)，
+ * 所以即使展开后有上百万个节点，内存占用也与 DAG 的大小相当。
+ */
+export function expandTreeDag(dag: EvalTreeDag): EvalNode {
+  const built: EvalNode[] = new Array(dag.nodes.length);
+  // nodes 按后序排列，子节点总是先于父节点出现
+  dag.nodes.forEach((node, i) => {
+    built[i] = { ...node, children: node.children.map(c => built[c]) } as EvalNode;
+  });
+  return built[dag.root];
+}
+
+/**
+ * 读取 /api/evaluate 的逐轮 NDJSON 流，每收到一轮施法就用已拼好的部分结果回调一次
+ */
+async function readEvalStream(
+  res: Response,
+  onProgress: (partial: EvalResponse) => void
+): Promise<EvalResponse | null> {
+  const tree: EvalNode = { name: 'Wand', count: 1, extra: '', index: [], children: [] };
+  const result: EvalResponse = { tree, states: [], counts: {}, cast_counts: {} };
+  if (!res.body) return null;
+
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let newline;
+    while ((newline = buffer.indexOf('\n')) >= 0) {
+      const line = buffer.slice(0, newline).trim();
+      buffer = buffer.slice(newline + 1);
+      if (!line) continue;
+
+      const msg = JSON.parse(line);
+      if (msg.type === 'cast') {
+        tree.children.push(msg.node);
+        result.states.push(...msg.states);
+        if (Object.keys(msg.counts).length > 0) result.cast_counts[String(msg.cast)] = msg.counts;
+        for (const [id, n] of Object.entries(msg.counts as Record<string, number>)) {
+          result.counts[id] = (result.counts[id] || 0) + n;
+        }
+        onProgress({
+          ...result,
+          tree: { ...tree, children: [...tree.children] },
+          states: [...result.states],
+          counts: { ...result.counts },
+          cast_counts: { ...result.cast_counts }
+        });
+      } else if (msg.type === 'done') {
+        result.counts = msg.counts;
+        return result;
+      } else if (msg.type === 'error') {
+        console.error(`Backend Error: ${msg.error}`, msg.details || '');
+        return null;
+      }
+    }
+  }
+  return null;
+}
+
+/**
+ * 取消后端正在进行的评估。省略 slotId 时取消整个标签页 (例如关闭标签页)
+ */
+export function cancelEvaluation(tabId: string, slotId?: string) {
+  const prefix = slotId === undefined ? `${tabId}-` : `${tabId}-${slotId}`;
+  for (const key of Object.keys(inflightRequests)) {
+    if (slotId === undefined ? key.startsWith(prefix) : key === prefix) {
+      inflightRequests[key].abort();
+      delete inflightRequests[key];
+    }
+  }
+  if ((import.meta as any).env?.VITE_STATIC_MODE === 'true') return;
+  fetch('/api/evaluate/cancel', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ tab_id: tabId, slot_id: slotId }),
+    keepalive: true
+  }).catch(() => {});
+}
+
 /**
  * 魔杖评估适配器
  * 自动在 后端API 和 本地WASM引擎 之间切换
@@ -27,7 +114,8 @@ export async function evaluateWand(
   isConnected: boolean,
   tabId: string = 'default',
   slotId: string = '1',
-  force: boolean = false
+  force: boolean = false,
+  onProgress?: (partial: EvalResponse, id: number) => void
 ): Promise<{ data: EvalResponse, id: number } | null> {
   
   const isStaticMode = (import.meta as any).env?.VITE_STATIC_MODE === 'true';
@@ -36,6 +124,14 @@ export async function evaluateWand(
   // --- 路径 A: 桌面/EXE/Dev 模式 ---
   if (!isStaticMode) {
     console.log(`[Evaluator] Using Backend API (${requestId})`);
+    const slotKey = `${tabId}-${slotId}`;
+    // 关闭折叠时结果可能非常大：改为一次性请求 DAG 形式的树，不走逐轮流式
+    const useDag = settings.foldNodes === false;
+    const stream = !!onProgress && !useDag;
+    // 同插槽的新请求顶替旧请求：断开旧连接，后端会随之终止旧的评估
+    inflightRequests[slotKey]?.abort();
+    const controller = new AbortController();
+    inflightRequests[slotKey] = controller;
     try {
       const spells: string[] = [];
       for (let i = 1; i <= wand.deck_capacity; i++) {
@@ -45,7 +141,10 @@ export async function evaluateWand(
       const res = await fetch('/api/evaluate', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
+        signal: controller.signal,
         body: JSON.stringify({
+          stream,
+          tree_format: useDag ? 'dag' : undefined,
           tab_id: tabId,
           slot_id: slotId,
           mana_max: wand.mana_max,
@@ -76,12 +175,24 @@ export async function evaluateWand(
         return null;
       }
 
+      if (stream && onProgress) {
+        const data = await readEvalStream(res, partial => onProgress(partial, requestId));
+        return data ? { data, id: requestId } : null;
+      }
+
       const data = await res.json();
+      if (data.success && data.data.tree_dag) {
+        const { tree_dag, ...rest } = data.data;
+        return { data: { ...rest, tree: expandTreeDag(tree_dag) }, id: requestId };
+      }
       if (data.success) return { data: data.data, id: requestId };
       return null;
     } catch (e) {
+      if (controller.signal.aborted) return null; // 被同插槽更新的评估顶替或已取消
       console.error("API Fetch failed:", e);
       return null;
+    } finally {
+      if (inflightRequests[slotKey] === controller) delete inflightRequests[slotKey];
     }
   }
 
@@ -118,6 +118,13 @@ export interface EvalResponse {
   cast_counts: Record<string, Record<string, number>>;
 }
 
+// 后端 tree_format: 'dag' 返回的树：完全相同的子树只出现一次，children 为节点编号
+export interface EvalTreeDag {
+  root: number;
+  expanded_nodes: number;
+  nodes: (Omit<EvalNode, 'children'> & { children: number[] })[];
+}
+
 export interface WarehouseWand extends WandData {
   id: string;
   name: string;
@@ -15,6 +15,8 @@ ws_log("Game root identified: " .. game_root)
 
 local sync_channel = effil.channel()
 local response_channel = effil.channel()
+-- 推送给 WATCH 连接的事件 (每条一行 JSON)
+local event_channel = effil.channel()
 
 local function table_to_json(t)
     if t == nil then return "null" end
@@ -47,7 +49,7 @@ local function parse_json(s)
     return nil
 end
 
-local function server_thread_func(chan, resp_chan, pkg_path, pkg_cpath, root_path)
+local function server_thread_func(chan, resp_chan, event_chan, pkg_path, pkg_cpath, root_path)
     package.path = pkg_path; package.cpath = pkg_cpath
     local socket = require("socket")
     local server = socket.tcp()
@@ -70,41 +72,95 @@ local function server_thread_func(chan, resp_chan, pkg_path, pkg_cpath, root_pat
         return true
     end
 
+    -- 请求带上编号，主线程按编号回复。等待超时的请求 (例如游戏暂停时主线程不运行) 之后才到的回复会被丢弃，
+    -- 不会被下一条命令当成自己的回复
+    local next_request_id = 0
+    local function request(msg, timeout)
+        next_request_id = next_request_id + 1
+        chan:push(msg, next_request_id)
+        local deadline = socket.gettime() + timeout
+        while true do
+            local left = deadline - socket.gettime()
+            if left <= 0 then return nil end
+            local reply, reply_id = resp_chan:pop(math.ceil(left * 1000), "ms")
+            if reply == nil then return nil end
+            if reply_id == next_request_id then return reply end
+        end
+    end
+
+    -- WATCH 连接保持打开，游戏主线程产生的事件和心跳都从这里推送给后端
+    local watchers = {}
+    local last_heartbeat = socket.gettime()
+    local function broadcast(data)
+        for i = #watchers, 1, -1 do
+            if not safe_send(watchers[i], data) then
+                watchers[i]:close()
+                table.remove(watchers, i)
+                chan:push("WATCHERS:" .. #watchers)
+            end
+        end
+    end
+
     while true do
         local client = server:accept()
         if client then
             client:settimeout(5) -- 增加超时时间到 5s
             local line = client:receive("*l")
-            if line == "GET_ALL_WANDS" then
-                chan:push("REQUEST_FETCH")
-                safe_send(client, (resp_chan:pop(2) or "{}") .. "\n")
+            if line == "WATCH" then
+                if safe_send(client, "WATCHING\n") then
+                    client:settimeout(1)
+                    table.insert(watchers, client)
+                    chan:push("WATCHERS:" .. #watchers)
+                    client = nil
+                end
+            elseif line == "GET_ALL_WANDS" then
+                safe_send(client, (request("REQUEST_FETCH", 2) or "{}") .. "\n")
+            elseif line == "GET_WAND_HASHES" then
+                safe_send(client, (request("REQUEST_HASHES", 2) or "{}") .. "\n")
+            elseif line and line:sub(1, 10) == "GET_WANDS:" then
+                safe_send(client, (request("REQUEST_WANDS:" .. line:sub(11), 2) or "{}") .. "\n")
+            elseif line and line:sub(1, 11) == "SYNC_BATCH " then
+                -- 分帧的批量推送：首行给出魔杖数，随后每行一个魔杖 JSON
+                local lines = {}
+                for i = 1, tonumber(line:sub(12)) or 0 do
+                    local item = client:receive("*l")
+                    if not item then break end
+                    table.insert(lines, item)
+                end
+                safe_send(client, (request("BATCH:" .. table.concat(lines, "\n"), 5) or "[]") .. "\n")
             elseif line == "GET_WAND_EDITOR_DATA" then
-                chan:push("REQUEST_WAND_EDITOR")
-                safe_send(client, (resp_chan:pop(2) or "{}") .. "\n")
+                safe_send(client, (request("REQUEST_WAND_EDITOR", 2) or "{}") .. "\n")
             elseif line == "GET_SPELL_LAB_DATA" then
-                chan:push("REQUEST_SPELL_LAB")
-                safe_send(client, (resp_chan:pop(2) or "{}") .. "\n")
+                safe_send(client, (request("REQUEST_SPELL_LAB", 2) or "{}") .. "\n")
             elseif line == "GET_ALL_SPELLS" then
-                chan:push("REQUEST_ALL_SPELLS")
-                safe_send(client, (resp_chan:pop(15) or "[]") .. "\n")
+                safe_send(client, (request("REQUEST_ALL_SPELLS", 15) or "[]") .. "\n")
             elseif line == "GET_MOD_APPENDS" then
-                chan:push("REQUEST_MOD_APPENDS")
-                safe_send(client, (resp_chan:pop(15) or "{}") .. "\n")
+                safe_send(client, (request("REQUEST_MOD_APPENDS", 15) or "{}") .. "\n")
             elseif line == "GET_ACTIVE_MODS" then
-                chan:push("REQUEST_ACTIVE_MODS")
-                safe_send(client, (resp_chan:pop(2) or "[]") .. "\n")
+                safe_send(client, (request("REQUEST_ACTIVE_MODS", 2) or "[]") .. "\n")
             elseif line == "GET_GAME_INFO" then
                 safe_send(client, '{"root":"' .. root_path:gsub("\\", "/") .. '"}\n')
             elseif line then
                 chan:push("DATA:" .. line)
                 safe_send(client, "OK\n")
             end
-            client:close()
+            if client then client:close() end
+        end
+        if #watchers > 0 then
+            local event = event_chan:pop(0)
+            while event do
+                broadcast(event .. "\n")
+                event = event_chan:pop(0)
+            end
+            if socket.gettime() - last_heartbeat >= 2 then
+                broadcast('{"type":"ping"}\n')
+                last_heartbeat = socket.gettime()
+            end
         end
         require("effil").sleep(0.05)
     end
 end
-effil.thread(server_thread_func)(sync_channel, response_channel, package.path, package.cpath, game_root)
+effil.thread(server_thread_func)(sync_channel, response_channel, event_channel, package.path, package.cpath, game_root)
 
 local function GetWandAtSlot(slot)
     local p = EntityGetWithTag("player_unit")[1]
@@ -187,12 +243,135 @@ local function ApplyFullWand(w, data)
     if p then local i2 = EntityGetFirstComponent(p, "Inventory2Component"); if i2 then ComponentSetValue2(i2, "mForceRefresh", true) end end
 end
 
+local watcher_count = 0
+local last_wands_json = nil
+
+-- 魔杖 JSON 的内容哈希 (两个 32 位字符串哈希拼接)，后端据此只拉取变化了的魔杖
+local function content_hash(s)
+    local h1, h2 = 5381, 0
+    for i = 1, #s do
+        local c = s:byte(i)
+        h1 = (h1 * 33 + c) % 4294967296
+        h2 = (h2 * 65599 + c) % 4294967296
+    end
+    return string.format("%08x%08x", h1, h2)
+end
+
+-- 序列化指定槽位的魔杖，返回 槽位 -> JSON 与 槽位 -> 哈希
+local function SerializeSlots(slots)
+    local wands, hashes = {}, {}
+    for _, i in ipairs(slots) do
+        local w = GetWandAtSlot(i)
+        if w then
+            local json = table_to_json(serialize_wand(w))
+            wands[tostring(i)] = json
+            hashes[tostring(i)] = content_hash(json)
+        end
+    end
+    return wands, hashes
+end
+
+-- 有后端在 WATCH 时每 30 帧检查一次快捷栏魔杖，变化了才推送
+local function PushWandChanges()
+    if watcher_count == 0 or GameGetFrameNum() % 30 ~= 0 then return end
+    local all = {}
+    for i=1, 4 do local w = GetWandAtSlot(i); if w then all[tostring(i)] = serialize_wand(w) end end
+    local json = table_to_json(all)
+    if json ~= last_wands_json then
+        last_wands_json = json
+        event_channel:push('{"type":"wands","wands":' .. json .. '}')
+    end
+end
+
+-- 应用一条魔杖推送 (带 slot 的 JSON)，返回是否成功与失败原因
+local function ApplyWandPush(data)
+    local slot = tonumber(data.slot) or 1
+    local w = GetWandAtSlot(slot)
+
+    if data.delete then
+        if w then EntityKill(w) end
+        return true
+    end
+    if not w and slot <= 4 then
+        -- Try to spawn a new wand if it doesn't exist in the slot
+        local player = EntityGetWithTag("player_unit")[1]
+        if player then
+            local x, y = EntityGetTransform(player)
+            w = EntityLoad("data/entities/items/wand_level_01.xml", x, y)
+
+            -- CRITICAL: Disable physics and sprites that cause "ghosts" at 0,0
+            local components = EntityGetAllComponents(w) or {}
+            for _, c in ipairs(components) do
+                local type_name = ComponentGetTypeName(c)
+                -- These components cause world-space rendering or physics bobbing
+                if type_name == "SpriteOffsetAnimComponent" or 
+                   type_name == "VelocityComponent" or 
+                   type_name == "SimplePhysicsComponent" or
+                   type_name == "PhysicsBodyComponent" or
+                   type_name == "LuaComponent" then
+                    EntityRemoveComponent(w, c)
+                end
+            end
+
+            local ic = EntityGetFirstComponentIncludingDisabled(w, "ItemComponent")
+            if ic then
+                ComponentSetValue2(ic, "inventory_slot", slot - 1, 0)
+                ComponentSetValue2(ic, "is_on_floor", false)
+                ComponentSetValue2(ic, "is_pickable", false)
+                ComponentSetValue2(ic, "mItemIsInventoryItem", true)
+            end
+
+            -- Find quick inventory and force child attachment
+            local inv = nil
+            for _, c in ipairs(EntityGetAllChildren(player) or {}) do 
+                if EntityGetName(c) == "inventory_quick" then inv = c break end 
+            end
+            if inv then 
+                EntityAddChild(inv, w)
+                EntitySetTransform(w, 0, 0) 
+            end
+
+            -- Force refresh inventory UI
+            local i2 = EntityGetFirstComponent(player, "Inventory2Component")
+            if i2 then
+                ComponentSetValue2(i2, "mForceRefresh", true)
+            end
+        end
+    end
+
+    if not w then return false, "no wand in slot " .. slot end
+    ApplyFullWand(w, data)
+    return true
+end
+
 function OnWorldPostUpdate()
-    local msg = sync_channel:pop(0)
-    if msg == "REQUEST_FETCH" then
+    PushWandChanges()
+    -- request_id 由服务端线程附在请求上，回复时原样带回
+    local msg, request_id = sync_channel:pop(0)
+    if msg and msg:sub(1, 9) == "WATCHERS:" then
+        watcher_count = tonumber(msg:sub(10)) or 0
+        -- 新的连接需要先拿到一次完整状态
+        last_wands_json = nil
+        if watcher_count > 0 then
+            event_channel:push('{"type":"mods","active_mods":' .. table_to_json(ModGetActiveModIDs() or {}) .. '}')
+        end
+    elseif msg == "REQUEST_FETCH" then
         local all = {}
         for i=1, 4 do local w = GetWandAtSlot(i); if w then all[tostring(i)] = serialize_wand(w) end end
-        response_channel:push(table_to_json(all))
+        response_channel:push(table_to_json(all), request_id)
+    elseif msg == "REQUEST_HASHES" then
+        local _, hashes = SerializeSlots({1, 2, 3, 4})
+        response_channel:push(table_to_json(hashes), request_id)
+    elseif msg and msg:sub(1, 14) == "REQUEST_WANDS:" then
+        local slots = {}
+        for n in msg:sub(15):gmatch("%d+") do
+            local i = tonumber(n)
+            if i >= 1 and i <= 4 then table.insert(slots, i) end
+        end
+        local wands, hashes = SerializeSlots(slots)
+        local parts = {}
+        for k, json in pairs(wands) do table.insert(parts, '"' .. k .. '":' .. json) end
+        response_channel:push('{"wands":{' .. table.concat(parts, ",") .. '},"hashes":' .. table_to_json(hashes) .. '}', request_id)
     elseif msg == "REQUEST_WAND_EDITOR" then
         local pages = {}
         local idx = 1
@@ -206,7 +385,7 @@ function OnWorldPostUpdate()
                 break
             end
         end
-        response_channel:push(table_to_json(pages))
+        response_channel:push(table_to_json(pages), request_id)
     elseif msg == "REQUEST_SPELL_LAB" then
         local data = {}
         -- Spell Lab Shugged
@@ -222,7 +401,7 @@ function OnWorldPostUpdate()
         local orig = ModSettingGet("spell_lab.spell_lab_saved_wands") or ModSettingGet("spell_lab_saved_wands")
         if orig then data.original = orig end
         
-        response_channel:push(table_to_json(data))
+        response_channel:push(table_to_json(data), request_id)
     elseif msg == "REQUEST_ALL_SPELLS" then
         ws_log("Processing REQUEST_ALL_SPELLS with deep analysis...")
         if not actions then
@@ -390,75 +569,34 @@ function OnWorldPostUpdate()
         }
         
         ws_log("Encoding " .. #all_actions .. " spells and " .. #appends .. " appends...")
-        response_channel:push(table_to_json(response))
+        response_channel:push(table_to_json(response), request_id)
     elseif msg == "REQUEST_MOD_APPENDS" then
         local appends = ModLuaFileGetAppends("data/scripts/gun/gun_actions.lua") or {}
         local data = {}
         for _, path in ipairs(appends) do
             data[path] = ModTextFileGetContent(path)
         end
-        response_channel:push(table_to_json(data))
+        response_channel:push(table_to_json(data), request_id)
     elseif msg == "REQUEST_ACTIVE_MODS" then
-        response_channel:push(table_to_json(ModGetActiveModIDs() or {}))
+        response_channel:push(table_to_json(ModGetActiveModIDs() or {}), request_id)
     elseif msg and msg:sub(1,5) == "DATA:" then
         local data = parse_json(msg:sub(6))
-        if data and not data.ping then
-            local slot = tonumber(data.slot) or 1
-            local w = GetWandAtSlot(slot)
-            
-            if data.delete then
-                if w then EntityKill(w) end
+        if data and not data.ping then ApplyWandPush(data) end
+    elseif msg and msg:sub(1, 6) == "BATCH:" then
+        -- 批量推送：每行一个魔杖，全部应用后一次性回复每个魔杖的确认
+        local acks = {}
+        for line in msg:sub(7):gmatch("[^\n]+") do
+            local data = parse_json(line)
+            local ok, applied, reason = false, false, "invalid json"
+            if data then ok, applied, reason = pcall(ApplyWandPush, data) end
+            if ok and applied then
+                table.insert(acks, { ok = true })
             else
-                if not w and slot <= 4 then
-                    -- Try to spawn a new wand if it doesn't exist in the slot
-                    local player = EntityGetWithTag("player_unit")[1]
-                    if player then
-                        local x, y = EntityGetTransform(player)
-                        w = EntityLoad("data/entities/items/wand_level_01.xml", x, y)
-                        
-                        -- CRITICAL: Disable physics and sprites that cause "ghosts" at 0,0
-                        local components = EntityGetAllComponents(w) or {}
-                        for _, c in ipairs(components) do
-                            local type_name = ComponentGetTypeName(c)
-                            -- These components cause world-space rendering or physics bobbing
-                            if type_name == "SpriteOffsetAnimComponent" or 
-                               type_name == "VelocityComponent" or 
-                               type_name == "SimplePhysicsComponent" or
-                               type_name == "PhysicsBodyComponent" or
-                               type_name == "LuaComponent" then
-                                EntityRemoveComponent(w, c)
-                            end
-                        end
-
-                        local ic = EntityGetFirstComponentIncludingDisabled(w, "ItemComponent")
-                        if ic then
-                            ComponentSetValue2(ic, "inventory_slot", slot - 1, 0)
-                            ComponentSetValue2(ic, "is_on_floor", false)
-                            ComponentSetValue2(ic, "is_pickable", false)
-                            ComponentSetValue2(ic, "mItemIsInventoryItem", true)
-                        end
-
-                        -- Find quick inventory and force child attachment
-                        local inv = nil
-                        for _, c in ipairs(EntityGetAllChildren(player) or {}) do 
-                            if EntityGetName(c) == "inventory_quick" then inv = c break end 
-                        end
-                        if inv then 
-                            EntityAddChild(inv, w)
-                            EntitySetTransform(w, 0, 0) 
-                        end
-
-                        -- Force refresh inventory UI
-                        local i2 = EntityGetFirstComponent(player, "Inventory2Component")
-                        if i2 then
-                            ComponentSetValue2(i2, "mForceRefresh", true)
-                        end
-                    end
-                end
-                
-                if w then ApplyFullWand(w, data) end
+                -- pcall 失败时第二个返回值是错误信息
+                table.insert(acks, { ok = false, error = tostring(ok and reason or applied) })
             end
         end
+        response_channel:push(table_to_json(acks), request_id)
     end
 end
 ws_log("WandSync Ready!")